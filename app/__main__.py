@@ -1,13 +1,16 @@
+import gc
 import logging
 import os
+import signal
 import time
 
-from injector import Injector, inject
-from dotenv import load_dotenv
+# First, so the timing covers the imports below
+from app.startup import read_sensors, timer
 
-from app.config import check_config
-from app.container import AppModule
-from app.services import SensorsService, MqttService, MockSensorService, RfidService
+with timer.phase("imports"):
+    from dotenv import load_dotenv
+
+    from app.config import check_config, get_config_path
 
 load_dotenv()
 log_level = os.environ.get('LOG_LEVEL', 'INFO')
@@ -17,37 +20,116 @@ logging.basicConfig(
 )
 
 
-@inject
-def main(
-    mqtt_service: MqttService,
-    sensors_service: SensorsService,
-    rfid_service: RfidService,
-    mock_sensor_service: MockSensorService,
-) -> None:
-    mqtt_service.connect()
+# Longest wait for GPIO edges before looking for a config change
+RELOAD_CHECK_INTERVAL = 1.0
+
+
+def _terminate(signum, frame):
+    # SIGTERM (systemd, docker stop) shuts down like Ctrl+C
+    raise KeyboardInterrupt
+
+
+def _runtime() -> str:
+    return os.environ.get("RUNTIME", "threads").lower()
+
+
+def _on_first_publish(mid) -> None:
+    if timer.mark("first_publish"):
+        timer.log()
+
+
+def main(mqtt_service, sensors_service, rfid_service, gpio_simulator, metrics_exporter, config_reloader) -> None:
+    mqtt_service.mqtt_client.add_publish_listener(_on_first_publish)
+    # The objects built at startup live until the end: moved out of the
+    # collector's reach, they are not traversed again by every full collection
+    gc.collect()
+    gc.freeze()
+    if _runtime() == "asyncio":
+        # asyncio is only imported by this runtime
+        import asyncio
+        from app.runtime import AsyncRuntime
+
+        asyncio.run(AsyncRuntime(
+            mqtt_service, sensors_service, rfid_service, gpio_simulator, metrics_exporter, config_reloader
+        ).run())
+        return
+
+    signal.signal(signal.SIGTERM, _terminate)
+    signal.signal(signal.SIGHUP, lambda signum, frame: config_reloader.request())
+    if _runtime() == "processes":
+        from app.supervisor import ProcessRuntime
+
+        ProcessRuntime(
+            mqtt_service, sensors_service, rfid_service, gpio_simulator, metrics_exporter, config_reloader
+        ).run()
+        return
+    with timer.phase("mqtt"):
+        mqtt_service.connect()
     sensors_service.connect_sensors()
-    rfid_service.connect_sensors()
+    with timer.phase("rfid"):
+        rfid_service.connect_sensors()
+        rfid_service.start()
+    metrics_exporter.start()
 
-    if not sensors_service.is_real_board():
-        mock_sensor_service.start()
+    if not sensors_service.is_real_board:
+        gpio_simulator.start()
 
-    check_timer: int = 0
+    config_reloader.watch()
+    timer.log()
     try:
         while True:
-            check_timer += 1
-            if check_timer == 5:
+            digest_in = sensors_service.supervise(time.monotonic())
+            if sensors_service.edge_mode:
+                sensors_service.wait_events(
+                    RELOAD_CHECK_INTERVAL if digest_in is None else min(RELOAD_CHECK_INTERVAL, digest_in)
+                )
+            else:
                 sensors_service.check_sensors()
-                check_timer = 0
-
-            time.sleep(0.1)
+                time.sleep(sensors_service.config.poll_interval)
+            if "rfid" in config_reloader.check():
+                rfid_service.start()
     except KeyboardInterrupt:
+        if not sensors_service.is_real_board:
+            gpio_simulator.stop()
+        rfid_service.stop()
+        metrics_exporter.stop()
+        config_reloader.close()
         mqtt_service.disconnect()
-        if not sensors_service.is_real_board():
-            mock_sensor_service.stop()
 
 
-if __name__ == "__main__":
+def run() -> None:
+    """
+    Read the sensors before the rest of the application is imported, with
+    nothing but configparser and gpiod, so the state at power-on is
+    captured as early as possible; the services are built afterwards and
+    the snapshot of that first read is queued before the MQTT connection,
+    the RFID readers and the other services are started.
+    """
     logging.info("PiAlarmAdapter is starting...")
     check_config()
-    injector = Injector([AppModule()])
-    injector.call_with_injection(main)
+    initial = None
+    if _runtime() != "processes":
+        # the workers of the processes runtime read the lines themselves
+        with timer.phase("gpio"):
+            initial = read_sensors(get_config_path())
+        timer.mark("gpio_state")
+    with timer.phase("imports"):
+        from injector import Injector
+
+        from app.container import AppModule
+        from app.metrics import MetricsExporter
+        from app.reload import ConfigReloader
+        from app.services import SensorsService, MqttService, RfidService
+        from app.simulator import GpioSimulator
+    with timer.phase("config"):
+        app_injector = Injector([AppModule()])
+    if initial is not None:
+        app_injector.get(SensorsService).connect_sensors(initial)
+    main(*(
+        app_injector.get(service)
+        for service in (MqttService, SensorsService, RfidService, GpioSimulator, MetricsExporter, ConfigReloader)
+    ))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,68 @@
+import json
+import logging
+
+
+def parse_uid(text: str) -> bytes:
+    return bytes.fromhex(text.replace(":", "").replace("-", "").strip())
+
+
+class AllowList:
+    """
+    In-memory index of the tags allowed to arm and disarm, keyed by UID, so
+    the decision on a read is a dictionary lookup.  The list is written one
+    tag per line as ``UID [label]`` (``#`` starts a comment), or as JSON: a
+    list of UIDs or an object mapping UIDs to labels.  A reload builds a new
+    index and swaps it in one assignment, so lookups never see half a list.
+    """
+
+    def __init__(self, entries=None):
+        self.logger = logging.getLogger(__name__)
+        self.entries = dict(entries or {})
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, uid: bytes) -> bool:
+        return uid in self.entries
+
+    def lookup(self, uid: bytes):
+        """Label of an allowed tag, ``None`` if the tag is not allowed."""
+        return self.entries.get(uid)
+
+    @staticmethod
+    def parse(text: str) -> dict:
+        text = text.strip()
+        if text.startswith(("[", "{")):
+            data = json.loads(text)
+            if isinstance(data, list):
+                if not all(isinstance(uid, str) for uid in data):
+                    raise ValueError("the UIDs must be strings")
+                data = {uid: "" for uid in data}
+            return {parse_uid(uid): str(label) for uid, label in data.items()}
+        entries = {}
+        for line in text.splitlines():
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            uid, _, label = line.replace(",", " ", 1).partition(" ")
+            entries[parse_uid(uid)] = label.strip()
+        return entries
+
+    def load(self, text: str, source: str) -> None:
+        try:
+            entries = self.parse(text)
+        except (ValueError, TypeError, AttributeError) as e:
+            self.logger.error("Invalid allow-list from %s, keeping the current one: %s", source, e)
+            return
+        self.entries = entries
+        self.logger.info("Loaded %d allowed tags from %s", len(entries), source)
+
+    def load_file(self, path) -> None:
+        try:
+            with open(path) as f:
+                self.load(f.read(), str(path))
+        except OSError as e:
+            self.logger.error("Cannot read the allow-list %s: %s", path, e)
+
+    def load_payload(self, payload: bytes) -> None:
+        self.load(payload.decode(errors="replace"), "MQTT")
@@ -4,14 +4,41 @@ import configparser
 import injector
 
 from app.config import get_config_path
-from app.models import MqttConfig, SensorsConfig, RfidConfig
+from app.journal import Journal
+from app.metrics import MetricsExporter
+from app import fake_expander, fake_gpiod
+from app.fake_mfrc522 import FakeSpiBus
+from app.models import MqttConfig, SensorsConfig, RfidConfig, MetricsConfig, SimulatorConfig
 from app.mqtt_client import MqttClient
-from app.services import MqttService, SensorsService, MockSensorService, RfidService
+from app.publisher import OutboundQueue
+from app.reload import ConfigReloader
+from app.spool import MessageSpool
+from app.services import MqttService, SensorsService, RfidService
+from app.simulator import GpioSimulator
+from app.topics import TopicTable
+
+
+def _optional_section(parser: configparser.ConfigParser, name: str) -> dict:
+    return dict(parser[name]) if parser.has_section(name) else {}
+
+
+def _parse_sensors(section) -> tuple:
+    """
+    Each sensor is written as ``name = pin`` or ``name = pin,chip`` when
+    the line does not belong to the default GPIO chip.
+    """
+    sensors, chips = {}, {}
+    for name, value in section.items():
+        pin, _, chip = value.partition(",")
+        sensors[int(pin)] = name
+        if chip.strip():
+            chips[int(pin)] = chip.strip()
+    return sensors, chips
 
 
 def _load_configs():
     """
-    Load the three config objects from the file indicated by
+    Load the config objects from the file indicated by
     :func:`app.config.get_config_path`.  The old
     ``providers.Configuration`` is replaced by a straightforward
     ``configparser`` read.
@@ -21,38 +48,59 @@ def _load_configs():
     parser.read(config_path)
 
     mqtt_cfg = MqttConfig(
-        address=parser["mqtt"]["address"],
-        port=int(parser["mqtt"]["port"]),
-        username=parser["mqtt"]["username"],
-        password=parser["mqtt"]["password"],
+        topics=_optional_section(parser, "topics"),
+        groups=_optional_section(parser, "groups"),
+        **parser["mqtt"],
     )
+    sensors, chips = _parse_sensors(parser["sensors"])
+    debounce = _optional_section(parser, "debounce")
     sensors_cfg = SensorsConfig(
-        sensors={int(v): k for k, v in parser["sensors"].items()}
+        sensors=sensors,
+        chips=chips,
+        expanders=_optional_section(parser, "expanders"),
+        zones=_optional_section(parser, "zones"),
+        debounce_times={pin: float(debounce[name]) for pin, name in sensors.items() if name in debounce},
+        **_optional_section(parser, "gpio"),
+    )
+    rfid_cfg = RfidConfig(sensors=parser["rfid"], **_optional_section(parser, "rfid_options"))
+    metrics_cfg = MetricsConfig(**_optional_section(parser, "metrics"))
+    intervals = _optional_section(parser, "simulator_intervals")
+    simulator_cfg = SimulatorConfig(
+        intervals={pin: float(intervals[name]) for pin, name in sensors.items() if name in intervals},
+        **_optional_section(parser, "simulator"),
     )
-    rfid_cfg = RfidConfig(sensors=parser["rfid"])
+    if not sensors_cfg.is_real_board():
+        first = max(sensors, default=0) + 1
+        for pin in range(first, first + simulator_cfg.virtual_sensors):
+            sensors_cfg.sensors[pin] = f"virtual{pin}"
 
-    return mqtt_cfg, sensors_cfg, rfid_cfg
+    return mqtt_cfg, sensors_cfg, rfid_cfg, metrics_cfg, simulator_cfg
 
 
 class AppModule(injector.Module):
-    def __init__(self, mqtt_cfg=None, sensors_cfg=None, rfid_cfg=None):
+    def __init__(self, mqtt_cfg=None, sensors_cfg=None, rfid_cfg=None, metrics_cfg=None, simulator_cfg=None):
         super().__init__()
         self._mqtt_cfg = mqtt_cfg
         self._sensors_cfg = sensors_cfg
         self._rfid_cfg = rfid_cfg
+        self._metrics_cfg = metrics_cfg
+        self._simulator_cfg = simulator_cfg
 
     def configure(self, binder: injector.Binder) -> None:
-        binder.bind(queue.Queue, to=queue.Queue, scope=injector.singleton)
-
-        if any(x is None for x in (self._mqtt_cfg, self._sensors_cfg, self._rfid_cfg)):
-            mqtt_cfg, sensors_cfg, rfid_cfg = _load_configs()
+        configs = (self._mqtt_cfg, self._sensors_cfg, self._rfid_cfg, self._metrics_cfg, self._simulator_cfg)
+        if any(x is None for x in configs):
+            mqtt_cfg, sensors_cfg, rfid_cfg, metrics_cfg, simulator_cfg = _load_configs()
             self._mqtt_cfg = self._mqtt_cfg or mqtt_cfg
             self._sensors_cfg = self._sensors_cfg or sensors_cfg
             self._rfid_cfg = self._rfid_cfg or rfid_cfg
+            self._metrics_cfg = self._metrics_cfg or metrics_cfg
+            self._simulator_cfg = self._simulator_cfg or simulator_cfg
 
         binder.bind(MqttConfig, to=self._mqtt_cfg, scope=injector.singleton)
         binder.bind(SensorsConfig, to=self._sensors_cfg, scope=injector.singleton)
         binder.bind(RfidConfig, to=self._rfid_cfg, scope=injector.singleton)
+        binder.bind(MetricsConfig, to=self._metrics_cfg, scope=injector.singleton)
+        binder.bind(SimulatorConfig, to=self._simulator_cfg, scope=injector.singleton)
 
     @injector.singleton
     @injector.provider
@@ -61,8 +109,45 @@ class AppModule(injector.Module):
 
     @injector.singleton
     @injector.provider
-    def provide_mqtt_service(self, client: MqttClient) -> MqttService:
-        return MqttService(client)
+    def provide_outbound_queue(self, config: MqttConfig) -> queue.Queue:
+        return OutboundQueue(
+            config.queue_size,
+            config.overflow_policy,
+            coalesce=config.coalesce,
+            window=config.coalesce_window,
+            max_latency=config.coalesce_max_latency,
+        )
+
+    @injector.singleton
+    @injector.provider
+    def provide_mqtt_service(
+        self,
+        client: MqttClient,
+        outbound_queue: queue.Queue,
+        config: MqttConfig,
+    ) -> MqttService:
+        spool = None
+        if config.spool_size > 0:
+            spool_path = config.spool_path or get_config_path().parent / "spool.bin"
+            spool = MessageSpool(spool_path, config.spool_size)
+        journal = None
+        if config.journal_size > 0:
+            journal_path = config.journal_path or get_config_path().parent / "journal"
+            journal = Journal(journal_path, config.journal_size, config.journal_files)
+        return MqttService(
+            client,
+            outbound_queue,
+            config.batch_size,
+            spool,
+            retain=config.retain,
+            snapshot=config.publish_snapshot,
+            payload_format=config.payload_format,
+            journal=journal,
+            topics=TopicTable.from_config(config),
+            status_topic=config.status_topic,
+            digest_topic=config.digest_topic,
+            digest_interval=config.digest_interval,
+        )
 
     @injector.singleton
     @injector.provider
@@ -71,17 +156,53 @@ class AppModule(injector.Module):
         sensors_config: SensorsConfig,
         mqtt_service: MqttService,
     ) -> SensorsService:
-        return SensorsService(sensors_config, mqtt_service)
+        if sensors_config.is_real_board():
+            return SensorsService(sensors_config, mqtt_service)
+        for name, expander in sensors_config.expanders.items():
+            fake_expander.attach(name, expander, sensors_config.chip)
+        return SensorsService(sensors_config, mqtt_service, gpio_backend=fake_gpiod, i2c_backend=fake_expander)
 
     @injector.singleton
     @injector.provider
-    def provide_rfid_service(self, rfid_config: RfidConfig) -> RfidService:
-        return RfidService(rfid_config)
+    def provide_metrics_exporter(
+        self,
+        config: MetricsConfig,
+        mqtt_service: MqttService,
+        sensors_service: SensorsService,
+    ) -> MetricsExporter:
+        return MetricsExporter(config, mqtt_service, sensors_service)
+
+    @injector.singleton
+    @injector.provider
+    def provide_rfid_service(
+        self,
+        rfid_config: RfidConfig,
+        mqtt_service: MqttService,
+        sensors_config: SensorsConfig,
+    ) -> RfidService:
+        transport = None
+        if not sensors_config.is_real_board():
+            transport = FakeSpiBus()
+            for sensor in rfid_config.sensors.values():
+                transport.add(sensor.cs_pin, sensor.rst_pin)
+        return RfidService(rfid_config, mqtt_service, transport)
 
     @injector.singleton
     @injector.provider
-    def provide_mock_sensor_service(
+    def provide_gpio_simulator(
         self,
+        sensors_config: SensorsConfig,
+        simulator_config: SimulatorConfig,
+    ) -> GpioSimulator:
+        return GpioSimulator(sensors_config, simulator_config)
+
+    @injector.singleton
+    @injector.provider
+    def provide_config_reloader(
+        self,
+        mqtt_service: MqttService,
         sensors_service: SensorsService,
-    ) -> MockSensorService:
-        return MockSensorService(sensors_service)
+        rfid_service: RfidService,
+    ) -> ConfigReloader:
+        configs = (self._mqtt_cfg, self._sensors_cfg, self._rfid_cfg, self._metrics_cfg, self._simulator_cfg)
+        return ConfigReloader(mqtt_service, sensors_service, rfid_service, configs, get_config_path(), _load_configs)
@@ -0,0 +1,50 @@
+MIN_RETRY = 0.001
+
+
+class Debouncer:
+    """
+    Software debounce of one sensor.  A new value is accepted only when it
+    has been read in ``samples`` consecutive samples and at least ``settle``
+    seconds have passed since the previous accepted change.  Times come
+    from the monotonic clock (or the kernel event timestamps, which use the
+    same clock), so a wall clock adjustment cannot open or close the window.
+    """
+
+    __slots__ = ("settle", "samples", "last_change", "candidate", "count", "rejected")
+
+    def __init__(self, settle: float = 0.05, samples: int = 1):
+        self.settle = settle
+        self.samples = max(1, samples)
+        self.last_change = float("-inf")
+        self.candidate = None
+        self.count = 0
+        self.rejected = 0
+
+    @property
+    def pending(self) -> bool:
+        """A different value has been read but not accepted yet."""
+        return self.candidate is not None
+
+    def accept(self, current: int, value: int, now: float) -> bool:
+        if value == current:
+            if self.candidate is not None:
+                self.rejected += 1
+            self.candidate = None
+            self.count = 0
+            return False
+        if value != self.candidate:
+            self.candidate = value
+            self.count = 0
+        self.count += 1
+        if self.count < self.samples or now - self.last_change < self.settle:
+            return False
+        self.last_change = now
+        self.candidate = None
+        self.count = 0
+        return True
+
+    def retry_in(self, now: float) -> float:
+        """Seconds before a pending value should be sampled again."""
+        if self.count < self.samples:
+            return max(self.settle / self.samples, MIN_RETRY)
+        return max(self.last_change + self.settle - now, MIN_RETRY)
@@ -0,0 +1,95 @@
+"""
+In-memory MCP23017 and PCF8574 expanders on fake I2C buses, answering the
+``SMBus`` calls made by :mod:`app.inputs`.  An expander is also registered
+as a :mod:`app.fake_gpiod` chip under its name, so its inputs are driven
+with :meth:`FakeChip.set_value` like the lines of the board (the simulator
+does so).  A change pulls the interrupt line low on the fake board chip
+until the port is read, as the real expanders do.
+"""
+import errno
+
+from app import fake_gpiod
+from app.inputs import Mcp23017Driver
+from app.models import EXPANDER_WIDTH, ExpanderConfig, ExpanderKind
+
+
+class FakeExpander(fake_gpiod.FakeChip):
+
+    def __init__(self, name: str, config: ExpanderConfig, interrupt_chip: str = "/dev/gpiochip0"):
+        super().__init__(name)
+        self.config = config
+        self.width = EXPANDER_WIDTH[config.kind]
+        self.interrupt_chip = interrupt_chip
+        self.registers = {}
+        self.transactions = 0
+
+    def port(self) -> int:
+        port = 0
+        for bit in range(self.width):
+            port |= self.values.get(self.config.base + bit, 1) << bit
+        return port
+
+    def set_value(self, offset: int, value: int, timestamp_ns: int = None) -> None:
+        changed = self.values.get(offset, 1) != value
+        super().set_value(offset, value, timestamp_ns)
+        if changed and self.config.interrupt is not None and self._interrupt_enabled(offset):
+            fake_gpiod.chip(self.interrupt_chip).set_value(self.config.interrupt, 0, timestamp_ns)
+
+    def _interrupt_enabled(self, offset: int) -> bool:
+        if self.config.kind is not ExpanderKind.MCP23017:
+            return True
+        enabled = self.registers.get(Mcp23017Driver.GPINTEN, 0) | self.registers.get(Mcp23017Driver.GPINTEN + 1, 0) << 8
+        return bool(enabled >> (offset - self.config.base) & 1)
+
+    def read_port(self) -> int:
+        """One I2C read of the inputs, which releases the interrupt line."""
+        self.transactions += 1
+        if self.config.interrupt is not None:
+            fake_gpiod.chip(self.interrupt_chip).set_value(self.config.interrupt, 1)
+        return self.port()
+
+
+devices = {}
+
+
+def attach(name: str, config: ExpanderConfig, interrupt_chip: str = "/dev/gpiochip0") -> FakeExpander:
+    """Put an expander on its fake bus and register it as the fake chip ``name``."""
+    expander = FakeExpander(name, config, interrupt_chip)
+    devices[config.bus, config.address] = expander
+    fake_gpiod.chips[name] = expander
+    return expander
+
+
+def reset() -> None:
+    devices.clear()
+
+
+class SMBus:
+    """The part of the ``smbus2.SMBus`` API used by the expander drivers."""
+
+    def __init__(self, bus: int):
+        self.bus = bus
+
+    def _device(self, address: int) -> FakeExpander:
+        device = devices.get((self.bus, address))
+        if device is None:
+            raise OSError(errno.EREMOTEIO, f"No device at 0x{address:02x} on I2C bus {self.bus}")
+        return device
+
+    def write_byte(self, address: int, value: int) -> None:
+        self._device(address).transactions += 1
+
+    def write_byte_data(self, address: int, register: int, value: int) -> None:
+        device = self._device(address)
+        device.transactions += 1
+        device.registers[register] = value
+
+    def read_byte(self, address: int) -> int:
+        return self._device(address).read_port() & 0xFF
+
+    def read_i2c_block_data(self, address: int, register: int, length: int) -> list:
+        port = self._device(address).read_port()
+        return [(port >> (8 * index)) & 0xFF for index in range(length)]
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,170 @@
+"""
+In-memory stand-in for the part of the gpiod v2 API used by
+:class:`app.services.SensorsService`: ``request_lines``, ``LineSettings``,
+the ``line`` enums and line requests with edge events and a pollable
+``fd``.  Lines are driven from Python with :meth:`FakeChip.set_value`, so
+the real sampling, debounce and event code runs without hardware.
+"""
+import os
+import threading
+import time
+from enum import Enum
+from types import SimpleNamespace
+
+
+class Direction(Enum):
+    AS_IS = 1
+    INPUT = 2
+    OUTPUT = 3
+
+
+class Bias(Enum):
+    AS_IS = 1
+    UNKNOWN = 2
+    DISABLED = 3
+    PULL_UP = 4
+    PULL_DOWN = 5
+
+
+class Edge(Enum):
+    NONE = 1
+    RISING = 2
+    FALLING = 3
+    BOTH = 4
+
+
+class Value(Enum):
+    INACTIVE = 0
+    ACTIVE = 1
+
+
+line = SimpleNamespace(Direction=Direction, Bias=Bias, Edge=Edge, Value=Value)
+
+
+class LineSettings:
+
+    def __init__(self, direction=Direction.AS_IS, bias=Bias.AS_IS, edge_detection=Edge.NONE,
+                 debounce_period=None, **kwargs):
+        self.direction = direction
+        self.bias = bias
+        self.edge_detection = edge_detection
+        self.debounce_period = debounce_period
+
+
+class EdgeEvent:
+    __slots__ = ("line_offset", "timestamp_ns", "event_type")
+
+    RISING_EDGE = 1
+    FALLING_EDGE = 2
+
+    def __init__(self, line_offset: int, timestamp_ns: int, event_type: int):
+        self.line_offset = line_offset
+        self.timestamp_ns = timestamp_ns
+        self.event_type = event_type
+
+
+class FakeLineRequest:
+    """A request of some lines of a :class:`FakeChip`."""
+
+    def __init__(self, chip: "FakeChip", config: dict):
+        self.chip = chip
+        self.config = config
+        self.events = []
+        self.released = False
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+
+    @property
+    def fd(self) -> int:
+        return self._read_fd
+
+    def get_values(self, offsets=None) -> list:
+        offsets = list(self.config) if offsets is None else offsets
+        values = self.chip.values
+        return [values.get(offset, 1) for offset in offsets]
+
+    def _notify(self, event: EdgeEvent) -> None:
+        with self.chip.lock:
+            was_empty = not self.events
+            self.events.append(event)
+        if was_empty:
+            os.write(self._write_fd, b"\0")
+
+    def read_edge_events(self, max_events=None) -> list:
+        with self.chip.lock:
+            events, self.events = self.events, []
+            try:
+                os.read(self._read_fd, 4096)
+            except BlockingIOError:
+                pass
+        return events
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.chip.requests.remove(self)
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+
+
+class FakeChip:
+    """
+    A GPIO chip whose lines idle high, as the inputs of the sensors with
+    their pull-up.  ``rejects`` holds the settings the chip refuses with an
+    ``OSError``, e.g. ``{"edge_detection"}`` for a board without edge
+    interrupts.
+    """
+
+    def __init__(self, path: str, rejects=()):
+        self.path = path
+        self.rejects = set(rejects)
+        self.values = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def request(self, config: dict) -> FakeLineRequest:
+        for settings in config.values():
+            if "edge_detection" in self.rejects and settings.edge_detection is not Edge.NONE:
+                raise OSError(f"{self.path}: edge detection not supported")
+            if "debounce_period" in self.rejects and settings.debounce_period:
+                raise OSError(f"{self.path}: debounce not supported")
+        request = FakeLineRequest(self, config)
+        self.requests.append(request)
+        return request
+
+    def set_value(self, offset: int, value: int, timestamp_ns: int = None) -> None:
+        """Drive a line and report the edge to the requests watching it."""
+        if self.values.get(offset, 1) == value:
+            return
+        self.values[offset] = value
+        event = EdgeEvent(
+            offset,
+            time.monotonic_ns() if timestamp_ns is None else timestamp_ns,
+            EdgeEvent.RISING_EDGE if value else EdgeEvent.FALLING_EDGE,
+        )
+        edges = (Edge.BOTH, Edge.RISING if value else Edge.FALLING)
+        for request in list(self.requests):
+            settings = request.config.get(offset)
+            if settings is not None and settings.edge_detection in edges:
+                request._notify(event)
+
+
+chips = {}
+
+
+def chip(path: str, **kwargs) -> FakeChip:
+    """Return the fake chip at ``path``, creating it on first use."""
+    if path not in chips:
+        chips[path] = FakeChip(path, **kwargs)
+    return chips[path]
+
+
+def reset() -> None:
+    for fake_chip in chips.values():
+        for request in list(fake_chip.requests):
+            request.release()
+    chips.clear()
+
+
+def request_lines(path: str, consumer: str = None, config: dict = None, **kwargs) -> FakeLineRequest:
+    return chip(path).request(config or {})
@@ -0,0 +1,163 @@
+"""
+In-memory MFRC522 readers on a fake SPI bus, answering the register
+accesses and the ISO 14443A frames used by :mod:`app.mfrc522`.  Tags are
+put on and taken off a reader with :meth:`FakeMfrc522.place` and
+:meth:`FakeMfrc522.remove`.
+"""
+import threading
+
+from app.mfrc522 import (
+    BIT_FRAMING_REG, COMMAND_REG, COM_IRQ_REG, CMD_SOFT_RESET, CMD_TRANSCEIVE, FIFO_DATA_REG, FIFO_LEVEL_REG,
+    IRQ_IDLE, IRQ_RX, IRQ_TIMER, PICC_CASCADE_TAG, PICC_HLTA, PICC_SELECT, PICC_WUPA, VERSION_REG, crc_a,
+)
+
+IDLE, READY, ACTIVE, HALT = "idle", "ready", "active", "halt"
+PICC_REQA = 0x26
+
+
+class FakeTag:
+
+    def __init__(self, uid: bytes):
+        self.uid = bytes(uid)
+        self.state = IDLE
+        self.level = 0
+
+    def cascade(self, level: int) -> bytes:
+        """UID bytes of a cascade level, with the cascade tag when more levels follow."""
+        if len(self.uid) == 4:
+            part = self.uid
+        elif len(self.uid) == 7:
+            part = bytes((PICC_CASCADE_TAG,)) + self.uid[:3] if level == 0 else self.uid[3:]
+        else:
+            part = bytes((PICC_CASCADE_TAG,)) + self.uid[3 * level:3 * level + 3] if level < 2 else self.uid[6:]
+        return part + bytes((part[0] ^ part[1] ^ part[2] ^ part[3],))
+
+    def levels(self) -> int:
+        return {4: 1, 7: 2, 10: 3}[len(self.uid)]
+
+    def answer(self, frame: bytes):
+        """Response of the tag to a frame, ``None`` when it stays silent."""
+        if frame == bytes((PICC_WUPA,)) and self.state in (IDLE, HALT) or \
+                frame == bytes((PICC_REQA,)) and self.state == IDLE:
+            self.state, self.level = READY, 0
+            return bytes((0x04 if len(self.uid) == 4 else 0x44, 0x00))
+        if self.state == READY and len(frame) == 2 and frame[0] == PICC_SELECT[self.level] and frame[1] == 0x20:
+            return self.cascade(self.level)
+        if self.state == READY and len(frame) == 9 and frame[:2] == bytes((PICC_SELECT[self.level], 0x70)):
+            if frame[2:7] != self.cascade(self.level) or frame[7:] != crc_a(frame[:7]):
+                self.state = IDLE
+                return None
+            self.level += 1
+            last = self.level == self.levels()
+            if last:
+                self.state = ACTIVE
+            sak = bytes((0x08 if last else 0x04,))
+            return sak + crc_a(sak)
+        if self.state == ACTIVE and frame[:2] == bytes((PICC_HLTA, 0)):
+            self.state = HALT
+            return None
+        self.state = IDLE if self.state != HALT else HALT
+        return None
+
+
+class FakeMfrc522:
+    """Registers, FIFO and radio of one reader."""
+
+    def __init__(self, version: int = 0x92):
+        self.version = version
+        self.lock = threading.Lock()
+        self.tag = None
+        self.transceives = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.registers = {VERSION_REG: self.version}
+        self.fifo = bytearray()
+
+    def place(self, uid: bytes) -> FakeTag:
+        with self.lock:
+            self.tag = FakeTag(uid)
+            return self.tag
+
+    def remove(self) -> None:
+        with self.lock:
+            self.tag = None
+
+    def _transmit(self) -> None:
+        frame = bytes(self.fifo)
+        self.fifo.clear()
+        self.transceives += 1
+        answer = self.tag.answer(frame) if self.tag is not None else None
+        if answer is None:
+            self.registers[COM_IRQ_REG] = IRQ_TIMER
+        else:
+            self.fifo.extend(answer)
+            self.registers[COM_IRQ_REG] = IRQ_RX | IRQ_IDLE
+
+    def write(self, reg: int, value: int) -> None:
+        with self.lock:
+            if reg == FIFO_DATA_REG:
+                self.fifo.append(value)
+            elif reg == FIFO_LEVEL_REG:
+                if value & 0x80:
+                    self.fifo.clear()
+            elif reg == COM_IRQ_REG:
+                # bit 7 selects whether the other bits are set or cleared
+                current = self.registers.get(COM_IRQ_REG, 0)
+                self.registers[reg] = current | value & 0x7F if value & 0x80 else current & ~value
+            elif reg == COMMAND_REG and value == CMD_SOFT_RESET:
+                self.reset()
+            else:
+                self.registers[reg] = value
+                if reg == BIT_FRAMING_REG and value & 0x80 and self.registers.get(COMMAND_REG) == CMD_TRANSCEIVE:
+                    self._transmit()
+
+    def read(self, reg: int) -> int:
+        with self.lock:
+            if reg == FIFO_DATA_REG:
+                return self.fifo.pop(0) if self.fifo else 0
+            if reg == FIFO_LEVEL_REG:
+                return len(self.fifo)
+            return self.registers.get(reg, 0)
+
+
+class FakeSpiBus:
+    """SPI transport with a :class:`FakeMfrc522` on each chip select line."""
+
+    def __init__(self, readers=None):
+        # cs pin -> reader
+        self.readers = dict(readers or {})
+        # rst pin -> cs pin
+        self.resets = {}
+        self.opened = False
+
+    def add(self, cs_pin: int, rst_pin: int = None, reader: FakeMfrc522 = None) -> FakeMfrc522:
+        self.readers[cs_pin] = reader or FakeMfrc522()
+        if rst_pin is not None:
+            self.resets[rst_pin] = cs_pin
+        return self.readers[cs_pin]
+
+    def open(self, pins) -> None:
+        self.opened = True
+
+    def transfer(self, cs_pin: int, data: bytes) -> bytes:
+        reader = self.readers.get(cs_pin)
+        if reader is None:
+            # nothing drives MISO
+            return bytes([0xFF] * len(data))
+        address = data[0]
+        reg = address >> 1 & 0x3F
+        if address & 0x80:
+            # every byte carries the next address, the answer is shifted by one byte
+            return bytes([0] + [reader.read(byte >> 1 & 0x3F) for byte in data[:-1]])
+        for value in data[1:]:
+            reader.write(reg, value)
+        return bytes(len(data))
+
+    def reset(self, rst_pin: int) -> None:
+        cs_pin = self.resets.get(rst_pin)
+        if cs_pin in self.readers:
+            self.readers[cs_pin].reset()
+
+    def close(self) -> None:
+        self.opened = False
@@ -0,0 +1,146 @@
+"""
+Line fault detection.  Every sensor keeps the times of its last accepted
+changes and of its last bounces (changes rejected by the debounce) in two
+fixed-size rings, and the time of its last change.  A fault is raised when
+
+* ``chatter``: ``fault_transitions`` changes are accepted within
+  ``fault_window`` seconds, a contact that opens and closes too often
+  (tampering, a magnet that moved);
+* ``bounce``: ``fault_bounces`` bounces happen within ``fault_window``
+  seconds, a failing reed switch or a loose wire;
+* ``stuck``: the line has not changed for ``fault_stuck`` seconds.
+
+The size of a ring is its threshold, so the memory of a sensor is bounded
+whatever the uptime, and a check costs one comparison: the threshold is
+crossed when the oldest time in a full ring is within the window.  A fault
+is cleared when its condition no longer holds.
+"""
+from array import array
+
+from app.models import SensorsConfig
+
+CHATTER = "chatter"
+BOUNCE = "bounce"
+STUCK = "stuck"
+FAULTS = (CHATTER, BOUNCE, STUCK)
+# Seconds between two scans of all the lines (stuck lines, rate faults that ended):
+# a scan walks every sensor, so it is not repeated on every GPIO event
+CHECK_INTERVAL = 1.0
+
+
+class Ring:
+    """The last ``size`` event times."""
+
+    __slots__ = ("times", "next", "count")
+
+    def __init__(self, size: int):
+        self.times = array("d", bytes(8 * size))
+        self.next = 0
+        self.count = 0
+
+    def add(self, now: float) -> None:
+        self.times[self.next] = now
+        self.next = (self.next + 1) % len(self.times)
+        if self.count < len(self.times):
+            self.count += 1
+
+    def full_within(self, now: float, window: float) -> bool:
+        """All the ``size`` events happened in the last ``window`` seconds."""
+        # once the ring is full the next slot holds the oldest time
+        return self.count == len(self.times) and now - self.times[self.next] <= window
+
+
+class LineStats:
+    """Rolling statistics of one sensor and its active faults."""
+
+    __slots__ = ("transitions", "bounces", "since", "faults")
+
+    def __init__(self, transitions: int, bounces: int, now: float):
+        self.transitions = Ring(transitions) if transitions > 0 else None
+        self.bounces = Ring(bounces) if bounces > 0 else None
+        # time of the last accepted change, or of the first read
+        self.since = now
+        self.faults = set()
+
+    def time_in_state(self, now: float) -> float:
+        return now - self.since
+
+
+class FaultDetector:
+    """
+    Statistics of the sensors, fed by :class:`app.services.SensorsService`
+    with the accepted changes and the bounces.  Every method returns the
+    faults that were raised or cleared, as ``(pin, fault, active)``.
+    """
+
+    def __init__(self, config: SensorsConfig):
+        self.window = config.fault_window
+        self.max_transitions = config.fault_transitions
+        self.max_bounces = config.fault_bounces
+        self.stuck = config.fault_stuck
+        # pin -> LineStats
+        self.lines = {}
+        self.raised = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_transitions > 0 or self.max_bounces > 0 or self.stuck > 0
+
+    def line(self, pin: int, now: float) -> LineStats:
+        line = self.lines.get(pin)
+        if line is None:
+            line = self.lines[pin] = LineStats(self.max_transitions, self.max_bounces, now)
+        return line
+
+    def _set(self, pin: int, line: LineStats, fault: str, active: bool, flips: list) -> None:
+        if active == (fault in line.faults):
+            return
+        if active:
+            line.faults.add(fault)
+            self.raised += 1
+        else:
+            line.faults.discard(fault)
+        flips.append((pin, fault, active))
+
+    def changed(self, pin: int, now: float) -> list:
+        """An accepted change of a sensor."""
+        line = self.line(pin, now)
+        line.since = now
+        flips = []
+        if STUCK in line.faults:
+            self._set(pin, line, STUCK, False, flips)
+        if line.transitions is not None:
+            line.transitions.add(now)
+            if line.transitions.full_within(now, self.window):
+                self._set(pin, line, CHATTER, True, flips)
+        return flips
+
+    def bounced(self, pin: int, now: float) -> list:
+        """A change of a sensor rejected by the debounce."""
+        line = self.line(pin, now)
+        flips = []
+        if line.bounces is not None:
+            line.bounces.add(now)
+            if line.bounces.full_within(now, self.window):
+                self._set(pin, line, BOUNCE, True, flips)
+        return flips
+
+    def check(self, pins, now: float) -> list:
+        """Raise the stuck lines among ``pins`` and clear the rate faults that ended."""
+        flips = []
+        for pin in pins:
+            line = self.line(pin, now)
+            if self.stuck > 0 and line.time_in_state(now) >= self.stuck:
+                self._set(pin, line, STUCK, True, flips)
+            if CHATTER in line.faults and not line.transitions.full_within(now, self.window):
+                self._set(pin, line, CHATTER, False, flips)
+            if BOUNCE in line.faults and not line.bounces.full_within(now, self.window):
+                self._set(pin, line, BOUNCE, False, flips)
+        return flips
+
+    def forget(self, pin: int) -> None:
+        self.lines.pop(pin, None)
+
+    @property
+    def active(self) -> int:
+        return sum(len(line.faults) for line in self.lines.values())
@@ -0,0 +1,258 @@
+"""
+Input drivers of :class:`app.services.SensorsService`.  A driver owns the
+lines of one device (a GPIO chip of the board or an I2C expander), reads
+them all at once with :meth:`InputDriver.read` and, when the device can
+signal a change, exposes a file descriptor that becomes readable when the
+lines should be read again.
+
+The expanders are reached through an ``SMBus`` object (``smbus2`` on the
+board, :mod:`app.fake_expander` in memory); a whole port is read in one I2C
+transaction, and the interrupt output of the expander, wired to a line of
+the board, replaces the polling.
+"""
+import logging
+from datetime import timedelta
+
+try:
+    import smbus2
+
+    SMBUS_AVAILABLE = True
+except ImportError:
+    smbus2 = None
+    SMBUS_AVAILABLE = False
+
+from app.models import EXPANDER_WIDTH, ExpanderConfig, ExpanderKind, SensorsConfig
+
+
+def _raw(value) -> int:
+    return value.value if hasattr(value, "value") else value
+
+
+class InputDriver:
+    """Lines of one device, read together."""
+
+    def __init__(self, name: str, pins: list):
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.pins = pins
+        # The device signals the changes on fd, otherwise it must be polled
+        self.edge = False
+        # The device debounces the lines itself
+        self.hardware_debounced = False
+
+    @property
+    def fd(self):
+        """File descriptor readable when the lines changed, ``None`` for a polled device."""
+        return None
+
+    def open(self) -> None:
+        raise NotImplementedError
+
+    def read(self) -> list:
+        """Values of :attr:`pins`, in the same order: 0 closed, 1 open."""
+        raise NotImplementedError
+
+    def events(self) -> dict:
+        """Consume the readiness of :attr:`fd`; returns ``pin -> monotonic time`` of the changes reported."""
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+class GpiodDriver(InputDriver):
+    """Lines of a GPIO chip of the board, requested together through gpiod."""
+
+    def __init__(self, name: str, pins: list, gpiod, config: SensorsConfig):
+        super().__init__(name, pins)
+        self.gpiod = gpiod
+        self.config = config
+        self.request = None
+
+    @property
+    def fd(self):
+        return self.request.fd if self.edge else None
+
+    def _line_settings(self, edge_detection: bool, debounce: float):
+        settings = {
+            "direction": self.gpiod.line.Direction.INPUT,
+            "bias": self.gpiod.line.Bias.PULL_UP,
+        }
+        if edge_detection:
+            settings["edge_detection"] = self.gpiod.line.Edge.BOTH
+        if debounce:
+            settings["debounce_period"] = timedelta(seconds=debounce)
+        return self.gpiod.LineSettings(**settings)
+
+    def _request(self, edge_detection: bool, hardware_debounce: bool):
+        return self.gpiod.request_lines(
+            self.name,
+            consumer="PiAlarmAdapter",
+            config={
+                pin: self._line_settings(
+                    edge_detection, self.config.debounce_for(pin) if hardware_debounce else 0
+                )
+                for pin in self.pins
+            },
+        )
+
+    def _modes(self) -> list:
+        edge, hardware = self.config.edge_detection, self.config.hardware_debounce
+        return list(dict.fromkeys([(edge, hardware), (edge, False), (False, hardware), (False, False)]))
+
+    def open(self) -> None:
+        """
+        Request the lines with the best settings the kernel accepts: edge
+        detection and hardware debounce are dropped, in this order, when
+        the chip rejects them.
+        """
+        for edge_detection, hardware_debounce in self._modes():
+            try:
+                self.request = self._request(edge_detection, hardware_debounce)
+                self.edge, self.hardware_debounced = edge_detection, hardware_debounce
+                return
+            except OSError as e:
+                if not (edge_detection or hardware_debounce):
+                    raise
+                self.logger.warning(
+                    f"Unable to request {self.name} with edge detection={edge_detection}, "
+                    f"hardware debounce={hardware_debounce}: {e}. Falling back."
+                )
+
+    def read(self) -> list:
+        return [_raw(value) for value in self.request.get_values(self.pins)]
+
+    def events(self) -> dict:
+        # the kernel timestamp of the last edge of a line is the time of its change
+        return {event.line_offset: event.timestamp_ns / 1e9 for event in self.request.read_edge_events()}
+
+    def close(self) -> None:
+        if self.request is not None:
+            self.request.release()
+            self.request = None
+
+
+class ExpanderDriver(InputDriver):
+    """
+    I2C port expander.  Sensor ``pin`` is input ``pin - base`` of the
+    expander.  With an interrupt line the expander is read when it pulls
+    the line low; reading the port releases it.
+    """
+
+    WIDTH = 8
+
+    def __init__(self, name: str, pins: list, config: ExpanderConfig, bus, gpiod=None, chip: str = None):
+        super().__init__(name, pins)
+        self.config = config
+        self.bus = bus
+        self.gpiod = gpiod
+        self.chip = chip
+        self.interrupt = None
+        outside = [pin for pin in pins if not 0 <= pin - config.base < self.WIDTH]
+        if outside:
+            raise ValueError(f"Pins {outside} are outside the {self.WIDTH} inputs of expander {name}")
+
+    @property
+    def mask(self) -> int:
+        """Bits of the port used by the sensors."""
+        mask = 0
+        for pin in self.pins:
+            mask |= 1 << (pin - self.config.base)
+        return mask
+
+    @property
+    def fd(self):
+        return self.interrupt.fd if self.interrupt is not None else None
+
+    def setup(self) -> None:
+        """Configure the inputs of the expander."""
+
+    def read_port(self) -> int:
+        """All the inputs of the expander, bit ``n`` for input ``n``, in one I2C transaction."""
+        raise NotImplementedError
+
+    def open(self) -> None:
+        self.setup()
+        if self.config.interrupt is not None:
+            # the interrupt output is open drain and active low
+            self.interrupt = self.gpiod.request_lines(
+                self.chip,
+                consumer=f"PiAlarmAdapter-{self.name}",
+                config={self.config.interrupt: self.gpiod.LineSettings(
+                    direction=self.gpiod.line.Direction.INPUT,
+                    bias=self.gpiod.line.Bias.PULL_UP,
+                    edge_detection=self.gpiod.line.Edge.FALLING,
+                )},
+            )
+            self.edge = True
+
+    def read(self) -> list:
+        port = self.read_port()
+        base = self.config.base
+        return [(port >> (pin - base)) & 1 for pin in self.pins]
+
+    def events(self) -> dict:
+        if self.interrupt is None:
+            return {}
+        events = self.interrupt.read_edge_events()
+        if not events:
+            return {}
+        changed = events[-1].timestamp_ns / 1e9
+        return {pin: changed for pin in self.pins}
+
+    def close(self) -> None:
+        if self.interrupt is not None:
+            self.interrupt.release()
+            self.interrupt = None
+
+
+class Mcp23017Driver(ExpanderDriver):
+    """Microchip MCP23017, 16 inputs in two 8 bit ports read together."""
+
+    WIDTH = EXPANDER_WIDTH[ExpanderKind.MCP23017]
+    # Registers with IOCON.BANK = 0: port A at the even address, port B at the next one
+    IODIR = 0x00
+    GPINTEN = 0x04
+    INTCON = 0x08
+    IOCON = 0x0A
+    GPPU = 0x0C
+    GPIO = 0x12
+    # IOCON: INTA and INTB mirrored on both pins, open drain interrupt output
+    IOCON_MIRROR = 0x40
+    IOCON_ODR = 0x04
+
+    def setup(self) -> None:
+        address, mask = self.config.address, self.mask
+        self.bus.write_byte_data(address, self.IOCON, self.IOCON_MIRROR | self.IOCON_ODR)
+        for register, value in (
+            (self.IODIR, 0xFFFF),  # all inputs
+            (self.GPPU, 0xFFFF),  # pull-ups
+            (self.INTCON, 0x0000),  # interrupt on any change
+            (self.GPINTEN, mask if self.config.interrupt is not None else 0),
+        ):
+            self.bus.write_byte_data(address, register, value & 0xFF)
+            self.bus.write_byte_data(address, register + 1, value >> 8)
+
+    def read_port(self) -> int:
+        # sequential read of GPIOA and GPIOB, which also clears the interrupt
+        port_a, port_b = self.bus.read_i2c_block_data(self.config.address, self.GPIO, 2)
+        return port_a | port_b << 8
+
+
+class Pcf8574Driver(ExpanderDriver):
+    """NXP PCF8574, 8 quasi-bidirectional inputs; its interrupt fires on any change."""
+
+    WIDTH = EXPANDER_WIDTH[ExpanderKind.PCF8574]
+
+    def setup(self) -> None:
+        # a high output is an input with a weak pull-up
+        self.bus.write_byte(self.config.address, 0xFF)
+
+    def read_port(self) -> int:
+        return self.bus.read_byte(self.config.address)
+
+
+EXPANDERS = {
+    ExpanderKind.MCP23017: Mcp23017Driver,
+    ExpanderKind.PCF8574: Pcf8574Driver,
+}
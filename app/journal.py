@@ -0,0 +1,272 @@
+"""
+Append-only binary journal of the sensor state changes and of what
+happened to their messages.  A change is written when it is queued; every
+later outcome (handed to the MQTT client, acknowledged, spooled, dropped,
+failed) is appended as another record with the same sequence number, so a
+record is never rewritten.  Records have a fixed size, so a file is read
+with one ``struct.iter_unpack`` over an mmap.
+
+The active file is ``journal.bin``; when it reaches ``max_bytes`` it is
+renamed ``journal-<number>.bin`` and only the newest ``files`` rotated
+files are kept.  Numbers rather than times name the files because the
+clock of a board without RTC can jump at boot.
+
+The sequence numbers start again from 1 at every start of the adapter, so
+each start appends a ``boot`` record first: a change is identified by its
+sequence number and pin within the records after the same ``boot``.
+
+``python -m app.journal`` (or ``pi_alarm_journal``) lists the changes,
+filtered by sensor and time range.
+"""
+import glob
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from app.config import get_config_path
+
+MAGIC = b"PIAJ"
+VERSION = 1
+# magic, version, record size
+FILE_HEADER = struct.Struct("<4sHH")
+# monotonic ns, wall ns, sequence number, pin, state, outcome
+RECORD = struct.Struct("<qqIHBB")
+ACTIVE_NAME = "journal.bin"
+
+QUEUED, PUBLISHED, ACKED, SPOOLED, DROPPED, FAILED, BOOT = range(7)
+OUTCOMES = ("queued", "published", "acked", "spooled", "dropped", "failed", "boot")
+# Outcomes after which nothing else happens to a message
+FINAL = {ACKED, DROPPED, FAILED}
+STATES = ("closed", "open")
+# Messages still waiting for a final outcome; the oldest are forgotten beyond this
+MAX_PENDING = 10000
+
+
+def default_path() -> str:
+    return str(get_config_path().parent / "journal")
+
+
+class Journal:
+    """Writer of the journal, shared by the sensor and the publisher threads."""
+
+    def __init__(self, path, max_bytes: int = 4 * 1024 * 1024, files: int = 24):
+        self.path = path
+        self.max_bytes = max(max_bytes, FILE_HEADER.size + RECORD.size)
+        self.files = files
+        self.lock = threading.Lock()
+        # seq -> (pin, state) of the messages without a final outcome
+        self.pending = {}
+        self.records = 0
+        os.makedirs(path, exist_ok=True)
+        self.file = None
+        self.size = 0
+        first = not rotated_files(path) and not os.path.exists(os.path.join(path, ACTIVE_NAME))
+        self._open()
+        if not first:
+            # the sequence numbers of this start may repeat those already journaled
+            self._write(time.monotonic_ns(), time.time_ns(), 0, 0, 0, BOOT)
+
+    def _open(self) -> None:
+        active = os.path.join(self.path, ACTIVE_NAME)
+        size = os.path.getsize(active) if os.path.exists(active) else 0
+        if size < FILE_HEADER.size:
+            with open(active, "wb") as f:
+                f.write(FILE_HEADER.pack(MAGIC, VERSION, RECORD.size))
+            size = FILE_HEADER.size
+        # a record cut by a power loss is dropped
+        whole = size - (size - FILE_HEADER.size) % RECORD.size
+        if whole != size:
+            os.truncate(active, whole)
+        self.file = open(active, "ab")
+        self.size = whole
+
+    def _rotate(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        rotated = rotated_files(self.path)
+        number = int(re.search(r"(\d+)\.bin$", rotated[-1]).group(1)) + 1 if rotated else 1
+        os.replace(os.path.join(self.path, ACTIVE_NAME), os.path.join(self.path, f"journal-{number:08d}.bin"))
+        for old in rotated_files(self.path)[:-self.files or None]:
+            os.remove(old)
+        self._open()
+
+    def _write(self, monotonic_ns: int, wall_ns: int, seq: int, pin: int, state: int, outcome: int) -> None:
+        if self.file is None:
+            # closed, acknowledgements can still arrive while disconnecting
+            return
+        if self.size + RECORD.size > self.max_bytes:
+            self._rotate()
+        self.file.write(RECORD.pack(monotonic_ns, wall_ns, seq, pin, state, outcome))
+        self.size += RECORD.size
+        self.records += 1
+
+    def changed(self, message, state: int) -> None:
+        """Record a state change queued as ``message``, at the time it was detected."""
+        now = time.monotonic_ns()
+        detected = int(message.timestamp * 1e9) if message.timestamp is not None else now
+        with self.lock:
+            if len(self.pending) >= MAX_PENDING:
+                del self.pending[next(iter(self.pending))]
+            self.pending[message.seq] = (message.pin, state)
+            self._write(detected, time.time_ns() - (now - detected), message.seq, message.pin, state, QUEUED)
+
+    def outcome(self, message, outcome: int) -> None:
+        """Record what happened to a message; messages that are not state changes are ignored."""
+        with self.lock:
+            entry = self.pending.pop(message.seq, None) if outcome in FINAL else self.pending.get(message.seq)
+            if entry is not None:
+                self._write(time.monotonic_ns(), time.time_ns(), message.seq, entry[0], entry[1], outcome)
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+
+def rotated_files(path) -> list:
+    """The rotated files, oldest first."""
+    return sorted(glob.glob(os.path.join(path, "journal-*.bin")))
+
+
+def read_records(file_path: str, since_ns: int = None, until_ns: int = None):
+    """
+    Yield the records of a file as tuples in the :data:`RECORD` layout.
+    Files written entirely before ``since_ns`` (by their modification time)
+    or whose first record is after ``until_ns`` are skipped without being
+    read.
+    """
+    if since_ns is not None and os.stat(file_path).st_mtime_ns < since_ns:
+        return
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < FILE_HEADER.size + RECORD.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, record_size = FILE_HEADER.unpack_from(data)
+            if magic != MAGIC or record_size != RECORD.size:
+                raise ValueError(f"{file_path} is not a journal file")
+            if until_ns is not None and RECORD.unpack_from(data, FILE_HEADER.size)[1] > until_ns:
+                return
+            end = size - (size - FILE_HEADER.size) % RECORD.size
+            view = memoryview(data)[FILE_HEADER.size:end]
+            try:
+                yield from RECORD.iter_unpack(view)
+            finally:
+                view.release()
+
+
+def query(path, pins=None, since_ns: int = None, until_ns: int = None, raw: bool = False):
+    """
+    Yield the records of the journal, oldest file first, for the given pins
+    and wall time range.  Unless ``raw`` is set a change is yielded once,
+    with the last outcome recorded for it: the changes still waiting for
+    one at the end of a file are matched with the outcomes of the next
+    files.  The ``boot`` records are not yielded.
+    """
+    files = rotated_files(path) + [os.path.join(path, ACTIVE_NAME)]
+    # (boot, seq, pin) -> record, in the order of the changes
+    changes = {}
+    boot = 0
+    for file_path in files:
+        if not os.path.exists(file_path):
+            continue
+        for record in read_records(file_path, since_ns, until_ns):
+            monotonic_ns, wall_ns, seq, pin, state, outcome = record
+            if outcome == BOOT:
+                boot += 1
+                continue
+            if pins is not None and pin not in pins:
+                continue
+            if raw:
+                if (since_ns is None or wall_ns >= since_ns) and (until_ns is None or wall_ns <= until_ns):
+                    yield record
+            elif outcome == QUEUED:
+                if (since_ns is None or wall_ns >= since_ns) and (until_ns is None or wall_ns <= until_ns):
+                    changes[boot, seq, pin] = list(record)
+            elif (boot, seq, pin) in changes:
+                changes[boot, seq, pin][5] = outcome
+        # the oldest changes are yielded once nothing can happen to them any more
+        while changes:
+            key = next(iter(changes))
+            if changes[key][5] not in FINAL and key[0] == boot and len(changes) <= MAX_PENDING:
+                break
+            yield tuple(changes.pop(key))
+    yield from (tuple(change) for change in changes.values())
+
+
+def _parse_time(value: str) -> int:
+    """Wall time in ns from an ISO date/time or a duration before now, such as ``90m``, ``12h`` or ``7d``."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", value)
+    if match:
+        unit = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}[match.group(2)]
+        moment = datetime.now() - timedelta(**{unit: float(match.group(1))})
+    else:
+        moment = datetime.fromisoformat(value)
+    return int(moment.timestamp() * 1e9)
+
+
+def _sensor_pins(sensors) -> set:
+    """Pins of the sensors given by pin or by their name in ``config.ini``."""
+    import configparser
+
+    parser = configparser.ConfigParser()
+    parser.read(get_config_path())
+    names = dict(parser["sensors"]) if parser.has_section("sensors") else {}
+    pins = set()
+    for sensor in sensors:
+        if sensor.isdigit():
+            pins.add(int(sensor))
+        elif sensor in names:
+            pins.add(int(names[sensor].partition(",")[0]))
+        else:
+            raise SystemExit(f"Unknown sensor {sensor}")
+    return pins
+
+
+def main(argv=None) -> None:
+    # only the command line needs these
+    import argparse
+    import csv
+
+    parser = argparse.ArgumentParser(
+        prog="pi_alarm_journal", description="List the sensor state changes recorded in the journal."
+    )
+    parser.add_argument("--path", default=default_path(), help="journal directory")
+    parser.add_argument("-s", "--sensor", action="append", help="sensor name or pin, can be repeated")
+    parser.add_argument("--since", type=_parse_time, help="ISO time or duration before now (30m, 12h, 7d)")
+    parser.add_argument("--until", type=_parse_time, help="ISO time or duration before now")
+    parser.add_argument("--raw", action="store_true", help="one line per record instead of one per change")
+    parser.add_argument("--csv", action="store_true", help="CSV output")
+    args = parser.parse_args(argv)
+
+    pins = _sensor_pins(args.sensor) if args.sensor else None
+    writer = csv.writer(sys.stdout) if args.csv else None
+    if writer is not None:
+        writer.writerow(("time", "monotonic", "seq", "pin", "state", "outcome"))
+    for monotonic_ns, wall_ns, seq, pin, state, outcome in query(args.path, pins, args.since, args.until, args.raw):
+        row = (
+            datetime.fromtimestamp(wall_ns / 1e9).isoformat(timespec="milliseconds"),
+            f"{monotonic_ns / 1e9:.6f}", seq, pin, STATES[state], OUTCOMES[outcome],
+        )
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            print("{} {:>14} {:>8} GPIO{:<3} {:<6} {}".format(*row))
+
+
+if __name__ == "__main__":
+    main()
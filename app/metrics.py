@@ -0,0 +1,283 @@
+import logging
+import math
+import os
+import threading
+import time
+
+from app.startup import timer
+
+# Buckets per power of two: the error of a percentile is below 10%
+BUCKETS_PER_OCTAVE = 8
+# 1 us .. ~1 h
+OCTAVES = 32
+METRIC_PREFIX = "pialarm_"
+
+
+class Histogram:
+    """
+    Fixed-size histogram of durations in seconds with logarithmic buckets,
+    so recording is O(1) and memory does not grow with the number of samples.
+    """
+
+    __slots__ = ("counts", "count", "total", "max", "lock")
+
+    def __init__(self):
+        self.counts = [0] * (BUCKETS_PER_OCTAVE * OCTAVES + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _bucket(seconds: float) -> int:
+        micros = seconds * 1e6
+        if micros <= 1:
+            return 0
+        return min(int(math.log2(micros) * BUCKETS_PER_OCTAVE) + 1, BUCKETS_PER_OCTAVE * OCTAVES)
+
+    @staticmethod
+    def _upper_bound(bucket: int) -> float:
+        return 2 ** (bucket / BUCKETS_PER_OCTAVE) / 1e6
+
+    def record(self, seconds: float) -> None:
+        seconds = max(seconds, 0.0)
+        with self.lock:
+            self.counts[self._bucket(seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, percent: float) -> float:
+        with self.lock:
+            if not self.count:
+                return 0.0
+            rank = math.ceil(self.count * percent / 100)
+            seen = 0
+            for bucket, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return min(self._upper_bound(bucket), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class LatencyStats:
+    """
+    Latency of the state changes of every sensor, measured from the
+    detection of the change to each stage of its way to the broker:
+    ``enqueue`` (MqttService queue), ``publish`` (handed to paho) and
+    ``ack`` (PUBACK/PUBCOMP received, or written to the socket for QoS 0).
+    """
+
+    STAGES = ("enqueue", "publish", "ack")
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def _histogram(self, pin: int, stage: str) -> Histogram:
+        key = (pin, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def record(self, pin, stage: str, detected_at, now: float) -> None:
+        if pin is None or detected_at is None:
+            return
+        self._histogram(pin, stage).record(now - detected_at)
+
+    def report(self) -> dict:
+        report = {}
+        for (pin, stage), histogram in sorted(self.histograms.items()):
+            report.setdefault(pin, {})[stage] = histogram.summary()
+        return report
+
+
+def process_rss() -> int:
+    """Resident set size of the process in bytes, 0 where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class MetricsExporter:
+    """
+    Exposes the counters of the adapter in the Prometheus text format,
+    served over HTTP on ``port`` and/or written every ``interval`` seconds
+    to ``textfile`` for the node_exporter textfile collector.  Values are
+    read from the services when a scrape happens, so the hot paths only
+    pay for incrementing plain integers.
+    """
+
+    def __init__(self, config, mqtt_service, sensors_service):
+        self.logger = logging.getLogger(__name__)
+        self.config = config
+        self.mqtt_service = mqtt_service
+        self.sensors_service = sensors_service
+        self.server = None
+        self.threads = []
+        self.stop_event = threading.Event()
+
+    def _samples(self):
+        sensors = self.sensors_service
+        stats = self.mqtt_service.stats()
+        yield "poll_iterations_total", "counter", "Sensor sampling iterations", sensors.iterations
+        yield "poll_duration_seconds_total", "counter", "Time spent sampling the sensors", sensors.iteration_seconds
+        yield "gpio_reads_total", "counter", "Reads of the GPIO lines", sensors.reads
+        yield "gpio_read_seconds_total", "counter", "Time spent reading the GPIO lines", sensors.read_seconds
+        yield "debounce_rejections_total", "counter", "Changes rejected by the debounce", sensors.debounce_rejections
+        yield "sensor_faults_total", "counter", "Line faults raised", sensors.faults.raised
+        yield "sensor_faults_active", "gauge", "Line faults not cleared yet", sensors.faults.active
+        yield "messages_enqueued_total", "counter", "Messages queued for publishing", stats["enqueued"]
+        yield "messages_published_total", "counter", "Messages handed to the MQTT client", stats["published"]
+        yield "messages_acked_total", "counter", "Messages acknowledged by the broker", stats["acknowledged"]
+        yield "messages_dropped_total", "counter", "Messages dropped by a full queue", stats["dropped"]
+        yield "messages_coalesced_total", "counter", "Messages replaced by a newer state", stats["coalesced"]
+        yield "messages_failed_total", "counter", "Messages the MQTT client refused", stats["failed"]
+        yield "messages_spooled_total", "counter", "Messages spooled while offline", stats["spooled"]
+        yield "queue_depth", "gauge", "Messages waiting in the outbound queue", stats["depth"]
+        yield "spool_depth", "gauge", "Messages waiting in the spool", stats["spool_depth"]
+        reconnects = self.mqtt_service.mqtt_client.reconnects
+        yield "mqtt_reconnects_total", "counter", "Reconnections to the broker", reconnects
+        yield "process_resident_memory_bytes", "gauge", "Resident memory of the process", process_rss()
+        yield "process_cpu_seconds_total", "counter", "CPU time of the process", time.process_time()
+
+    def render(self) -> str:
+        lines = []
+        for name, kind, help_text, value in self._samples():
+            lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+            lines.append(f"{METRIC_PREFIX}{name} {value}")
+        name = f"{METRIC_PREFIX}state_change_latency_seconds"
+        lines.append(f"# HELP {name} Latency from the detection of a change to each stage of its publishing")
+        lines.append(f"# TYPE {name} summary")
+        for pin, stages in self.mqtt_service.latency.report().items():
+            for stage, summary in stages.items():
+                labels = f'pin="{pin}",stage="{stage}"'
+                lines.append(f'{name}{{{labels},quantile="0.5"}} {summary["p50"]}')
+                lines.append(f'{name}{{{labels},quantile="0.99"}} {summary["p99"]}')
+                lines.append(f"{name}_count{{{labels}}} {summary['count']}")
+        for name, help_text, label, values in (
+            ("startup_phase_seconds", "Duration of the startup phases", "phase", timer.phases),
+            ("startup_milestone_seconds", "Seconds from the process start to a startup milestone", "milestone",
+             timer.milestones),
+        ):
+            lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} gauge")
+            for key, seconds in values.items():
+                lines.append(f'{METRIC_PREFIX}{name}{{{label}="{key}"}} {seconds}')
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self) -> None:
+        # Written aside and renamed, so the collector never reads half a file
+        tmp_path = f"{self.config.textfile}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.config.textfile)
+
+    def _textfile_loop(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                self.write_textfile()
+            except OSError as e:
+                self.logger.warning("Cannot write the metrics to %s: %s", self.config.textfile, e)
+            self.stop_event.wait(self.config.interval)
+
+    def _handler(self):
+        from http.server import BaseHTTPRequestHandler
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                exporter.logger.debug("Metrics: " + format, *args)
+
+        return Handler
+
+    async def _handle_http(self, reader, writer) -> None:
+        try:
+            request = (await reader.readline()).split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if len(request) >= 2 and request[0] == b"GET" and request[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run_async(self) -> None:
+        """Serve the endpoint and write the textfile on the asyncio runtime instead of threads."""
+        import asyncio
+
+        server = None
+        if self.config.port > 0:
+            server = await asyncio.start_server(self._handle_http, self.config.address, self.config.port)
+            self.logger.info("Metrics available on http://%s:%d/metrics", self.config.address, self.config.port)
+        try:
+            while self.config.textfile:
+                try:
+                    self.write_textfile()
+                except OSError as e:
+                    self.logger.warning("Cannot write the metrics to %s: %s", self.config.textfile, e)
+                await asyncio.sleep(self.config.interval)
+            await asyncio.Event().wait()
+        finally:
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+
+    def _start_thread(self, target) -> None:
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def start(self) -> None:
+        if self.config.port > 0:
+            from http.server import ThreadingHTTPServer
+
+            self.server = ThreadingHTTPServer((self.config.address, self.config.port), self._handler())
+            self.server.daemon_threads = True
+            self._start_thread(self.server.serve_forever)
+            self.logger.info("Metrics available on http://%s:%d/metrics", self.config.address, self.config.port)
+        if self.config.textfile:
+            self._start_thread(self._textfile_loop)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
@@ -0,0 +1,235 @@
+"""
+Driver of the NXP MFRC522 13.56 MHz reader (ISO 14443A tags) over SPI.
+
+The SPI bus is reached through a transport with ``transfer(cs_pin, data)``
+and ``reset(rst_pin)``, so several readers with their own chip select line
+can share one bus: :class:`SpidevTransport` on the board, or
+:class:`app.fake_mfrc522.FakeSpiBus` in memory.
+"""
+import logging
+import time
+
+try:
+    import spidev
+
+    SPIDEV_AVAILABLE = True
+except ImportError:
+    SPIDEV_AVAILABLE = False
+
+try:
+    import gpiod
+except ImportError:
+    gpiod = None
+
+# Registers
+COMMAND_REG = 0x01
+COM_IRQ_REG = 0x04
+ERROR_REG = 0x06
+FIFO_DATA_REG = 0x09
+FIFO_LEVEL_REG = 0x0A
+CONTROL_REG = 0x0C
+BIT_FRAMING_REG = 0x0D
+COLL_REG = 0x0E
+MODE_REG = 0x11
+TX_CONTROL_REG = 0x14
+TX_ASK_REG = 0x15
+T_MODE_REG = 0x2A
+T_PRESCALER_REG = 0x2B
+T_RELOAD_REG_H = 0x2C
+T_RELOAD_REG_L = 0x2D
+VERSION_REG = 0x37
+
+# Commands
+CMD_IDLE = 0x00
+CMD_TRANSCEIVE = 0x0C
+CMD_SOFT_RESET = 0x0F
+
+# ComIrqReg bits
+IRQ_RX = 0x20
+IRQ_IDLE = 0x10
+IRQ_TIMER = 0x01
+# ErrorReg bits that invalidate a frame: buffer overflow, parity, protocol
+FRAME_ERRORS = 0x13
+
+# ISO 14443A
+PICC_WUPA = 0x52
+PICC_HLTA = 0x50
+PICC_SELECT = (0x93, 0x95, 0x97)
+PICC_CASCADE_TAG = 0x88
+
+# Timeout of the reader timer (0.5 ms ticks), well above the tag response time
+TIMER_TICKS = 10
+# Software guard when the reader stops answering
+TRANSCEIVE_TIMEOUT = 0.03
+
+
+class RfidError(Exception):
+    pass
+
+
+def crc_a(data: bytes) -> bytes:
+    """CRC_A of ISO 14443-3, appended to SELECT and HLTA frames."""
+    crc = 0x6363
+    for byte in data:
+        byte ^= crc & 0xFF
+        byte = (byte ^ (byte << 4)) & 0xFF
+        crc = (crc >> 8) ^ (byte << 8) ^ (byte << 3) ^ (byte >> 4)
+    return bytes((crc & 0xFF, crc >> 8 & 0xFF))
+
+
+class MFRC522:
+    """
+    One reader on a shared SPI transport.  A poll is split in
+    :meth:`start_wake` and :meth:`poll_transceive`, so the radio timeouts
+    of all the readers of a bus run at the same time; only a reader that
+    got an answer goes on with the (short) anticollision and select.
+    """
+
+    def __init__(self, transport, cs_pin: int, rst_pin: int):
+        self.transport = transport
+        self.cs_pin = cs_pin
+        self.rst_pin = rst_pin
+
+    def _write(self, reg: int, *values: int) -> None:
+        self.transport.transfer(self.cs_pin, bytes(((reg << 1) & 0x7E, *values)))
+
+    def _read(self, reg: int, count: int = 1) -> bytes:
+        address = ((reg << 1) & 0x7E) | 0x80
+        return self.transport.transfer(self.cs_pin, bytes([address] * count + [0]))[1:]
+
+    def _read_byte(self, reg: int) -> int:
+        return self._read(reg)[0]
+
+    def _set_bits(self, reg: int, mask: int) -> None:
+        self._write(reg, self._read_byte(reg) | mask)
+
+    def _clear_bits(self, reg: int, mask: int) -> None:
+        self._write(reg, self._read_byte(reg) & ~mask & 0xFF)
+
+    def init(self) -> int:
+        """Reset and configure the reader, switch the antenna on and return its version (0x91/0x92)."""
+        self.transport.reset(self.rst_pin)
+        self._write(COMMAND_REG, CMD_SOFT_RESET)
+        time.sleep(0.05)
+        self._write(T_MODE_REG, 0x8D)
+        self._write(T_PRESCALER_REG, 0x3E)
+        self._write(T_RELOAD_REG_H, 0)
+        self._write(T_RELOAD_REG_L, TIMER_TICKS)
+        self._write(TX_ASK_REG, 0x40)
+        self._write(MODE_REG, 0x3D)
+        self._set_bits(TX_CONTROL_REG, 0x03)
+        return self._read_byte(VERSION_REG)
+
+    def start_transceive(self, data: bytes, tx_last_bits: int = 0) -> None:
+        self._write(COMMAND_REG, CMD_IDLE)
+        self._write(COM_IRQ_REG, 0x7F)
+        self._write(FIFO_LEVEL_REG, 0x80)
+        self._write(FIFO_DATA_REG, *data)
+        self._write(COMMAND_REG, CMD_TRANSCEIVE)
+        self._write(BIT_FRAMING_REG, 0x80 | tx_last_bits)
+
+    def poll_transceive(self):
+        """
+        ``None`` while the reader is still waiting for the tag, then the
+        received bytes (empty when no tag answered).
+        """
+        irq = self._read_byte(COM_IRQ_REG)
+        if not irq & (IRQ_RX | IRQ_IDLE | IRQ_TIMER):
+            return None
+        self._clear_bits(BIT_FRAMING_REG, 0x80)
+        if irq & IRQ_TIMER and not irq & IRQ_RX:
+            return b""
+        if self._read_byte(ERROR_REG) & FRAME_ERRORS:
+            raise RfidError(f"frame error on the reader with CS {self.cs_pin}")
+        level = self._read_byte(FIFO_LEVEL_REG)
+        return self._read(FIFO_DATA_REG, level) if level else b""
+
+    def transceive(self, data: bytes, tx_last_bits: int = 0) -> bytes:
+        self.start_transceive(data, tx_last_bits)
+        deadline = time.monotonic() + TRANSCEIVE_TIMEOUT
+        while (response := self.poll_transceive()) is None:
+            if time.monotonic() > deadline:
+                raise RfidError(f"the reader with CS {self.cs_pin} does not answer")
+        return response
+
+    def start_wake(self) -> None:
+        """Send WUPA (7 bits), which wakes idle and halted tags alike."""
+        self.start_transceive(bytes((PICC_WUPA,)), tx_last_bits=7)
+
+    def select(self):
+        """Run anticollision and select on every cascade level and return the UID, ``None`` if it fails."""
+        self._clear_bits(COLL_REG, 0x80)
+        uid = b""
+        for cascade in PICC_SELECT:
+            answer = self.transceive(bytes((cascade, 0x20)))
+            if len(answer) != 5 or answer[0] ^ answer[1] ^ answer[2] ^ answer[3] != answer[4]:
+                return None
+            frame = bytes((cascade, 0x70)) + answer
+            sak = self.transceive(frame + crc_a(frame))
+            if len(sak) != 3:
+                return None
+            if answer[0] != PICC_CASCADE_TAG:
+                return uid + answer[:4]
+            uid += answer[1:4]
+        return None
+
+    def halt(self) -> None:
+        """Put the tag in HALT; it answers no more until the next WUPA."""
+        frame = bytes((PICC_HLTA, 0))
+        self.transceive(frame + crc_a(frame))
+
+
+class SpidevTransport:
+    """
+    SPI bus of the board through spidev.  Chip select and reset are plain
+    GPIO lines driven with gpiod, so any number of readers can share the bus.
+    """
+
+    def __init__(self, bus: int = 0, device: int = 0, speed_hz: int = 1000000, chip: str = "/dev/gpiochip0"):
+        self.logger = logging.getLogger(__name__)
+        self.bus = bus
+        self.device = device
+        self.speed_hz = speed_hz
+        self.chip = chip
+        self.spi = None
+        self.lines = None
+
+    def open(self, pins) -> None:
+        self.spi = spidev.SpiDev()
+        self.spi.open(self.bus, self.device)
+        self.spi.max_speed_hz = self.speed_hz
+        self.spi.mode = 0
+        try:
+            self.spi.no_cs = True
+        except OSError:
+            self.logger.warning("The SPI driver keeps its own chip select active")
+        self.lines = gpiod.request_lines(
+            self.chip,
+            consumer="PiAlarmAdapter-rfid",
+            config={
+                tuple(pins): gpiod.LineSettings(
+                    direction=gpiod.line.Direction.OUTPUT, output_value=gpiod.line.Value.ACTIVE
+                )
+            },
+        )
+
+    def transfer(self, cs_pin: int, data: bytes) -> bytes:
+        self.lines.set_value(cs_pin, gpiod.line.Value.INACTIVE)
+        try:
+            return bytes(self.spi.xfer2(list(data)))
+        finally:
+            self.lines.set_value(cs_pin, gpiod.line.Value.ACTIVE)
+
+    def reset(self, rst_pin: int) -> None:
+        self.lines.set_value(rst_pin, gpiod.line.Value.INACTIVE)
+        time.sleep(0.001)
+        self.lines.set_value(rst_pin, gpiod.line.Value.ACTIVE)
+        time.sleep(0.05)
+
+    def close(self) -> None:
+        if self.lines is not None:
+            self.lines.release()
+            self.lines = None
+        if self.spi is not None:
+            self.spi.close()
+            self.spi = None
@@ -1,20 +1,22 @@
 import os
-from typing import Dict
+import socket
+from enum import Enum
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, ValidationInfo, field_validator
+
+from app.topics import check_template
 
 
 class MessageModel:
-    status: str
-    pin: int
-    name: str
-    qos: int
+    __slots__ = ("status", "pin", "name", "qos", "timestamp")
 
-    def __init__(self, status, pin, name, qos=0):
+    def __init__(self, status, pin, name, qos=0, timestamp=None):
         self.status = status
         self.pin = pin
         self.name = name
         self.qos = qos
+        self.timestamp = timestamp
 
     def to_dict(self):
         return {
@@ -25,21 +27,233 @@ class MessageModel:
         }
 
 
+class MqttProtocol(str, Enum):
+    V311 = "3.1.1"
+    V5 = "5"
+
+
+class PayloadFormat(str, Enum):
+    PLAIN = "plain"
+    JSON = "json"
+    BINARY = "binary"
+
+
+class OverflowPolicy(str, Enum):
+    BLOCK = "block"
+    DROP_OLDEST = "drop-oldest"
+    COALESCE = "coalesce"
+
+
+class ExpanderKind(str, Enum):
+    MCP23017 = "mcp23017"
+    PCF8574 = "pcf8574"
+
+
+class SimulatorMode(str, Enum):
+    PERIODIC = "periodic"
+    RANDOM = "random"
+    POISSON = "poisson"
+    TRACE = "trace"
+
+
 class MqttConfig(BaseModel):
     address: str = Field("localhost", description="Address of MQTT Broker")
     port: int = Field(1883, description="MQTT Broker port")
     username: str
     password: str
+    protocol: MqttProtocol = Field(MqttProtocol.V311, description="MQTT protocol version")
+    client_id: str = Field(default_factory=lambda: f"PiAlarmAdapter-{socket.gethostname()}")
+    clean_session: bool = Field(False, description="Start a new session at every connection")
+    session_expiry: int = Field(86400, description="Seconds the broker keeps the session (MQTT 5)")
+    topic_aliases: bool = Field(True, description="Use topic aliases when the broker allows them (MQTT 5)")
+    message_expiry: int = Field(0, description="Seconds after which the broker discards a message, 0 never (MQTT 5)")
+    user_properties: bool = Field(True, description="Send pin, timestamp and sequence as user properties (MQTT 5)")
+    payload_format: PayloadFormat = Field(PayloadFormat.PLAIN, description="Format of the state payload")
+    topic_prefix: str = Field("alarm/", description="Prefix of every topic, {device} is the device_id")
+    topic_template: str = Field("{name}/status", description="Topic of a sensor state after the prefix")
+    device_id: str = Field(default_factory=socket.gethostname, description="Identifier of the adapter in the topics")
+    topics: Dict[str, List[str]] = Field(default_factory=dict, description="Topic templates of sensors and groups")
+    groups: Dict[str, List[str]] = Field(default_factory=dict, description="Sensors of each group, by name")
+    zone_template: str = Field("zone/{name}/status", description="Topic of a zone state after the prefix")
+    status_topic: str = Field("status", description="Retained online/offline topic after the prefix, empty disables it")
+    digest_topic: str = Field("digest", description="Topic of the periodic digest of all the states after the prefix")
+    digest_interval: float = Field(60.0, description="Seconds between two digests, 0 disables them")
+    keepalive: int = Field(120, description="Seconds between two pings to the broker")
+    reconnect_min_delay: float = Field(1.0, description="First delay before a reconnection attempt")
+    reconnect_max_delay: float = Field(120.0, description="Maximum delay between two reconnection attempts")
+    spool_path: str = Field("", description="File storing the messages sent while offline")
+    spool_size: int = Field(10000, description="Maximum number of messages kept in the spool, 0 disables it")
+    journal_path: str = Field("", description="Directory of the journal of the state changes")
+    journal_size: int = Field(1048576, description="Bytes of a journal file before it is rotated, 0 disables it")
+    journal_files: int = Field(60, description="Rotated journal files kept")
+    retain: bool = Field(False, description="Publish the sensor states as retained messages")
+    publish_snapshot: bool = Field(False, description="Publish the state of every sensor at startup")
+    queue_size: int = Field(1000, description="Maximum number of messages waiting to be published")
+    overflow_policy: OverflowPolicy = Field(OverflowPolicy.BLOCK, description="What to do when the queue is full")
+    batch_size: int = Field(50, description="Maximum number of messages taken from the queue at once")
+    coalesce: bool = Field(False, description="Keep only the latest queued message of each topic")
+    coalesce_window: float = Field(0.0, description="Seconds a topic must be quiet before its message is sent")
+    coalesce_max_latency: float = Field(1.0, description="Maximum seconds a message is held by the window")
+
+    @field_validator("topics", "groups", mode="before")
+    def parse_lists(cls, value: dict, info: ValidationInfo):
+        # written in config.ini as comma separated lists; the groups list sensor
+        # names, which configparser lowercases, the topics list templates
+        normalize = str.lower if info.field_name == "groups" else str
+        return {
+            name: [normalize(item.strip()) for item in items.split(",") if item.strip()]
+            if isinstance(items, str) else items
+            for name, items in value.items()
+        }
+
+    @field_validator("topic_prefix", "topic_template", "zone_template", "status_topic", "digest_topic")
+    def check_template(cls, value: str):
+        return check_template(value)
+
+    @field_validator("topics")
+    def check_templates(cls, value: dict):
+        for templates in value.values():
+            for template in templates:
+                check_template(template)
+        return value
+
+
+EXPANDER_WIDTH = {ExpanderKind.MCP23017: 16, ExpanderKind.PCF8574: 8}
+
+
+class ExpanderConfig(BaseModel):
+    kind: ExpanderKind
+    bus: int = Field(1, description="I2C bus number")
+    address: int = Field(description="I2C address")
+    base: int = Field(description="Pin number of the sensor on the first input of the expander")
+    interrupt: Optional[int] = Field(None, description="Line of the default chip wired to the interrupt output")
+
+
+class ZoneConfig(BaseModel):
+    members: List[str] = Field(description="Names of the sensors of the zone")
+    rule: str = Field("any", description="Open members that make the zone open: any, all or a number")
+
+    @field_validator("rule")
+    def check_rule(cls, value: str):
+        value = value.strip().lower()
+        if value not in ("any", "all") and not (value.isdigit() and int(value) > 0):
+            raise ValueError(f"Zone rule must be any, all or a positive number, not {value!r}")
+        return value
+
+    def threshold(self, members: int) -> int:
+        """Number of open members, out of ``members``, from which the zone is open."""
+        if self.rule == "any":
+            return 1
+        if self.rule == "all":
+            return members
+        return int(self.rule)
 
 
 class SensorsConfig(BaseModel):
     sensors: Dict[int, str] = Field(default_factory=dict)
+    chips: Dict[int, str] = Field(default_factory=dict, description="GPIO chip of the sensors not on the default chip")
+    expanders: Dict[str, ExpanderConfig] = Field(default_factory=dict, description="I2C expanders, by name")
+    zones: Dict[str, ZoneConfig] = Field(default_factory=dict, description="Zones of sensors, by name")
+    chip: str = Field("/dev/gpiochip0", description="Default GPIO chip")
+    edge_detection: bool = Field(True, description="Wait for GPIO edge events instead of polling")
+    poll_interval: float = Field(0.5, description="Seconds between two reads in polling mode")
+    debounce: float = Field(0.05, description="Default seconds between two accepted changes of a sensor")
+    debounce_times: Dict[int, float] = Field(default_factory=dict, description="Debounce of single sensors")
+    debounce_samples: int = Field(1, description="Consecutive equal samples needed to accept a change")
+    hardware_debounce: bool = Field(False, description="Let the kernel debounce the lines when supported")
+    fault_window: float = Field(60.0, description="Seconds over which the changes and bounces are counted")
+    fault_transitions: int = Field(30, description="Changes within the window that raise a chatter fault, 0 never")
+    fault_bounces: int = Field(100, description="Bounces within the window that raise a bounce fault, 0 never")
+    fault_stuck: float = Field(0.0, description="Seconds without a change that raise a stuck fault, 0 never")
+    workers: int = Field(0, description="Worker processes reading the chips (RUNTIME=processes), 0 one per chip")
+    worker_timeout: float = Field(10.0, description="Seconds without news from a worker before it is restarted")
+
+    def debounce_for(self, pin: int) -> float:
+        return self.debounce_times.get(pin, self.debounce)
+
+    def chip_for(self, pin: int) -> str:
+        """Chip of a sensor: the one given with its pin, else the expander whose inputs hold it, else the default."""
+        chip = self.chips.get(pin)
+        if chip is not None:
+            return chip
+        for name, expander in self.expanders.items():
+            if expander.base <= pin < expander.base + EXPANDER_WIDTH[expander.kind]:
+                return name
+        return self.chip
+
+    def pins_by_chip(self) -> Dict[str, List[int]]:
+        grouped: Dict[str, List[int]] = {}
+        for pin in self.sensors:
+            grouped.setdefault(self.chip_for(pin), []).append(pin)
+        return grouped
+
+    @field_validator("expanders", mode="before")
+    def parse_expanders(cls, value: dict):
+        parsed = {}
+        for name, spec in value.items():
+            if not isinstance(spec, str):
+                parsed[name] = spec
+                continue
+            kind, bus, address, base, *interrupt = (field.strip() for field in spec.split(","))
+            parsed[name] = {
+                "kind": kind.lower(),
+                "bus": int(bus),
+                "address": int(address, 0),
+                "base": int(base),
+                "interrupt": int(interrupt[0]) if interrupt and interrupt[0] else None,
+            }
+        return parsed
+
+    @field_validator("zones", mode="before")
+    def parse_zones(cls, value: dict):
+        # written in config.ini as ``[rule:] sensor1, sensor2``
+        parsed = {}
+        for name, spec in value.items():
+            if not isinstance(spec, str):
+                parsed[name] = spec
+                continue
+            rule, _, members = spec.rpartition(":")
+            parsed[name] = {
+                # configparser lowercases the sensor names, the members must match them
+                "members": [member.strip().lower() for member in members.split(",") if member.strip()],
+                "rule": rule.strip() or "any",
+            }
+        return parsed
 
     @classmethod
     def is_real_board(cls):
         return os.environ.get("GPIO_MOCK", "false").lower() != "true"
 
 
+class SimulatorConfig(BaseModel):
+    mode: SimulatorMode = Field(SimulatorMode.PERIODIC, description="How the simulated sensors change")
+    interval: float = Field(
+        default_factory=lambda: float(os.environ.get("MOCK_INTERVAL", 10)),
+        description="Mean seconds between two changes of a sensor",
+    )
+    intervals: Dict[int, float] = Field(default_factory=dict, description="Interval of single sensors")
+    bounces: int = Field(0, description="Contact bounces before a change settles")
+    bounce_time: float = Field(0.005, description="Seconds the bounces of a change last")
+    trace: str = Field("", description="CSV file with the changes to replay (trace mode)")
+    loop: bool = Field(False, description="Replay the trace again when it ends")
+    seed: Optional[int] = Field(None, description="Seed of the random changes, for repeatable runs")
+    virtual_sensors: int = Field(0, description="Extra simulated sensors added to the configured ones")
+
+    def interval_for(self, pin: int) -> float:
+        return self.intervals.get(pin, self.interval)
+
+
+class MetricsConfig(BaseModel):
+    port: int = 0
+    address: str = "127.0.0.1"
+    textfile: str = ""
+    interval: float = 15.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.port > 0 or bool(self.textfile)
+
+
 class RfidSensorConfig(BaseModel):
     cs_pin: int
     rst_pin: int
@@ -47,6 +261,16 @@ class RfidSensorConfig(BaseModel):
 
 class RfidConfig(BaseModel):
     sensors: Dict[str, RfidSensorConfig]
+    spi_bus: int = Field(0, description="SPI bus shared by the readers")
+    spi_device: int = Field(0, description="SPI device opened on the bus")
+    spi_speed: int = Field(1000000, description="SPI clock in Hz")
+    chip: str = Field("/dev/gpiochip0", description="GPIO chip of the CS and RST lines")
+    poll_min_interval: float = Field(0.05, description="Seconds between two polls of a reader with a tag")
+    poll_max_interval: float = Field(0.3, description="Seconds between two polls of an idle reader")
+    poll_backoff: float = Field(1.5, description="Growth of the poll interval of an idle reader")
+    dedup_window: float = Field(2.0, description="Seconds a tag must be away from a reader before it is read again")
+    allow_list: str = Field("", description="File with the UIDs of the tags allowed to arm and disarm")
+    allow_list_topic: str = Field("", description="Retained MQTT topic with the UIDs of the allowed tags")
 
     @field_validator("sensors", mode="before")
     def parse_sensors(cls, value: dict):
@@ -1,22 +1,316 @@
 import logging
+import random
+import threading
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
-from app.models import MqttConfig
+from app.models import MqttConfig, MqttProtocol
+from app.topics import TopicTable
+
+# Payloads of the status topic; the broker publishes OFFLINE as last will
+ONLINE = "online"
+OFFLINE = "offline"
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter: the n-th delay is a random value
+    between ``min_delay`` and ``min(max_delay, min_delay * 2 ** n)``.
+    """
+
+    def __init__(self, min_delay: float = 1.0, max_delay: float = 120.0):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        ceiling = min(self.max_delay, self.min_delay * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(self.min_delay, ceiling)
+
+    def reset(self) -> None:
+        self.attempts = 0
 
 
 class MqttClient:
+    # Settings of the connection: a change makes the client reconnect
+    BROKER_SETTINGS = ("address", "port", "username", "password", "keepalive", "session_expiry")
+    # Settings fixed when the paho client is created
+    RESTART_SETTINGS = ("protocol", "client_id", "clean_session")
 
     def __init__(self, config: MqttConfig) -> None:
         self.config = config
         self.logger = logging.getLogger(__name__)
-        self.client = mqtt.Client()
+        self.is_v5 = config.protocol is MqttProtocol.V5
+        if self.is_v5:
+            self.client = mqtt.Client(
+                client_id=config.client_id,
+                protocol=mqtt.MQTTv5,
+                reconnect_on_failure=False,
+            )
+        else:
+            self.client = mqtt.Client(
+                client_id=config.client_id,
+                clean_session=config.clean_session,
+                reconnect_on_failure=False,
+            )
         self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.on_pre_connect = self._on_pre_connect
         self.client.username_pw_set(config.username, config.password)
+        self._set_will()
+        self.backoff = Backoff(config.reconnect_min_delay, config.reconnect_max_delay)
+        self.connect_listeners = []
+        self.publish_listeners = []
+        self.subscriptions = {}
+        self.reconnects = 0
+        self.reconfigured = False
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.alias_lock = threading.Lock()
+        self.alias_maximum = 0
+        self.aliases = {}
 
     def _on_connect(self, client, userdata, flags, reason_code, properties=None):
         self.logger.info("Connected to broker: %s:%s with code %s",
                          self.config.address, self.config.port, reason_code)
+        if reason_code == 0:
+            if self.is_v5 and self.config.topic_aliases:
+                with self.alias_lock:
+                    self.alias_maximum = getattr(properties, "TopicAliasMaximum", 0)
+            self.backoff.reset()
+            for topic, qos in self.subscriptions.items():
+                client.subscribe(topic, qos)
+            for listener in self.connect_listeners:
+                listener()
+
+    def _on_pre_connect(self, client, userdata):
+        """Topic aliases only live as long as the network connection: the next one starts without."""
+        with self.alias_lock:
+            self.aliases = {}
+            self.alias_maximum = 0
+
+    @property
+    def status_topic(self) -> str:
+        """Full topic of the online/offline status, empty when it is disabled."""
+        if not self.config.status_topic:
+            return ""
+        return TopicTable.from_config(self.config).event_topic(self.config.status_topic)
+
+    def _set_will(self) -> None:
+        """Have the broker mark the adapter offline when the connection is lost without a disconnect."""
+        topic = self.status_topic
+        if topic:
+            self.client.will_set(topic, OFFLINE, qos=1, retain=True)
+        else:
+            self.client.will_clear()
+
+    def _connect_properties(self):
+        if not self.is_v5 or self.config.clean_session:
+            return None
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = self.config.session_expiry
+        return properties
+
+    def _publish_properties(self, topic: str, user_properties, qos: int = 0):
+        """
+        Return the topic to send and the MQTT 5 properties of a publish.
+        Only QoS 0 messages use a topic alias: paho resends the others
+        as they were sent after a reconnect, when the alias no longer exists.
+        """
+        properties = Properties(PacketTypes.PUBLISH)
+        if self.config.message_expiry:
+            properties.MessageExpiryInterval = self.config.message_expiry
+        if user_properties and self.config.user_properties:
+            properties.UserProperty = list(user_properties)
+        if qos > 0:
+            return topic, properties
+        with self.alias_lock:
+            alias = self.aliases.get(topic)
+            if alias is not None:
+                properties.TopicAlias = alias
+                topic = ""
+            elif len(self.aliases) < self.alias_maximum:
+                alias = len(self.aliases) + 1
+                self.aliases[topic] = alias
+                properties.TopicAlias = alias
+        return topic, properties
+
+    def _on_disconnect(self, client, userdata, *args):
+        if not (self.stop_event.is_set() or self.reconfigured):
+            self.logger.warning("Connection to %s:%s lost", self.config.address, self.config.port)
+
+    def _on_publish(self, client, userdata, mid, *args):
+        for listener in self.publish_listeners:
+            listener(mid)
+
+    def add_connect_listener(self, listener) -> None:
+        self.connect_listeners.append(listener)
+
+    def add_publish_listener(self, listener) -> None:
+        """``listener`` is called with the message id of every publish acknowledged by the broker."""
+        self.publish_listeners.append(listener)
+
+    def subscribe(self, topic: str, callback, qos: int = 1) -> None:
+        """
+        ``callback`` is called with the payload of every message on ``topic``.
+        The subscription is renewed on every connection, so the broker sends
+        the retained message again after a reconnect.
+        """
+        self.subscriptions[topic] = qos
+        self.client.message_callback_add(topic, lambda client, userdata, message: callback(message.payload))
+        if self.is_connected():
+            self.client.subscribe(topic, qos)
+
+    def is_connected(self) -> bool:
+        return self.client.is_connected()
+
+    def _run(self):
+        """
+        Network thread: connect, run the paho loop until the connection is
+        lost, then wait for the backoff delay and try again until
+        :meth:`disconnect` is called.
+        """
+        first_attempt = True
+        while not self.stop_event.is_set():
+            try:
+                if first_attempt or self.reconfigured:
+                    self.reconfigured = False
+                    self._connect()
+                else:
+                    self.reconnects += 1
+                    self.client.reconnect()
+                first_attempt = False
+                if self.stop_event.is_set():
+                    break
+                self.client.loop_forever()
+            except OSError as e:
+                self.logger.warning("Unable to connect to %s:%s: %s", self.config.address, self.config.port, e)
+            except Exception:
+                # raised by a callback: the network thread must outlive it
+                self.logger.exception("Unexpected error in the MQTT network loop")
+            if self.stop_event.is_set():
+                break
+            if self.reconfigured:
+                continue
+            delay = self.backoff.next_delay()
+            self.logger.info("Reconnecting in %.1f s", delay)
+            self.stop_event.wait(delay)
+
+    async def run_async(self) -> None:
+        """
+        Asyncio version of the network thread: paho's socket is served by
+        the running event loop through its external loop callbacks, and the
+        connection is retried with the same backoff.  The connection attempts
+        run in the default executor, so an unreachable broker does not stop
+        the GPIO events.  When the task is cancelled the client disconnects
+        after flushing its writes.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        loop_thread = threading.get_ident()
+        closed = asyncio.Event()
+        tasks = []
+
+        def in_loop(callback):
+            # paho calls the socket callbacks from the executor during a connection attempt
+            def wrapper(client, userdata, sock):
+                if threading.get_ident() == loop_thread:
+                    callback(client, userdata, sock)
+                else:
+                    loop.call_soon_threadsafe(callback, client, userdata, sock)
+            return wrapper
+
+        async def misc_loop():
+            while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(1)
+
+        def on_socket_open(client, userdata, sock):
+            loop.add_reader(sock, client.loop_read)
+            tasks.append(loop.create_task(misc_loop()))
+
+        def on_socket_close(client, userdata, sock):
+            loop.remove_reader(sock)
+            loop.remove_writer(sock)
+            while tasks:
+                tasks.pop().cancel()
+            closed.set()
+
+        self.client.on_socket_open = in_loop(on_socket_open)
+        self.client.on_socket_close = in_loop(on_socket_close)
+        self.client.on_socket_register_write = in_loop(
+            lambda client, userdata, sock: loop.add_writer(sock, client.loop_write)
+        )
+        self.client.on_socket_unregister_write = in_loop(lambda client, userdata, sock: loop.remove_writer(sock))
+        first_attempt = True
+        try:
+            while True:
+                closed.clear()
+                try:
+                    if first_attempt or self.reconfigured:
+                        self.reconfigured = False
+                        await loop.run_in_executor(None, self._connect)
+                    else:
+                        self.reconnects += 1
+                        await loop.run_in_executor(None, self.client.reconnect)
+                    first_attempt = False
+                    await closed.wait()
+                except OSError as e:
+                    self.logger.warning("Unable to connect to %s:%s: %s", self.config.address, self.config.port, e)
+                if self.reconfigured:
+                    continue
+                delay = self.backoff.next_delay()
+                self.logger.info("Reconnecting in %.1f s", delay)
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.logger.info("Disconnecting from %s:%s", self.config.address, self.config.port)
+            if self.client.disconnect() == mqtt.MQTT_ERR_SUCCESS:
+                try:
+                    await asyncio.wait_for(closed.wait(), 5)
+                except asyncio.TimeoutError:
+                    pass
+            raise
+
+    def _connect(self):
+        if self.is_v5:
+            self.client.connect(
+                self.config.address,
+                self.config.port,
+                keepalive=self.config.keepalive,
+                clean_start=self.config.clean_session,
+                properties=self._connect_properties(),
+            )
+        else:
+            self.client.connect(self.config.address, self.config.port, keepalive=self.config.keepalive)
+
+    def reconfigure(self, config: MqttConfig) -> bool:
+        """
+        Switch to a new configuration without a restart.  The client drops
+        the connection and connects with the new settings only when a broker
+        setting changed; the settings fixed when the client was created keep
+        their value until a restart.  Returns whether the client reconnects.
+        """
+        old = self.config
+        restart = [name for name in self.RESTART_SETTINGS if getattr(old, name) != getattr(config, name)]
+        if restart:
+            self.logger.warning("MQTT settings %s take effect after a restart", ", ".join(restart))
+        self.config = config.model_copy(update={name: getattr(old, name) for name in restart})
+        # used from the next connection
+        self._set_will()
+        self.backoff.min_delay = config.reconnect_min_delay
+        self.backoff.max_delay = config.reconnect_max_delay
+        if all(getattr(old, name) == getattr(config, name) for name in self.BROKER_SETTINGS):
+            return False
+        self.logger.info("Broker settings changed, connecting to %s:%s", config.address, config.port)
+        self.client.username_pw_set(config.username, config.password)
+        self.reconfigured = True
+        if self.is_connected():
+            self.client.disconnect()
+        return True
 
     def connect(self):
         self.logger.info(
@@ -24,8 +318,9 @@ class MqttClient:
             self.config.address,
             self.config.port
         )
-        self.client.connect(self.config.address, self.config.port, keepalive=120)
-        self.client.loop_start()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
 
     def disconnect(self) -> None:
         self.logger.info(
@@ -33,9 +328,17 @@ class MqttClient:
             self.config.address,
             self.config.port
         )
-        self.client.loop_stop()
+        self.stop_event.set()
         self.client.disconnect()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
-    def publish_message(self, topic, message, qos) -> None:
-        self.client.publish(topic, message, qos)
+    def publish_message(self, topic, message, qos, retain=False, user_properties=None) -> int:
+        if self.is_v5:
+            wire_topic, properties = self._publish_properties(topic, user_properties, qos)
+            info = self.client.publish(wire_topic, message, qos, retain, properties)
+        else:
+            info = self.client.publish(topic, message, qos, retain)
         self.logger.debug("Sent message: %s to topic: %s", message, topic)
+        return info.mid
@@ -0,0 +1,353 @@
+import itertools
+import json
+import queue
+import struct
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from app.models import OverflowPolicy, PayloadFormat
+
+# pin, state (0 closed, 1 open)
+BINARY_PAYLOAD = struct.Struct("<HB")
+# zone state, open members, members
+ZONE_PAYLOAD = struct.Struct("<BHH")
+# digest sequence, sensors; followed by the bitmap of their states
+DIGEST_HEADER = struct.Struct("<IH")
+# pin, fault (index in app.faults.FAULTS), active
+FAULT_PAYLOAD = struct.Struct("<HBB")
+
+
+def encode_payload(payload_format: PayloadFormat, status: str, pin: int, name: str):
+    """
+    Build the payload of a state message.  ``plain`` is the bare status
+    string, ``json`` a compact object and ``binary`` three bytes.
+    """
+    if payload_format is PayloadFormat.JSON:
+        return json.dumps({"status": status, "pin": pin, "name": name}, separators=(",", ":"))
+    if payload_format is PayloadFormat.BINARY:
+        return BINARY_PAYLOAD.pack(pin, status != "closed")
+    return status
+
+
+def encode_zone(payload_format: PayloadFormat, name: str, active: bool, open_members: int, members: int):
+    """Payload of a zone state: the status, with the open and total members for ``json`` and ``binary``."""
+    status = "open" if active else "closed"
+    if payload_format is PayloadFormat.JSON:
+        return json.dumps(
+            {"status": status, "zone": name, "open": open_members, "members": members}, separators=(",", ":")
+        )
+    if payload_format is PayloadFormat.BINARY:
+        return ZONE_PAYLOAD.pack(active, open_members, members)
+    return status
+
+
+def encode_digest(payload_format: PayloadFormat, seq: int, values: list):
+    """
+    Payload of a digest: bit ``n`` of the bitmap, little endian, is set when
+    the ``n``-th sensor in pin order is open.  ``binary`` is the header and
+    the bitmap, ``json`` and ``plain`` carry the bitmap in hex.
+    """
+    bitmap = 0
+    for bit, value in enumerate(values):
+        if value:
+            bitmap |= 1 << bit
+    bitmap = bitmap.to_bytes((len(values) + 7) // 8, "little")
+    if payload_format is PayloadFormat.JSON:
+        return json.dumps({"seq": seq, "sensors": len(values), "bitmap": bitmap.hex()}, separators=(",", ":"))
+    if payload_format is PayloadFormat.BINARY:
+        return DIGEST_HEADER.pack(seq & 0xFFFFFFFF, len(values)) + bitmap
+    return f"{seq},{len(values)},{bitmap.hex()}"
+
+
+def encode_fault(payload_format: PayloadFormat, pin: int, name: str, fault: str, code: int, active: bool):
+    """Payload of a line fault: ``active`` or ``clear``, with the sensor for ``json`` and ``binary``."""
+    if payload_format is PayloadFormat.JSON:
+        return json.dumps({"fault": fault, "active": active, "pin": pin, "name": name}, separators=(",", ":"))
+    if payload_format is PayloadFormat.BINARY:
+        return FAULT_PAYLOAD.pack(pin, code, active)
+    return "active" if active else "clear"
+
+
+def encode_tag(payload_format: PayloadFormat, reader: str, uid: bytes):
+    """Payload of a tag read: the UID in hex, in a compact object for ``json`` or as raw bytes for ``binary``."""
+    if payload_format is PayloadFormat.JSON:
+        return json.dumps({"uid": uid.hex().upper(), "reader": reader}, separators=(",", ":"))
+    if payload_format is PayloadFormat.BINARY:
+        return bytes(uid)
+    return uid.hex().upper()
+
+
+def encode_access(payload_format: PayloadFormat, reader: str, uid: bytes, label):
+    """Payload of an access decision: ``granted`` or ``denied``, the decision with the tag for ``json``."""
+    granted = label is not None
+    if payload_format is PayloadFormat.JSON:
+        return json.dumps(
+            {"uid": uid.hex().upper(), "reader": reader, "granted": granted, "label": label or ""},
+            separators=(",", ":"),
+        )
+    if payload_format is PayloadFormat.BINARY:
+        return b"\x01" if granted else b"\x00"
+    return "granted" if granted else "denied"
+
+
+class OutboundMessage:
+    __slots__ = ("topic", "payload", "qos", "retain", "pin", "timestamp", "seq")
+
+    def __init__(self, topic, payload, qos=0, retain=False, pin=None, timestamp=None, seq=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.pin = pin
+        self.timestamp = timestamp
+        self.seq = seq
+
+    def user_properties(self):
+        if self.pin is None:
+            return None
+        return (("pin", str(self.pin)), ("ts", str(int(self.timestamp * 1e9))), ("seq", str(self.seq)))
+
+
+class SensorRoute:
+    """Topics and payloads of one sensor, encoded once rather than at every change."""
+
+    __slots__ = ("name", "topics", "payloads")
+
+    def __init__(self, name: str, topics: tuple, payload_format: PayloadFormat, pin: int):
+        self.name = name
+        self.topics = topics
+        # indexed by the line value: 0 closed, 1 open
+        self.payloads = tuple(encode_payload(payload_format, status, pin, name) for status in ("closed", "open"))
+
+
+class OutboundQueue(queue.Queue):
+    """
+    Bounded queue of :class:`OutboundMessage` waiting for the publisher
+    thread.  The ``policy`` decides what happens when the queue is full:
+
+    * ``block``: the producer waits for a free slot, as ``queue.Queue`` does;
+    * ``drop-oldest``: the oldest waiting message is discarded;
+    * ``coalesce``: like ``drop-oldest``, but a message waiting for the same
+      topic is always replaced in place by the new one.
+
+    With ``coalesce`` enabled the queue keeps at most one message per topic
+    whatever the policy.  A positive ``window`` also holds each message
+    until its topic has been quiet for ``window`` seconds, but never longer
+    than ``max_latency`` seconds after it was first queued, so a chattering
+    sensor only sends its final state.
+
+    ``on_discard``, when set, is called with every message that leaves the
+    queue without being returned by :meth:`get_batch` (dropped or replaced).
+    ``on_ready``, when set, is called after every put and :meth:`wake`, for
+    consumers that do not block in :meth:`get_batch` (the asyncio runtime).
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1000,
+        policy: OverflowPolicy = OverflowPolicy.BLOCK,
+        coalesce: bool = False,
+        window: float = 0.0,
+        max_latency: float = 1.0,
+    ):
+        self.policy = OverflowPolicy(policy)
+        self.coalescing = coalesce or self.policy is OverflowPolicy.COALESCE
+        self.window = window if self.coalescing else 0.0
+        self.max_latency = max_latency
+        self.counters = {"enqueued": 0, "dropped": 0, "coalesced": 0, "max_depth": 0}
+        self._wakeups = 0
+        self.on_discard = None
+        self.on_ready = None
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self.queue = OrderedDict()
+        self._keys = itertools.count()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        now = time.monotonic()
+        key = item.topic if self.coalescing else next(self._keys)
+        self.queue[key] = [item, now, now]
+
+    def _get(self):
+        return self.queue.popitem(last=False)[1][0]
+
+    def _discard(self, item):
+        if self.on_discard is not None:
+            self.on_discard(item)
+
+    def _drop_oldest(self):
+        self._discard(self.queue.popitem(last=False)[1][0])
+        self.unfinished_tasks -= 1
+        self.counters["dropped"] += 1
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            if self.coalescing and item.topic in self.queue:
+                entry = self.queue[item.topic]
+                self._discard(entry[0])
+                entry[0] = item
+                entry[2] = time.monotonic()
+                self.counters["coalesced"] += 1
+                self._notify_ready()
+                return
+            if 0 < self.maxsize <= self._qsize():
+                if self.policy is OverflowPolicy.BLOCK:
+                    self._wait_not_full(block, timeout)
+                else:
+                    self._drop_oldest()
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.counters["enqueued"] += 1
+            self.counters["max_depth"] = max(self.counters["max_depth"], self._qsize())
+            self.not_empty.notify()
+            self._notify_ready()
+
+    def _notify_ready(self):
+        if self.on_ready is not None:
+            self.on_ready()
+
+    def _wait_not_full(self, block, timeout):
+        if not block:
+            raise queue.Full
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._qsize() >= self.maxsize:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise queue.Full
+            self.not_full.wait(remaining)
+
+    def _take_ready(self, max_items: int, now: float, flush: bool):
+        """
+        Return the messages that can be sent now and the number of seconds
+        before the next held message becomes ready (``None`` if none is held).
+        """
+        if self.window <= 0 or flush:
+            return [self._get() for _ in range(min(max_items, self._qsize()))], None
+        ready, next_ready = [], None
+        for key, (_, first, last) in self.queue.items():
+            delay = min(last + self.window, first + self.max_latency) - now
+            if delay <= 0:
+                ready.append(key)
+                if len(ready) == max_items:
+                    break
+            elif next_ready is None or delay < next_ready:
+                next_ready = delay
+        return [self.queue.pop(key)[0] for key in ready], next_ready
+
+    def get_batch(self, max_items: int, timeout=None, flush: bool = False) -> list:
+        """
+        Wait up to ``timeout`` seconds for at least one message ready to be
+        sent and return up to ``max_items`` of them, taken with a single lock
+        acquisition.  ``flush`` ignores the coalescing window.  An empty list
+        means that the timeout expired or :meth:`wake` was called.
+        """
+        with self.not_empty:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            wakeups = self._wakeups
+            while True:
+                now = time.monotonic()
+                batch, next_ready = self._take_ready(max_items, now, flush)
+                remaining = None if deadline is None else deadline - now
+                if batch or wakeups != self._wakeups or (remaining is not None and remaining <= 0):
+                    break
+                if next_ready is not None and (remaining is None or next_ready < remaining):
+                    remaining = next_ready
+                self.not_empty.wait(remaining)
+            if batch:
+                self.not_full.notify(len(batch))
+            return batch
+
+    def ready_in(self):
+        """Seconds before a queued message can be sent: 0 if one is ready, ``None`` if the queue is empty."""
+        with self.mutex:
+            if not self.queue:
+                return None
+            if self.window <= 0:
+                return 0.0
+            now = time.monotonic()
+            return max(0.0, min(
+                min(last + self.window, first + self.max_latency) - now for _, first, last in self.queue.values()
+            ))
+
+    def wake(self) -> None:
+        with self.not_empty:
+            self._wakeups += 1
+            self.not_empty.notify_all()
+            self._notify_ready()
+
+
+def _as_bytes(payload) -> bytes:
+    return payload.encode() if isinstance(payload, str) else bytes(payload)
+
+
+class DeliveryTracker:
+    """
+    Follow every state message from the moment it is queued until the
+    broker acknowledges it, so that the publisher knows the last state of
+    each topic that is stored on the broker and which topics still have
+    messages on their way.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.acked = {}
+        self.pending = Counter()
+        self.inflight = {}
+        self._early_acks = set()
+
+    def queued(self, message: OutboundMessage) -> None:
+        with self.lock:
+            self.latest[message.topic] = message
+            self.pending[message.topic] += 1
+
+    def discarded(self, message: OutboundMessage) -> None:
+        """The message was dropped or could not be published."""
+        with self.lock:
+            self._release(message.topic)
+
+    def sent(self, message: OutboundMessage, mid: int):
+        """Return the message if the broker acknowledged it before it was recorded."""
+        with self.lock:
+            if mid in self._early_acks:
+                self._early_acks.discard(mid)
+                self._acknowledge(message)
+                return message
+            self.inflight[mid] = message
+            return None
+
+    def acknowledged(self, mid: int):
+        """Return the acknowledged message, if it has already been recorded."""
+        # paho can report a QoS 0 publish before publish() has returned its mid
+        with self.lock:
+            message = self.inflight.pop(mid, None)
+            if message is None:
+                self._early_acks.add(mid)
+            else:
+                self._acknowledge(message)
+            return message
+
+    def _acknowledge(self, message: OutboundMessage) -> None:
+        self.acked[message.topic] = _as_bytes(message.payload)
+        self._release(message.topic)
+
+    def _release(self, topic: str) -> None:
+        if self.pending[topic] > 0:
+            self.pending[topic] -= 1
+
+    def is_delivered(self, message: OutboundMessage) -> bool:
+        with self.lock:
+            return not self.pending[message.topic] and self.acked.get(message.topic) == _as_bytes(message.payload)
+
+    def out_of_sync(self) -> list:
+        """Latest message of the topics whose acknowledged state differs and that have nothing on the way."""
+        with self.lock:
+            return [
+                message for topic, message in self.latest.items()
+                if not self.pending[topic] and self.acked.get(topic) != _as_bytes(message.payload)
+            ]
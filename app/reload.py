@@ -0,0 +1,155 @@
+import logging
+import os
+import struct
+from pathlib import Path
+
+from app.services import MqttService, SensorsService, RfidService
+
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+# wd, mask, cookie, length of the name that follows
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class FileWatcher:
+    """
+    Reports the changes of one file through inotify.  The directory is
+    watched rather than the file, so an editor replacing the file with a
+    rename is noticed too.  Without inotify the modification time of the
+    file is compared at every check.
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.path = Path(path)
+        self.name = os.fsencode(self.path.name)
+        self.fd = None
+        self.mtime = self._mtime()
+        try:
+            import ctypes
+            import ctypes.util
+
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            if libc.inotify_add_watch(fd, os.fsencode(self.path.parent), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.fd = fd
+        except (OSError, AttributeError) as e:
+            self.logger.info("inotify not available (%s): checking the modification time of %s", e, self.path)
+
+    def _mtime(self):
+        try:
+            return self.path.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def changed(self) -> bool:
+        """Whether the file was written since the previous call; never blocks."""
+        if self.fd is None:
+            mtime, self.mtime = self.mtime, self._mtime()
+            return mtime != self.mtime
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                length = EVENT_HEADER.unpack_from(data, offset)[3]
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                changed = changed or name == self.name
+                offset += EVENT_HEADER.size + length
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class ConfigReloader:
+    """
+    Applies a new ``config.ini`` to the running services, on SIGHUP
+    (:meth:`request`) or when the file is written (:meth:`watch`).  Only
+    what changed is touched: the sensors through
+    :meth:`SensorsService.apply_config`, the broker connection when its
+    settings changed, the RFID readers when their section changed.  The
+    metrics and the simulator keep their settings until a restart.  An
+    invalid file is logged and the running configuration is kept.
+    """
+
+    def __init__(
+        self,
+        mqtt_service: MqttService,
+        sensors_service: SensorsService,
+        rfid_service: RfidService,
+        configs: tuple,
+        path,
+        loader,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.mqtt_service = mqtt_service
+        self.sensors_service = sensors_service
+        self.rfid_service = rfid_service
+        # mqtt, sensors, rfid, metrics and simulator configs, as returned by the loader
+        self.configs = configs
+        self.path = path
+        self.loader = loader
+        self.watcher = None
+        self.requested = False
+        self.reloads = 0
+
+    @property
+    def fd(self):
+        """File descriptor readable when the config file changes, ``None`` without inotify."""
+        return self.watcher.fd if self.watcher is not None else None
+
+    def watch(self) -> None:
+        if self.watcher is None:
+            self.watcher = FileWatcher(self.path)
+
+    def request(self) -> None:
+        """Ask for a reload at the next :meth:`check`; safe to call from a signal handler."""
+        self.requested = True
+
+    def check(self) -> set:
+        """Reload when requested or when the file changed; returns the parts that changed."""
+        requested, self.requested = self.requested, False
+        if self.watcher is not None and self.watcher.changed():
+            requested = True
+        return self.reload() if requested else set()
+
+    def reload(self) -> set:
+        """Load the config file again and apply it; returns the changed parts among mqtt, sensors and rfid."""
+        try:
+            configs = self.loader()
+        except Exception as e:
+            self.logger.error("Invalid configuration in %s, keeping the running one: %s", self.path, e)
+            return set()
+        mqtt_cfg, sensors_cfg, rfid_cfg, metrics_cfg, simulator_cfg = configs
+        current = self.configs
+        changed = set()
+        if mqtt_cfg != current[0]:
+            self.mqtt_service.apply_config(mqtt_cfg)
+            changed.add("mqtt")
+        if sensors_cfg != current[1]:
+            self.sensors_service.apply_config(sensors_cfg)
+            changed.add("sensors")
+        if rfid_cfg != current[2]:
+            self.rfid_service.apply_config(rfid_cfg)
+            changed.add("rfid")
+        for name, new, old in (("metrics", metrics_cfg, current[3]), ("simulator", simulator_cfg, current[4])):
+            if new != old:
+                self.logger.warning("The %s settings take effect after a restart", name)
+        self.configs = (mqtt_cfg, sensors_cfg, rfid_cfg, current[3], current[4])
+        self.reloads += 1
+        self.logger.info("Configuration reloaded, changed: %s", ", ".join(sorted(changed)) or "nothing")
+        return changed
+
+    def close(self) -> None:
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
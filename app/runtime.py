@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import signal
+import time
+
+from app.metrics import MetricsExporter
+from app.reload import ConfigReloader
+from app.services import MqttService, SensorsService, RfidService
+from app.simulator import GpioSimulator
+from app.startup import timer
+
+# Longest interval between two checks of the line faults and of the digest settings
+SUPERVISION_INTERVAL = 1.0
+
+
+class AsyncRuntime:
+    """
+    Runs the whole adapter on one asyncio event loop instead of a thread
+    per component: the GPIO edge file descriptors and the MQTT socket are
+    watched by the loop, while the publisher, the debounce retries, the
+    polling, the RFID readers, the simulator and the metrics are tasks and
+    timers.  SIGINT and SIGTERM cancel the tasks; the publisher flushes its
+    queue before the MQTT client disconnects.  SIGHUP and the writes of the
+    config file reload the configuration between two callbacks of the loop.
+    """
+
+    def __init__(
+        self,
+        mqtt_service: MqttService,
+        sensors_service: SensorsService,
+        rfid_service: RfidService,
+        gpio_simulator: GpioSimulator,
+        metrics_exporter: MetricsExporter,
+        config_reloader: ConfigReloader = None,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.mqtt_service = mqtt_service
+        self.sensors_service = sensors_service
+        self.rfid_service = rfid_service
+        self.gpio_simulator = gpio_simulator
+        self.metrics_exporter = metrics_exporter
+        self.config_reloader = config_reloader
+        self.rfid_task = None
+        self.poll_task = None
+        self.watched_fds = []
+        self.loop = None
+        self.retry_timer = None
+        self.stopping = None
+
+    def stop(self) -> None:
+        """Ask :meth:`run` to shut down; safe to call from a signal handler."""
+        if self.stopping is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    def _arm_retry(self) -> None:
+        """Sample the pins held back by the debounce as soon as it allows it, and the polled chips when due."""
+        if self.retry_timer is not None:
+            self.retry_timer.cancel()
+            self.retry_timer = None
+        retry = self.sensors_service.wake_in()
+        if retry is not None:
+            self.retry_timer = self.loop.call_later(retry, self._on_edge, None)
+
+    def _on_edge(self, fd) -> None:
+        self.sensors_service.handle_events([fd] if fd is not None else [])
+        self._arm_retry()
+
+    async def _poll_sensors(self) -> None:
+        while True:
+            self.sensors_service.check_sensors()
+            await asyncio.sleep(self.sensors_service.config.poll_interval)
+
+    def _watch_sensors(self) -> None:
+        if not self.sensors_service.edge_mode:
+            self.poll_task = self.loop.create_task(self._poll_sensors())
+            return
+        self.watched_fds = list(self.sensors_service.edge_fds)
+        for fd in self.watched_fds:
+            self.loop.add_reader(fd, self._on_edge, fd)
+        # the chips without edge events
+        self._arm_retry()
+
+    def _unwatch_sensors(self) -> None:
+        if self.poll_task is not None:
+            self.poll_task.cancel()
+            self.poll_task = None
+        for fd in self.watched_fds:
+            self.loop.remove_reader(fd)
+        self.watched_fds = []
+        if self.retry_timer is not None:
+            self.retry_timer.cancel()
+            self.retry_timer = None
+
+    async def _supervise(self) -> None:
+        while True:
+            due = self.sensors_service.supervise(time.monotonic())
+            await asyncio.sleep(SUPERVISION_INTERVAL if due is None else min(due, SUPERVISION_INTERVAL))
+
+    def _start_rfid(self) -> None:
+        if self.rfid_task is None or self.rfid_task.done():
+            self.rfid_task = self.loop.create_task(self.rfid_service.run_async())
+
+    def _reload(self, requested: bool = False) -> None:
+        """Apply a config change and follow the new line requests and readers."""
+        if requested:
+            self.config_reloader.request()
+        changed = self.config_reloader.check()
+        if "sensors" in changed:
+            self._unwatch_sensors()
+            self._watch_sensors()
+        if "rfid" in changed:
+            self._start_rfid()
+
+    async def _watch_config(self) -> None:
+        """Check the config file every second when inotify is not available."""
+        while True:
+            await asyncio.sleep(1)
+            self._reload()
+
+    @staticmethod
+    async def _cancel(tasks) -> None:
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logging.getLogger(__name__).error("Task failed during shutdown: %s", result)
+
+    async def run(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.stop)
+
+        client_task = self.loop.create_task(self.mqtt_service.mqtt_client.run_async())
+        publisher_task = self.loop.create_task(self.mqtt_service.run_async())
+        # Let the publisher hook into the queue before the snapshot is queued
+        await asyncio.sleep(0)
+        self.sensors_service.connect_sensors()
+        self.rfid_service.connect_sensors()
+        self._watch_sensors()
+        self._start_rfid()
+        tasks = []
+        if self.config_reloader is not None:
+            self.config_reloader.watch()
+            self.loop.add_signal_handler(signal.SIGHUP, self._reload, True)
+            if self.config_reloader.fd is not None:
+                self.loop.add_reader(self.config_reloader.fd, self._reload)
+            else:
+                tasks.append(self.loop.create_task(self._watch_config()))
+        tasks.append(self.loop.create_task(self._supervise()))
+        if not self.sensors_service.is_real_board:
+            tasks.append(self.loop.create_task(self.gpio_simulator.run_async()))
+        if self.metrics_exporter.config.enabled:
+            tasks.append(self.loop.create_task(self.metrics_exporter.run_async()))
+        self.logger.info("Asyncio runtime started")
+        timer.log()
+
+        try:
+            await self.stopping.wait()
+        finally:
+            self.logger.info("Shutting down")
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                self.loop.remove_signal_handler(sig)
+            if self.config_reloader is not None:
+                self.loop.remove_signal_handler(signal.SIGHUP)
+                if self.config_reloader.fd is not None:
+                    self.loop.remove_reader(self.config_reloader.fd)
+                self.config_reloader.close()
+            poll_task = self.poll_task
+            self._unwatch_sensors()
+            await self._cancel([task for task in (poll_task, self.rfid_task) if task is not None] + tasks)
+            await self._cancel([publisher_task])
+            await self._cancel([client_task])
+            self.rfid_service.stop()
+            self.sensors_service.close()
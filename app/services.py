@@ -1,5 +1,8 @@
+import contextlib
+import itertools
 import json
 import logging
+import select
 import threading
 import time
 
@@ -10,138 +13,1094 @@ try:
 except ImportError:
     GPIOD_AVAILABLE = False
 
-from collections import defaultdict
-from app.models import MessageModel, SensorsConfig, RfidConfig
-from app.mqtt_client import MqttClient
+from app.allowlist import AllowList
+from app.debounce import Debouncer
+from app.faults import CHECK_INTERVAL as FAULT_CHECK_INTERVAL, FAULTS, FaultDetector
+from app.inputs import EXPANDERS, GpiodDriver, InputDriver, smbus2
+from app.journal import ACKED, DROPPED, FAILED, PUBLISHED, SPOOLED, Journal
+from app.metrics import LatencyStats
+from app.models import MessageModel, MqttConfig, OverflowPolicy, PayloadFormat, SensorsConfig, RfidConfig
+from app.mqtt_client import OFFLINE, ONLINE, MqttClient
+from app.mfrc522 import MFRC522, RfidError, SPIDEV_AVAILABLE, TRANSCEIVE_TIMEOUT, SpidevTransport
+from app.publisher import (
+    DeliveryTracker, OutboundMessage, OutboundQueue, SensorRoute, encode_access, encode_digest, encode_fault,
+    encode_tag, encode_zone,
+)
+from app.spool import MessageSpool
+from app.topics import TopicTable
+from app.zones import Zone, ZoneEngine
 
 
 class MqttService:
-    topic_prefix = "alarm/"
-    topic_suffix = "/status"
+    # Settings of the queue and the spool, created once at startup
+    TOPIC_SETTINGS = ("topic_prefix", "topic_template", "device_id", "topics", "groups", "zone_template")
+    RESTART_SETTINGS = (
+        "queue_size", "overflow_policy", "coalesce", "coalesce_window", "coalesce_max_latency", "spool_path",
+        "spool_size", "journal_path", "journal_size", "journal_files",
+    )
 
-    def __init__(self, mqtt_client: MqttClient):
+    def __init__(
+        self,
+        mqtt_client: MqttClient,
+        outbound_queue: OutboundQueue = None,
+        batch_size: int = 50,
+        spool: MessageSpool = None,
+        retain: bool = False,
+        snapshot: bool = False,
+        payload_format: PayloadFormat = PayloadFormat.PLAIN,
+        journal: Journal = None,
+        topics: TopicTable = None,
+        status_topic: str = "",
+        digest_topic: str = "digest",
+        digest_interval: float = 0.0,
+    ):
         self.logger = logging.getLogger(__name__)
         self.mqtt_client = mqtt_client
+        self.queue = outbound_queue if outbound_queue is not None else OutboundQueue()
+        self.batch_size = batch_size
+        self.spool = spool
+        self.journal = journal
+        self.retain = retain
+        self.snapshot = snapshot
+        self.payload_format = PayloadFormat(payload_format)
+        self.topics = topics if topics is not None else TopicTable()
+        # pin -> SensorRoute, the routing table built by compile_routes or at the first message of a sensor
+        self.routes = {}
+        self.sequence = itertools.count(1)
+        # Supervision: retained online/offline status and periodic digest of all the states
+        self.status_topic = status_topic
+        self.digest_topic = digest_topic
+        self.digest_interval = digest_interval
+        self.digest_sequence = itertools.count(1)
+        self.next_digest = 0.0
+        self.digests = 0
+        self.tracker = DeliveryTracker()
+        self.latency = LatencyStats()
+        self.thread = None
+        self.stop_event = threading.Event()
+        # Set by run_async: there is no publisher thread to make room in a full queue
+        self.inline_drain = False
+        # Messages that would block on a full queue before the publisher starts
+        # (a startup snapshot larger than the queue), queued when it starts
+        self.staged = []
+        self.resync_requested = False
+        self.connections = 0
+        self.published = 0
+        self.acknowledged = 0
+        self.failed = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.republished = 0
+        self.replay_rate = 0.0
+        self.queue.on_discard = self._on_discard
+        self.mqtt_client.add_connect_listener(self._on_connected)
+        self.mqtt_client.add_publish_listener(self._on_published)
 
     def _get_topic(self, sub_topic: str) -> str:
-        return f"{self.topic_prefix}{sub_topic}"
+        return self.topics.event_topic(sub_topic)
+
+    def _on_connected(self) -> None:
+        self.connections += 1
+        if self.connections > 1:
+            self.resync_requested = True
+        if self.status_topic:
+            # replaces the offline status left by the last will
+            self._publish_status(ONLINE)
+        self.queue.wake()
+
+    def _publish_status(self, status: str) -> None:
+        self._enqueue(OutboundMessage(
+            self._get_topic(self.status_topic), status, 1, True, timestamp=time.monotonic(), seq=next(self.sequence)
+        ))
+
+    def _publish_offline(self) -> None:
+        """Mark the adapter offline before a clean disconnect, which does not trigger the last will."""
+        if self.status_topic and self.mqtt_client.is_connected():
+            self._publish_status(OFFLINE)
+
+    def _record(self, message: OutboundMessage, outcome: int) -> None:
+        if self.journal is not None:
+            self.journal.outcome(message, outcome)
+
+    def _on_discard(self, message: OutboundMessage) -> None:
+        self.tracker.discarded(message)
+        self._record(message, DROPPED)
+
+    def _on_published(self, mid: int) -> None:
+        message = self.tracker.acknowledged(mid)
+        if message is not None:
+            self.acknowledged += 1
+            self.latency.record(message.pin, "ack", message.timestamp, time.monotonic())
+            self._record(message, ACKED)
+
+    def _new_route(self, pin: int, name: str) -> SensorRoute:
+        return SensorRoute(name, self.topics.topics_for(pin, name), self.payload_format, pin)
+
+    def compile_routes(self, sensors: dict) -> None:
+        """Resolve the topics and payloads of all the sensors, ``pin -> name``, before their first change."""
+        self.routes = {pin: self._new_route(pin, name) for pin, name in sensors.items()}
+
+    def _route(self, pin: int, name: str) -> SensorRoute:
+        route = self.routes.get(pin)
+        if route is None or route.name != name:
+            route = self.routes[pin] = self._new_route(pin, name)
+        return route
+
+    def _state_messages(self, pin: int, name: str, value: int, qos: int, timestamp) -> list:
+        """One message per topic of the sensor, the first on its main topic."""
+        route = self._route(pin, name)
+        payload = route.payloads[value]
+        if timestamp is None:
+            timestamp = time.monotonic()
+        return [
+            OutboundMessage(topic, payload, qos, self.retain, pin=pin, timestamp=timestamp, seq=next(self.sequence))
+            for topic in route.topics
+        ]
+
+    def _to_outbound(self, msg) -> list:
+        return self._state_messages(msg.pin, msg.name, int(msg.status != "closed"), msg.qos, msg.timestamp)
+
+    def _enqueue(self, message: OutboundMessage, state: bool = False) -> None:
+        """
+        Queue a message.  Only the ``state`` messages (sensors, zones) are
+        tracked for the resync after a reconnect: an event, a tag or an
+        access decision lost with the connection must not be replayed later.
+        """
+        if self.inline_drain and self.queue.full():
+            self.drain(timeout=0, flush=True)
+        if state:
+            self.tracker.queued(message)
+        if self.staged or self.thread is None and not self.inline_drain and self.queue.full() \
+                and self.queue.policy is OverflowPolicy.BLOCK:
+            self.staged.append(message)
+        else:
+            self.queue.put(message)
+        self.latency.record(message.pin, "enqueue", message.timestamp, time.monotonic())
+
+    def _unstage(self) -> None:
+        """Queue the messages held until the publisher started, in order."""
+        staged, self.staged = self.staged, []
+        for message in staged:
+            if self.inline_drain and self.queue.full():
+                self.drain(timeout=0, flush=True)
+            self.queue.put(message)
 
     def publish_message(self, msg) -> None:
-        msg_str = msg.to_dict()
-        topic = msg.name + self.topic_suffix
-        self.logger.debug(f"Message requests for: {json.dumps(msg_str)}")
-        self.mqtt_client.publish_message(self._get_topic(topic), msg.status, msg.qos)
+        """
+        Queue the message for the publisher thread.  Depending on the queue
+        overflow policy this call can only block when the policy is ``block``.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Message requests for: {json.dumps(msg.to_dict())}")
+        self.publish_state(msg.pin, msg.name, int(msg.status != "closed"), msg.timestamp, msg.qos)
+
+    def publish_state(self, pin: int, name: str, value: int, timestamp: float = None, qos: int = 2) -> None:
+        """
+        Queue a state change (``value`` 0 closed, 1 open) like
+        :meth:`publish_message`, without building a :class:`MessageModel`:
+        the topics and the payloads of the sensor come from the routing table.
+        """
+        messages = self._state_messages(pin, name, value, qos, timestamp)
+        if self.journal is not None:
+            self.journal.changed(messages[0], value)
+        for message in messages:
+            self._enqueue(message, state=True)
+
+    def publish_zone(self, zone: Zone, timestamp: float = None, snapshot: bool = False) -> None:
+        """
+        Queue the state of a zone.  A ``snapshot`` state is queued only when
+        the snapshot is enabled and the broker does not already have it.
+        """
+        if snapshot and not self.snapshot:
+            return
+        message = OutboundMessage(
+            self.topics.zone_topic(zone.name),
+            encode_zone(self.payload_format, zone.name, zone.active, zone.open, len(zone.pins)),
+            2,
+            self.retain,
+            timestamp=timestamp if timestamp is not None else time.monotonic(),
+            seq=next(self.sequence),
+        )
+        if snapshot and self.tracker.is_delivered(message):
+            return
+        self._enqueue(message, state=True)
+
+    def digest_in(self, now: float):
+        """Seconds before the next digest is due, ``None`` when the digests are disabled."""
+        if self.digest_interval <= 0:
+            return None
+        return max(0.0, self.next_digest - now)
+
+    def publish_digest(self, values: list, now: float) -> None:
+        """
+        Queue the digest of the sensor states, ``values`` in pin order, and
+        schedule the next one.  No digest is queued while offline: it would
+        be stale by the time the spool is replayed.
+        """
+        self.next_digest = now + self.digest_interval
+        if not self.mqtt_client.is_connected():
+            return
+        self._enqueue(OutboundMessage(
+            self._get_topic(self.digest_topic),
+            encode_digest(self.payload_format, next(self.digest_sequence), values),
+            timestamp=now,
+            seq=next(self.sequence),
+        ))
+        self.digests += 1
+
+    def publish_fault(self, pin: int, name: str, fault: str, active: bool) -> None:
+        """Queue a line fault raised or cleared on ``alarm/<name>/fault/<fault>``."""
+        self._enqueue(OutboundMessage(
+            self._get_topic(f"{name}/fault/{fault}"),
+            encode_fault(self.payload_format, pin, name, fault, FAULTS.index(fault), active),
+            1,
+            self.retain,
+            timestamp=time.monotonic(),
+            seq=next(self.sequence),
+        ))
+
+    def _publish_event(self, sub_topic: str, payload) -> None:
+        self._enqueue(OutboundMessage(
+            self._get_topic(sub_topic),
+            payload,
+            1,
+            timestamp=time.monotonic(),
+            seq=next(self.sequence),
+        ))
+
+    def publish_tag(self, reader: str, uid: bytes) -> None:
+        """Queue the read of a tag on ``alarm/<reader>/tag``."""
+        self._publish_event(f"{reader}/tag", encode_tag(self.payload_format, reader, uid))
+
+    def publish_access(self, reader: str, uid: bytes, label) -> None:
+        """Queue the decision on a tag on ``alarm/<reader>/access``; ``label`` is ``None`` for a denied tag."""
+        self._publish_event(f"{reader}/access", encode_access(self.payload_format, reader, uid, label))
+
+    def subscribe(self, topic: str, callback) -> None:
+        self.mqtt_client.subscribe(topic, callback)
+
+    def apply_config(self, config: MqttConfig) -> bool:
+        """Apply the publishing settings of a new configuration; returns whether the client reconnects."""
+        old = self.mqtt_client.config
+        restart = [name for name in self.RESTART_SETTINGS if getattr(old, name) != getattr(config, name)]
+        if restart:
+            self.logger.warning("MQTT settings %s take effect after a restart", ", ".join(restart))
+        self.batch_size = config.batch_size
+        self.retain = config.retain
+        self.snapshot = config.publish_snapshot
+        self.status_topic = config.status_topic
+        self.digest_topic = config.digest_topic
+        if config.digest_interval != self.digest_interval:
+            self.digest_interval = config.digest_interval
+            self.next_digest = 0.0
+        if self.payload_format is not PayloadFormat(config.payload_format) or any(
+            getattr(old, name) != getattr(config, name) for name in self.TOPIC_SETTINGS
+        ):
+            self.payload_format = PayloadFormat(config.payload_format)
+            self.topics = TopicTable.from_config(config)
+            self.routes.clear()
+        return self.mqtt_client.reconfigure(config)
+
+    def publish_snapshot(self, messages) -> None:
+        """Queue the current state of every sensor, skipping the states the broker already has."""
+        if not self.snapshot:
+            return
+        queued = 0
+        for msg in messages:
+            for message in self._to_outbound(msg):
+                if not self.tracker.is_delivered(message):
+                    self._enqueue(message, state=True)
+                    queued += 1
+        self.logger.info("Queued startup snapshot of %d sensor topics", queued)
+
+    def _send(self, message: OutboundMessage) -> None:
+        mid = self.mqtt_client.publish_message(
+            message.topic, message.payload, message.qos, message.retain, message.user_properties()
+        )
+        now = time.monotonic()
+        self.latency.record(message.pin, "publish", message.timestamp, now)
+        self._record(message, PUBLISHED)
+        if self.tracker.sent(message, mid) is not None:
+            self.acknowledged += 1
+            self.latency.record(message.pin, "ack", message.timestamp, now)
+            self._record(message, ACKED)
+
+    def resync(self) -> None:
+        """
+        After a reconnection republish only the states that differ from the
+        ones acknowledged by the broker and that are not already on their way.
+        """
+        self.resync_requested = False
+        for message in self.tracker.out_of_sync():
+            self.tracker.queued(message)
+            try:
+                self._send(message)
+                self.republished += 1
+            except Exception as e:
+                self.tracker.discarded(message)
+                self.logger.error(f"Unable to republish on {message.topic}: {e}")
+
+    def _must_spool(self) -> bool:
+        return self.spool is not None and (self.spool.depth > 0 or not self.mqtt_client.is_connected())
+
+    def replay_spool(self) -> None:
+        """Publish the spooled messages in order, stopping if the connection drops again."""
+        started = time.monotonic()
+        sent = 0
+        for message in self.spool.pending():
+            if not self.mqtt_client.is_connected():
+                break
+            try:
+                self._send(message)
+            except Exception as e:
+                self.logger.error(f"Unable to replay message on {message.topic}: {e}")
+                break
+            sent += 1
+        self.spool.consume(sent)
+        elapsed = time.monotonic() - started
+        self.replayed += sent
+        self.replay_rate = sent / elapsed if elapsed > 0 else float(sent)
+        self.logger.info(
+            "Replayed %d spooled messages in %.3f s (%.0f msg/s), %d left",
+            sent, elapsed, self.replay_rate, self.spool.depth,
+        )
+
+    def drain(self, timeout=None, flush: bool = False) -> int:
+        """Publish one batch of queued messages and return its size."""
+        if self.spool is not None and self.spool.depth and self.mqtt_client.is_connected():
+            self.replay_spool()
+        if self.resync_requested and self.mqtt_client.is_connected():
+            self.resync()
+        batch = self.queue.get_batch(self.batch_size, timeout, flush)
+        for message in batch:
+            try:
+                if self._must_spool():
+                    self.spool.append(message)
+                    self.spooled += 1
+                    self._record(message, SPOOLED)
+                else:
+                    self._send(message)
+                    self.published += 1
+            except Exception as e:
+                self.tracker.discarded(message)
+                self.failed += 1
+                self._record(message, FAILED)
+                self.logger.error(f"Unable to publish on {message.topic}: {e}")
+            finally:
+                self.queue.task_done()
+        if self.spool is not None:
+            self.spool.sync()
+        if self.journal is not None:
+            self.journal.flush()
+        return len(batch)
+
+    def _publish_loop(self):
+        while not self.stop_event.is_set():
+            self.drain(timeout=1.0)
+        while self.drain(timeout=0, flush=True):
+            pass
+
+    async def run_async(self) -> None:
+        """
+        Publisher of the asyncio runtime: the queue is drained on the event
+        loop whenever a message is put or a held message becomes ready.
+        When the task is cancelled the queue is flushed to the MQTT client.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self.queue.on_ready = lambda: loop.call_soon_threadsafe(ready.set)
+        self.inline_drain = True
+        self._unstage()
+        try:
+            while True:
+                ready.clear()
+                while self.drain(timeout=0):
+                    pass
+                try:
+                    await asyncio.wait_for(ready.wait(), self.queue.ready_in())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._publish_offline()
+            while self.drain(timeout=0, flush=True):
+                pass
+            self.queue.on_ready = None
+            self.inline_drain = False
+            self.log_latency()
+            if self.spool is not None:
+                self.spool.close()
+            if self.journal is not None:
+                self.journal.close()
+
+    def stats(self) -> dict:
+        return {
+            **self.queue.counters,
+            "published": self.published,
+            "acknowledged": self.acknowledged,
+            "failed": self.failed,
+            "depth": self.queue.qsize() + len(self.staged),
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "republished": self.republished,
+            "replay_rate": self.replay_rate,
+            "spool_depth": self.spool.depth if self.spool is not None else 0,
+            "digests": self.digests,
+        }
+
+    def log_latency(self) -> None:
+        for pin, stages in self.latency.report().items():
+            self.logger.info("GPIO%s latency: %s", pin, ", ".join(
+                f"{stage} p50={s['p50'] * 1000:.1f}ms p99={s['p99'] * 1000:.1f}ms max={s['max'] * 1000:.1f}ms"
+                for stage, s in stages.items()
+            ))
 
     def connect(self) -> None:
         self.mqtt_client.connect()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._publish_loop, daemon=True)
+        self.thread.start()
+        self._unstage()
 
     def disconnect(self) -> None:
+        self._publish_offline()
+        if self.thread is not None:
+            self.stop_event.set()
+            self.queue.wake()
+            self.thread.join()
+            self.thread = None
+        self.log_latency()
         self.mqtt_client.disconnect()
+        if self.spool is not None:
+            self.spool.close()
+        if self.journal is not None:
+            self.journal.close()
+
+
+class SensorState:
+    """What is known of one sensor: its chip, name, last value and debounce."""
+
+    __slots__ = ("pin", "name", "chip", "value", "debouncer")
+
+    def __init__(self, pin: int, name: str, chip: str, value: int = -1):
+        self.pin = pin
+        self.name = name
+        self.chip = chip
+        # -1 until the line has been read
+        self.value = value
+        self.debouncer = None
 
 
 class SensorsService:
+    # Settings of the fault detection: a change starts the statistics again
+    FAULT_SETTINGS = ("fault_window", "fault_transitions", "fault_bounces", "fault_stuck")
 
-    def __init__(self, sensors_config: SensorsConfig, mqtt_service: MqttService):
+    def __init__(
+        self, sensors_config: SensorsConfig, mqtt_service: MqttService, gpio_backend=None, i2c_backend=None
+    ):
         self.logger = logging.getLogger(__name__)
         self.config = sensors_config
         self.mqtt_service = mqtt_service
-        self.lines = {}
-        self.last_values = {}
-        self.last_change = defaultdict(float)
-        self.DEBOUNCE_TIME = 0.05
+        # Module with the gpiod API, e.g. app.fake_gpiod for the simulator; the real gpiod when None
+        self.gpio_backend = gpio_backend
+        # Module with an SMBus class for the expanders, e.g. app.fake_expander; smbus2 when None
+        self.i2c_backend = i2c_backend
+        self.i2c_buses = {}
+        # chip -> (InputDriver, SensorState of each of its pins in the same order)
+        self.drivers = {}
+        # pin -> SensorState
+        self.states = {}
+        self.zones = ZoneEngine(sensors_config.zones, sensors_config.sensors)
+        self.faults = FaultDetector(sensors_config)
+        self.next_fault_check = 0.0
+        self.hardware_debounced = set()
+        self.edge_mode = False
+        self.edge_fds = {}
+        # chips without edge events, sampled every poll_interval between the events of the others
+        self.polled_chips = set()
+        self.next_poll = 0.0
+        self.connected = False
+        # False when the lines are read by worker processes, which report their changes with apply_change
+        self.local = True
+        self.pending = set()
+        self.iterations = 0
+        self.iteration_seconds = 0.0
+        self.reads = 0
+        self.read_seconds = 0.0
 
     def name_from_pin(self, pin: int) -> str:
         return self.config.sensors[pin]
 
     @property
     def is_real_board(self) -> bool:
-        return self.config.is_real_board
+        return self.config.is_real_board()
 
-    def connect_sensors(self):
-        if not self.is_real_board:
-            self.logger.info("Mock mode enabled. Real GPIO excluded")
+    @property
+    def gpiod(self):
+        return self.gpio_backend if self.gpio_backend is not None else gpiod
+
+    def _i2c_bus(self, number: int):
+        bus = self.i2c_buses.get(number)
+        if bus is None:
+            backend = self.i2c_backend if self.i2c_backend is not None else smbus2
+            if backend is None:
+                raise OSError("smbus2 is needed by the I2C expanders")
+            bus = self.i2c_buses[number] = backend.SMBus(number)
+        return bus
+
+    def _driver(self, chip: str, pins: list) -> InputDriver:
+        expander = self.config.expanders.get(chip)
+        if expander is None:
+            return GpiodDriver(chip, pins, self.gpiod, self.config)
+        return EXPANDERS[expander.kind](chip, pins, expander, self._i2c_bus(expander.bus), self.gpiod, self.config.chip)
+
+    def _debouncer(self, pin: int) -> Debouncer:
+        state = self.states[pin]
+        if state.debouncer is None:
+            settle = 0.0 if pin in self.hardware_debounced else self.config.debounce_for(pin)
+            state.debouncer = Debouncer(settle, self.config.debounce_samples)
+        return state.debouncer
+
+    def _gpio_available(self) -> bool:
+        if self.gpio_backend is None:
+            if not self.is_real_board:
+                self.logger.info("Mock mode enabled. Real GPIO excluded")
+                return False
+            if not GPIOD_AVAILABLE:
+                self.logger.warning("gpiod not available. Force use mock.")
+                return False
+        return True
+
+    def _connect_chip(self, chip: str, pins: list) -> None:
+        """Open the driver of a chip; the pins already known keep their last value."""
+        driver = self._driver(chip, pins)
+        driver.open()
+        if driver.hardware_debounced:
+            self.hardware_debounced.update(pins)
+        if driver.fd is None:
+            self.polled_chips.add(chip)
+        else:
+            self.edge_fds[driver.fd] = chip
+        states = []
+        for pin, value in zip(pins, driver.read()):
+            name = self.name_from_pin(pin)
+            state = self.states.get(pin)
+            if state is None:
+                state = self.states[pin] = SensorState(pin, name, chip, value)
+            state.chip = chip
+            states.append(state)
+            self.logger.info(f"Sensor {name} on GPIO {pin} ({chip}) connected.")
+        self.drivers[chip] = (driver, states)
+
+    def _release_chip(self, chip: str) -> None:
+        driver, _ = self.drivers.pop(chip)
+        self.edge_fds.pop(driver.fd, None)
+        self.polled_chips.discard(chip)
+        self.hardware_debounced.difference_update(driver.pins)
+        driver.close()
+
+    def _update_edge_mode(self) -> None:
+        self.edge_mode = bool(self.edge_fds)
+        if self.edge_mode and self.polled_chips:
+            self.logger.info("GPIO mode: edge events, %d chips polled", len(self.polled_chips))
+        else:
+            self.logger.info("GPIO mode: %s", "edge events" if self.edge_mode else "polling")
+
+    def connect_sensors(self, initial: dict = None):
+        """
+        Request the lines, read the state of the sensors and queue the
+        snapshot; only the first call does it.  ``initial`` holds the values
+        read before the services were built (``pin -> value``): the snapshot
+        reports them, and a sensor that changed since is published as any
+        other change.
+        """
+        if self.connected:
             return
-        if not GPIOD_AVAILABLE:
-            self.logger.warning("gpiod not available. Force use mock.")
+        self.connected = True
+        self.mqtt_service.compile_routes(self.config.sensors)
+        if not self._gpio_available():
             return
-        try:
-            for pin, name in self.config.sensors.items():
-                request = gpiod.request_lines(
-                    "/dev/gpiochip0",
-                    consumer=name,
-                    config={
-                        pin: gpiod.LineSettings(
-                            direction=gpiod.line.Direction.INPUT,
-                            bias=gpiod.line.Bias.PULL_UP,
-                        )
-                    },
-                )
-                self.lines[pin] = (request, name)
-                self.last_values[pin] = request.get_value(pin).value
-                self.logger.info(f"Sensor {name} on GPIO {pin} connected.")
-        except Exception as e:
-            self.logger.error(f"Error on GPIO: {e}. Try to use isrealboard=false.")
+        for chip, pins in self.config.pins_by_chip().items():
+            try:
+                self._connect_chip(chip, pins)
+            except Exception as e:
+                self.logger.error(f"Error on {chip}: {e}. Try to use isrealboard=false.")
+        for pin, value in (initial or {}).items():
+            if pin in self.states:
+                self.states[pin].value = value
+        self._update_edge_mode()
+        self.zones.reset(self._values())
+        self.publish_snapshot()
+        if initial:
+            for chip in self.drivers:
+                self._sample(chip)
+
+    def _changed_chips(self, old: SensorsConfig, new: SensorsConfig) -> set:
+        """Chips whose line request must be replaced to apply ``new``."""
+        old_chips, new_chips = old.pins_by_chip(), new.pins_by_chip()
+        if (old.edge_detection, old.hardware_debounce) != (new.edge_detection, new.hardware_debounce):
+            return set(old_chips) | set(new_chips)
+        changed = set()
+        for chip in old_chips.keys() | new_chips.keys():
+            pins = new_chips.get(chip, [])
+            if old_chips.get(chip) != pins or old.expanders.get(chip) != new.expanders.get(chip) or \
+                    new.hardware_debounce and any(
+                old.debounce_for(pin) != new.debounce_for(pin) for pin in pins
+            ):
+                changed.add(chip)
+        return changed
+
+    def apply_config(self, sensors_config: SensorsConfig) -> None:
+        """
+        Switch to a new configuration without a restart.  Only the chips
+        whose lines changed are released and requested again; the sensors
+        that did not change keep their last value and debounce state, and a
+        change they had while their chip was re-requested is published.
+        """
+        old, self.config = self.config, sensors_config
+        self.mqtt_service.compile_routes(sensors_config.sensors)
+        for pin in old.sensors.keys() - sensors_config.sensors.keys():
+            self.states.pop(pin, None)
+            self.pending.discard(pin)
+            self.faults.forget(pin)
+        if any(getattr(old, name) != getattr(sensors_config, name) for name in self.FAULT_SETTINGS):
+            self._clear_faults()
+            self.faults = FaultDetector(sensors_config)
+        for pin, state in self.states.items():
+            state.name = sensors_config.sensors[pin]
+            if old.debounce_for(pin) != sensors_config.debounce_for(pin) \
+                    or old.debounce_samples != sensors_config.debounce_samples:
+                state.debouncer = None
+        if self.local and (self.drivers or self._gpio_available()):
+            self._reconnect_chips(old, sensors_config)
+        # once the chips are requested, so the sensors added count with the value read
+        if (old.zones, old.sensors) != (sensors_config.zones, sensors_config.sensors):
+            self._rebuild_zones()
+
+    def _reconnect_chips(self, old: SensorsConfig, sensors_config: SensorsConfig) -> None:
+        new_chips = sensors_config.pins_by_chip()
+        changed = self._changed_chips(old, sensors_config)
+        added = sensors_config.sensors.keys() - old.sensors.keys()
+        for chip in changed:
+            try:
+                hardware_debounced = set(self.hardware_debounced)
+                if chip in self.drivers:
+                    self._release_chip(chip)
+                if chip in new_chips:
+                    self._connect_chip(chip, new_chips[chip])
+                    # the device took over the debounce of a pin, or gave it back
+                    for pin in hardware_debounced ^ self.hardware_debounced:
+                        self.states[pin].debouncer = None
+                    self._sample(chip)
+            except Exception as e:
+                self.logger.error(f"Error on {chip}: {e}. Its sensors are not read until the next reload.")
+                self._drop_chip(chip, new_chips.get(chip, []))
+        self._update_edge_mode()
+        self.mqtt_service.publish_snapshot(
+            MessageModel(status=self._status(self.states[pin].value), pin=pin, name=self.states[pin].name, qos=2)
+            for pin in added if pin in self.states
+        )
+
+    def _drop_chip(self, chip: str, pins: list) -> None:
+        """Forget a chip that could not be requested again, and the sensors on it."""
+        if chip in self.drivers:
+            with contextlib.suppress(Exception):
+                self._release_chip(chip)
+        for pin in set(pins) | {pin for pin, state in self.states.items() if state.chip == chip}:
+            self.states.pop(pin, None)
+            self.pending.discard(pin)
+
+    def _publish_faults(self, flips: list) -> None:
+        for pin, fault, active in flips:
+            name = self.config.sensors.get(pin, str(pin))
+            self.mqtt_service.publish_fault(pin, name, fault, active)
+            if active:
+                self.logger.warning("%s GPIO%d: %s fault", name, pin, fault)
+            else:
+                self.logger.info("%s GPIO%d: %s fault cleared", name, pin, fault)
+
+    def _clear_faults(self) -> None:
+        """Clear the active faults, whose statistics are about to be dropped."""
+        self._publish_faults([
+            (pin, fault, False)
+            for pin, line in self.faults.lines.items() if pin in self.states
+            for fault in line.faults
+        ])
+
+    def _values(self) -> dict:
+        return {pin: state.value for pin, state in self.states.items()}
+
+    def _rebuild_zones(self) -> None:
+        """Evaluate the zones of the new configuration and publish those that are new or changed state."""
+        previous = {name: zone.active for name, zone in self.zones.zones.items()}
+        self.zones = ZoneEngine(self.config.zones, self.config.sensors)
+        self.zones.reset(self._values())
+        for name, zone in self.zones.zones.items():
+            if previous.get(name) is not zone.active:
+                self.mqtt_service.publish_zone(zone)
+
+    @staticmethod
+    def _status(value: int) -> str:
+        return "closed" if value == 0 else "open"
+
+    def publish_snapshot(self) -> None:
+        self.mqtt_service.publish_snapshot(
+            MessageModel(status=self._status(state.value), pin=pin, name=state.name, qos=2)
+            for pin, state in self.states.items()
+        )
+        for zone in self.zones.zones.values():
+            self.mqtt_service.publish_zone(zone, snapshot=True)
+
+    def _sample(self, chip: str, timestamps=None) -> None:
+        driver, states = self.drivers[chip]
+        started = time.perf_counter()
+        values = driver.read()
+        self.read_seconds += time.perf_counter() - started
+        self.reads += 1
+        now = time.monotonic()
+        for state, value in zip(states, values):
+            if value == state.value and (state.debouncer is None or not state.debouncer.pending):
+                # nothing changed and nothing pending: the common case costs one comparison
+                continue
+            event_time = timestamps.get(state.pin, now) if timestamps else now
+            self._update_sensor(state, value, event_time)
+
+    def _update_sensor(self, state: SensorState, value: int, now: float) -> None:
+        pin = state.pin
+        debouncer = state.debouncer or self._debouncer(pin)
+        rejected = debouncer.rejected
+        if not debouncer.accept(state.value, value, now):
+            if debouncer.rejected != rejected:
+                self._publish_faults(self.faults.bounced(pin, now))
+            if debouncer.pending:
+                self.pending.add(pin)
+            else:
+                self.pending.discard(pin)
+            return
+        self.pending.discard(pin)
+        if state.value != -1:
+            self._publish_faults(self.faults.changed(pin, now))
+        self._publish_change(state, value, now)
+
+    def _publish_change(self, state: SensorState, value: int, now: float) -> None:
+        """Publish an accepted change and update the zones of the sensor."""
+        self.mqtt_service.publish_state(state.pin, state.name, value, now)
+        self.logger.info("%s GPIO%d: %s", state.name, state.pin, self._status(value))
+        for zone in self.zones.update(state.pin, state.value, value):
+            self.mqtt_service.publish_zone(zone, now)
+            self.logger.info("Zone %s: %s (%d/%d open)", zone.name, zone.status, zone.open, len(zone.pins))
+        state.value = value
+
+    def _remote_state(self, pin: int) -> SensorState:
+        state = self.states.get(pin)
+        if state is None:
+            state = self.states[pin] = SensorState(pin, self.name_from_pin(pin), self.config.chip_for(pin))
+        return state
+
+    def apply_change(self, pin: int, value: int, now: float) -> None:
+        """
+        A change read and debounced by a worker process (see
+        :mod:`app.supervisor`): published and aggregated in the zones like
+        a change of a local line; its faults are detected by the worker.
+        """
+        if pin in self.config.sensors:
+            self._publish_change(self._remote_state(pin), value, now)
+
+    def apply_snapshot(self, values: dict, now: float) -> None:
+        """
+        The values read by a worker process when it starts, ``pin -> value``.
+        After a restart of the worker the sensors that changed meanwhile
+        are published as changes, then the snapshot is queued.
+        """
+        for pin, value in values.items():
+            if pin not in self.config.sensors:
+                continue
+            state = self._remote_state(pin)
+            if state.value == -1:
+                state.value = value
+            elif state.value != value:
+                self._publish_change(state, value, now)
+        self.zones.reset(self._values())
+        self.mqtt_service.publish_snapshot(
+            MessageModel(status=self._status(self.states[pin].value), pin=pin, name=self.states[pin].name, qos=2)
+            for pin in values if pin in self.states
+        )
+        for zone in self.zones.zones.values():
+            self.mqtt_service.publish_zone(zone, snapshot=True)
 
     def check_sensors(self):
-        if not self.lines:
+        if not self.drivers:
             return
-        for pin, (request, name) in self.lines.items():
-            raw_value = request.get_value(pin)
-            value = raw_value.value if hasattr(raw_value, "value") else raw_value
-            now = time.time()
-            if (
-                value != self.last_values.get(pin, -1)
-                and now - self.last_change[pin] > self.DEBOUNCE_TIME
-            ):
-                status = "closed" if value == 0 else "open"
-                self.mqtt_service.publish_message(
-                    MessageModel(status=status, pin=pin, name=name, qos=2)
-                )
-                self.logger.info(f"{name} GPIO{pin}: {status}")
-                self.last_values[pin] = value
-                self.last_change[pin] = now
+        started = time.perf_counter()
+        for chip in self.drivers:
+            self._sample(chip)
+        self.iterations += 1
+        self.iteration_seconds += time.perf_counter() - started
+
+    @property
+    def debounce_rejections(self) -> int:
+        return sum(state.debouncer.rejected for state in self.states.values() if state.debouncer is not None)
+
+    def wait_events(self, timeout=None) -> None:
+        """
+        Block on the file descriptors of the drivers until a change is
+        reported (or ``timeout`` seconds elapse) and publish the changes.
+        Pins whose last change was held back by the debounce are sampled
+        again as soon as their debounce allows it, and the chips without
+        edge events every ``poll_interval``.  The time reported by the
+        driver (the kernel timestamp of the edge) is the time of a change.
+        """
+        if not self.edge_mode:
+            return
+        retry = self.wake_in()
+        if retry is not None:
+            timeout = retry if timeout is None else min(timeout, retry)
+        ready, _, _ = select.select(list(self.edge_fds), [], [], timeout)
+        self.handle_events(ready)
+
+    def retry_in(self):
+        """Seconds before a pin held back by the debounce must be sampled again, ``None`` if there is none."""
+        if not self.pending:
+            return None
+        now = time.monotonic()
+        return min(self._debouncer(pin).retry_in(now) for pin in self.pending)
+
+    def poll_in(self):
+        """Seconds before the chips without edge events must be sampled, ``None`` if there is none."""
+        if not self.polled_chips:
+            return None
+        return max(0.0, self.next_poll - time.monotonic())
+
+    def wake_in(self):
+        """Seconds before :meth:`handle_events` must run without an event, ``None`` if never."""
+        delays = [delay for delay in (self.retry_in(), self.poll_in()) if delay is not None]
+        return min(delays) if delays else None
+
+    def handle_events(self, ready) -> None:
+        """
+        Read the events of the ready file descriptors and sample their
+        chips, the pending pins and, when they are due, the polled chips.
+        """
+        started = time.perf_counter()
+        chips = {self.states[pin].chip for pin in self.pending}
+        if self.polled_chips:
+            now = time.monotonic()
+            if now >= self.next_poll:
+                chips.update(self.polled_chips)
+                self.next_poll = now + self.config.poll_interval
+        timestamps = {}
+        for fd in ready:
+            chip = self.edge_fds[fd]
+            timestamps.update(self.drivers[chip][0].events())
+            chips.add(chip)
+        for chip in chips:
+            self._sample(chip, timestamps)
+        self.iterations += 1
+        self.iteration_seconds += time.perf_counter() - started
+
+    def publish_digest(self, now: float):
+        """
+        Queue the digest of the state of every sensor when it is due and
+        return the seconds before the next one (``None`` when disabled).
+        A sensor not read yet counts as open, like in the snapshot.
+        """
+        due = self.mqtt_service.digest_in(now)
+        if due == 0:
+            self.mqtt_service.publish_digest(
+                [self.states[pin].value != 0 if pin in self.states else True for pin in sorted(self.config.sensors)],
+                now,
+            )
+            due = self.mqtt_service.digest_in(now)
+        return due
+
+    def check_faults(self, now: float) -> None:
+        """Raise the stuck lines and clear the faults whose rate went back below the threshold."""
+        if self.faults.enabled:
+            self._publish_faults(self.faults.check(self.states, now))
+
+    def supervise(self, now: float):
+        """
+        Periodic checks of the main loop: the faults, at most every
+        :data:`app.faults.CHECK_INTERVAL`, and the digest; returns the
+        seconds before the digest.
+        """
+        if now >= self.next_fault_check:
+            self.check_faults(now)
+            self.next_fault_check = now + FAULT_CHECK_INTERVAL
+        return self.publish_digest(now)
 
     def close(self):
-        for request, _ in self.lines.values():
-            request.release()
+        for driver, _ in self.drivers.values():
+            driver.close()
+        for bus in self.i2c_buses.values():
+            bus.close()
+        self.i2c_buses.clear()
+
+
+class RfidReader:
+    """Poll schedule of one reader and the last tag it read."""
+
+    __slots__ = ("name", "device", "interval", "next_poll", "last_uid", "last_seen")
+
+    def __init__(self, name: str, device: MFRC522, interval: float):
+        self.name = name
+        self.device = device
+        self.interval = interval
+        self.next_poll = 0.0
+        self.last_uid = None
+        self.last_seen = 0.0
 
 
 class RfidService:
+    """
+    Polls the MFRC522 readers sharing the SPI bus and publishes the UID of
+    every tag read.  The due readers are woken together, so their radio
+    timeouts overlap, and only the ones that got an answer run the select.
+    A reader with a tag is polled every ``poll_min_interval`` seconds; an
+    idle one backs off up to ``poll_max_interval``.
 
-    def __init__(self, rfid_config: RfidConfig):
+    A tag held on a reader is published once: it is read again only after
+    it has been away for ``dedup_window`` seconds.  With an allow-list the
+    service also decides locally whether the tag may arm and disarm.
+    """
+
+    def __init__(self, rfid_config: RfidConfig, mqtt_service: MqttService, transport=None):
+        self.logger = logging.getLogger(__name__)
         self.config = rfid_config
+        self.mqtt_service = mqtt_service
+        self.transport = transport
+        # a transport built from the config is built again when the config changes
+        self.own_transport = False
+        self.readers = []
+        self.reads = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.allow_list = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def load_allow_list(self) -> None:
+        if not (self.config.allow_list or self.config.allow_list_topic):
+            return
+        self.allow_list = AllowList()
+        if self.config.allow_list:
+            self.allow_list.load_file(self.config.allow_list)
+        if self.config.allow_list_topic:
+            self.mqtt_service.subscribe(self.config.allow_list_topic, self.allow_list.load_payload)
 
     def connect_sensors(self):
-        self.logger = logging.getLogger(__name__)
-        self.logger.info("RfidService: connect_sensors (not yet implemented)")
+        if not self.config.sensors:
+            return
+        self.load_allow_list()
+        if self.transport is None:
+            if not (SPIDEV_AVAILABLE and GPIOD_AVAILABLE):
+                self.logger.warning("spidev or gpiod not available. RFID readers disabled.")
+                return
+            self.transport = SpidevTransport(
+                self.config.spi_bus, self.config.spi_device, self.config.spi_speed, self.config.chip
+            )
+            self.own_transport = True
+        pins = [pin for sensor in self.config.sensors.values() for pin in (sensor.cs_pin, sensor.rst_pin)]
+        try:
+            self.transport.open(pins)
+        except Exception as e:
+            self.logger.error(f"Error on SPI bus: {e}. RFID readers disabled.")
+            self.transport = None
+            return
+        for name, sensor in self.config.sensors.items():
+            device = MFRC522(self.transport, sensor.cs_pin, sensor.rst_pin)
+            version = device.init()
+            if version in (0x00, 0xFF):
+                self.logger.error(f"RFID reader {name} (CS {sensor.cs_pin}) does not answer.")
+                continue
+            self.readers.append(RfidReader(name, device, self.config.poll_min_interval))
+            self.logger.info(f"RFID reader {name} (CS {sensor.cs_pin}, version 0x{version:02X}) connected.")
 
+    def _read(self, reader: RfidReader):
+        try:
+            answer = None
+            deadline = time.monotonic() + TRANSCEIVE_TIMEOUT
+            while answer is None and time.monotonic() < deadline:
+                answer = reader.device.poll_transceive()
+            if not answer:
+                return None
+            uid = reader.device.select()
+            if uid is not None:
+                reader.device.halt()
+            return uid
+        except RfidError as e:
+            self.errors += 1
+            self.logger.debug(f"RFID reader {reader.name}: {e}")
+            return None
 
-class MockSensorService:
-    def __init__(self, sensors_service: SensorsService):
-        self.thread = None
-        self.interval = 30
-        self.sensors_service = sensors_service
-        self.logger = logging.getLogger(__name__)
-        self.stop_event = threading.Event()
-        self.mock_states = {pin: 1 for pin in sensors_service.config.sensors.keys()}
+    def poll(self, now: float) -> float:
+        """Poll the due readers and return the seconds before the next one is due."""
+        due = [reader for reader in self.readers if reader.next_poll <= now]
+        for reader in due:
+            reader.device.start_wake()
+        for reader in due:
+            uid = self._read(reader)
+            if uid is None:
+                reader.interval = min(reader.interval * self.config.poll_backoff, self.config.poll_max_interval)
+            else:
+                reader.interval = self.config.poll_min_interval
+                self._on_tag(reader, uid, now)
+            reader.next_poll = now + reader.interval
+        if not self.readers:
+            return self.config.poll_max_interval
+        return max(0.0, min(reader.next_poll for reader in self.readers) - time.monotonic())
 
-    def _toggle_state(self):
-        time.sleep(10)
-        while not self.stop_event.is_set():
-            for pin, name in self.sensors_service.config.sensors.items():
-                new_value = 0 if self.mock_states[pin] == 1 else 1
-                self.mock_states[pin] = new_value
-                status = "closed" if new_value == 0 else "open"
-                self.logger.debug(f"[MOCK] {name} GPIO{pin}: {status}")
-                self.sensors_service.mqtt_service.publish_message(
-                    MessageModel(status=status, pin=pin, name=name, qos=2)
-                )
-            time.sleep(self.interval)
-
-    def start(self):
-        self.thread = threading.Thread(target=self._toggle_state, daemon=True)
+    def _on_tag(self, reader: RfidReader, uid: bytes, now: float) -> None:
+        held = uid == reader.last_uid and now - reader.last_seen < self.config.dedup_window
+        reader.last_uid = uid
+        reader.last_seen = now
+        if held:
+            self.duplicates += 1
+            return
+        self.reads += 1
+        self.logger.info(f"RFID reader {reader.name}: tag {uid.hex().upper()}")
+        if self.allow_list is not None:
+            self.mqtt_service.publish_access(reader.name, uid, self.allow_list.lookup(uid))
+        self.mqtt_service.publish_tag(reader.name, uid)
+
+    def _poll_loop(self):
+        while not self.stop_event.wait(self.poll(time.monotonic())):
+            pass
+
+    def start(self) -> None:
+        if not self.readers or self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._poll_loop, daemon=True)
         self.thread.start()
 
-    def stop(self):
+    async def run_async(self) -> None:
+        """Poll the readers as a task of the asyncio runtime instead of a thread."""
+        import asyncio
+
+        while self.readers:
+            await asyncio.sleep(self.poll(time.monotonic()))
+
+    def stop(self) -> None:
         self.stop_event.set()
-        self.thread.join()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.transport is not None:
+            self.transport.close()
+
+    def apply_config(self, rfid_config: RfidConfig) -> None:
+        """
+        Connect the readers of a new configuration.  The poll thread is
+        stopped and the bus closed first; :meth:`start` starts it again.
+        """
+        self.stop()
+        if self.own_transport:
+            # the SPI bus, device, speed or chip may have changed
+            self.transport = None
+            self.own_transport = False
+        self.config = rfid_config
+        self.readers = []
+        self.allow_list = None
+        self.connect_sensors()
@@ -0,0 +1,146 @@
+import csv
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from app import fake_gpiod
+from app.models import SensorsConfig, SimulatorConfig, SimulatorMode
+
+STATES = {"0": 0, "1": 1, "closed": 0, "open": 1}
+
+
+def load_trace(path) -> list:
+    """
+    Read a trace of sensor changes: one ``seconds,pin,state`` row per
+    change, with the seconds counted from the start of the replay and the
+    state written as ``0``/``1`` or ``closed``/``open``.  Empty rows and
+    rows starting with ``#`` are skipped.
+    """
+    trace = []
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0].lstrip().startswith("#"):
+                continue
+            seconds, pin, state = (field.strip() for field in row[:3])
+            trace.append((float(seconds), int(pin), STATES[state.lower()]))
+    trace.sort(key=lambda change: change[0])
+    return trace
+
+
+class GpioSimulator:
+    """
+    Drives the lines of :mod:`app.fake_gpiod` when the adapter runs without
+    a board, so the changes go through the real sampling, debounce and
+    publishing path of :class:`app.services.SensorsService`.  Every sensor
+    changes on its own schedule (periodic, uniformly random or Poisson), a
+    change can bounce before it settles, or a recorded trace is replayed.
+    All the sensors are served by one thread with a heap of timers.
+    """
+
+    def __init__(self, sensors_config: SensorsConfig, config: SimulatorConfig):
+        self.logger = logging.getLogger(__name__)
+        self.sensors_config = sensors_config
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.sequence = itertools.count()
+        self.timers = []
+        self.trace = []
+        self.trace_end = 0.0
+        self.changes = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def _line(self, pin: int) -> fake_gpiod.FakeChip:
+        return fake_gpiod.chip(self.sensors_config.chip_for(pin))
+
+    def _schedule(self, at: float, pin: int, value=None) -> None:
+        """Queue a change of the pin to ``value``, or a new simulated change when ``value`` is None."""
+        heapq.heappush(self.timers, (at, next(self.sequence), pin, value))
+
+    def _next_delay(self, pin: int) -> float:
+        interval = self.config.interval_for(pin)
+        if self.config.mode is SimulatorMode.RANDOM:
+            return self.random.uniform(0, 2 * interval)
+        if self.config.mode is SimulatorMode.POISSON:
+            return self.random.expovariate(1 / interval)
+        return interval
+
+    def _change(self, pin: int, now: float) -> None:
+        target = 1 - self._line(pin).values.get(pin, 1)
+        self._line(pin).set_value(pin, target)
+        bounces = self.config.bounces
+        if bounces:
+            step = self.config.bounce_time / (2 * bounces)
+            for transition in range(1, 2 * bounces + 1):
+                self._schedule(now + transition * step, pin, target if transition % 2 == 0 else 1 - target)
+        self._schedule(now + self.config.bounce_time * bool(bounces) + self._next_delay(pin), pin)
+
+    def _schedule_trace(self, trace: list, start: float) -> float:
+        for seconds, pin, value in trace:
+            self._schedule(start + seconds, pin, value)
+        return start + (trace[-1][0] if trace else 0)
+
+    def _prepare(self) -> None:
+        start = time.monotonic()
+        self.trace = []
+        if self.config.mode is SimulatorMode.TRACE:
+            self.trace = load_trace(self.config.trace)
+            self.trace_end = self._schedule_trace(self.trace, start)
+            self.logger.info("Replaying %d changes from %s", len(self.trace), self.config.trace)
+        else:
+            for pin in self.sensors_config.sensors:
+                self._schedule(start + self._next_delay(pin), pin)
+
+    def _next_wait(self):
+        """Seconds before the next timer, ``None`` when the simulation is over."""
+        if not self.timers:
+            if not (self.trace and self.config.loop and self.trace[-1][0] > 0):
+                return None
+            self.trace_end = self._schedule_trace(self.trace, self.trace_end)
+        return max(0.0, self.timers[0][0] - time.monotonic())
+
+    def _fire(self) -> None:
+        at, _, pin, value = heapq.heappop(self.timers)
+        if value is None:
+            self._change(pin, at)
+        else:
+            self._line(pin).set_value(pin, value)
+        self.changes += 1
+
+    def _run(self) -> None:
+        self._prepare()
+        while not self.stop_event.is_set():
+            wait = self._next_wait()
+            if wait is None or self.stop_event.wait(wait):
+                break
+            self._fire()
+        self.logger.info("Simulator stopped after %d line changes", self.changes)
+
+    async def run_async(self) -> None:
+        """Run the simulation as a task of the asyncio runtime instead of a thread."""
+        import asyncio
+
+        self._prepare()
+        try:
+            while (wait := self._next_wait()) is not None:
+                await asyncio.sleep(wait)
+                self._fire()
+        finally:
+            self.logger.info("Simulator stopped after %d line changes", self.changes)
+
+    def start(self) -> None:
+        self.logger.info(
+            "Simulating %d sensors (%s)", len(self.sensors_config.sensors), self.config.mode.value
+        )
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
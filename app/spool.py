@@ -0,0 +1,106 @@
+import logging
+import os
+import struct
+
+from app.publisher import OutboundMessage
+
+# topic length, payload length, qos, retain
+RECORD_HEADER = struct.Struct("<HIBB")
+# Share of the spool dropped at once when it is full, so the file is rewritten
+# once every max_messages * TRIM_FRACTION appends instead of on every append
+TRIM_FRACTION = 0.1
+
+
+class MessageSpool:
+    """
+    Append-only file with the messages that could not be published while
+    the broker was unreachable.  Records are written as they arrive and
+    :meth:`sync` makes them durable with one ``fsync`` per batch.  When the
+    spool holds ``max_messages`` records the oldest tenth is discarded.
+    A record left incomplete by a power loss is ignored on the next start.
+    """
+
+    def __init__(self, path, max_messages: int = 10000):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.max_messages = max_messages
+        self.dropped = 0
+        self.dirty = False
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        records = self._read_records()
+        self.depth = len(records)
+        if self.depth:
+            self.logger.info("Found %d spooled messages in %s", self.depth, path)
+        self.file = open(path, "ab")
+
+    @staticmethod
+    def _encode(message: OutboundMessage) -> bytes:
+        topic = message.topic.encode()
+        payload = message.payload.encode() if isinstance(message.payload, str) else bytes(message.payload)
+        return RECORD_HEADER.pack(len(topic), len(payload), message.qos, message.retain) + topic + payload
+
+    def _read_records(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "rb") as f:
+            data = f.read()
+        records, offset = [], 0
+        while offset + RECORD_HEADER.size <= len(data):
+            topic_len, payload_len, qos, retain = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + topic_len + payload_len
+            if end > len(data):
+                break
+            topic = data[start:start + topic_len].decode()
+            records.append(OutboundMessage(topic, data[start + topic_len:end], qos, bool(retain)))
+            offset = end
+        return records
+
+    def _rewrite(self, records: list) -> None:
+        self.file.close()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(self._encode(record) for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "ab")
+        self.depth = len(records)
+        self.dirty = False
+
+    def append(self, message: OutboundMessage) -> None:
+        if self.depth >= self.max_messages:
+            self.sync()
+            trim = max(1, int(self.max_messages * TRIM_FRACTION))
+            keep = self._read_records()[self.depth - self.max_messages + trim:]
+            self.dropped += self.depth - len(keep)
+            self._rewrite(keep)
+        self.file.write(self._encode(message))
+        self.depth += 1
+        self.dirty = True
+
+    def sync(self) -> None:
+        if self.dirty:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def pending(self) -> list:
+        """Return the spooled messages, oldest first."""
+        self.sync()
+        return self._read_records()
+
+    def consume(self, count: int) -> None:
+        """Remove the ``count`` oldest messages once they have been published."""
+        self.sync()
+        if count >= self.depth:
+            self.file.truncate(0)
+            os.fsync(self.file.fileno())
+            self.depth = 0
+            self.dirty = False
+        elif count > 0:
+            self._rewrite(self._read_records()[count:])
+
+    def close(self) -> None:
+        self.sync()
+        self.file.close()
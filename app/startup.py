@@ -0,0 +1,127 @@
+"""
+Timing of the startup, from the start of the process to the first message
+acknowledged by the broker.  Phases are durations (imports, config, gpio,
+...); milestones are seconds since the process started (first state read,
+first publish).  The module is imported first and only uses the standard
+library (and gpiod, when the sensors are read), so the time spent importing
+the rest is measured too.
+"""
+import configparser
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+# inputs of the I2C expanders, read by their own driver
+EXPANDER_WIDTH = {"mcp23017": 16, "pcf8574": 8}
+
+
+def process_age() -> float:
+    """Seconds since the process started, from /proc; 0 where it is not available."""
+    try:
+        with open("/proc/self/stat") as f:
+            # the fields after the command name, starttime is the 22nd field of the line
+            start_ticks = int(f.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def _board_pins(parser: configparser.ConfigParser) -> dict:
+    """Pins of the sensors on the GPIO chips of the board, ``chip -> pins``, like ``SensorsConfig.pins_by_chip``."""
+    default = parser.get("gpio", "chip", fallback="/dev/gpiochip0")
+    expanders = []
+    if parser.has_section("expanders"):
+        for spec in parser["expanders"].values():
+            kind, _, _, base = (field.strip() for field in spec.split(",")[:4])
+            expanders.append(range(int(base), int(base) + EXPANDER_WIDTH[kind.lower()]))
+    grouped = {}
+    for value in parser["sensors"].values():
+        pin, _, chip = value.partition(",")
+        pin = int(pin)
+        if not chip.strip() and any(pin in inputs for inputs in expanders):
+            continue
+        grouped.setdefault(chip.strip() or default, []).append(pin)
+    return grouped
+
+
+def read_sensors(config_path) -> dict:
+    """
+    Value of the sensors on the GPIO chips of the board, ``pin -> value``,
+    read with nothing but configparser and gpiod before the rest of the
+    application is imported.  The lines are released again; the sensors on
+    the I2C expanders, and those of a chip that cannot be read, are missing.
+    """
+    logger = logging.getLogger(__name__)
+    if os.environ.get("GPIO_MOCK", "false").lower() == "true":
+        from app import fake_gpiod as gpiod
+    else:
+        try:
+            import gpiod
+        except ImportError:
+            return {}
+    parser = configparser.ConfigParser()
+    parser.read(config_path)
+    try:
+        grouped = _board_pins(parser)
+    except (KeyError, ValueError) as e:
+        # the full configuration check reports it
+        logger.debug("Sensors not read at startup: %s", e)
+        return {}
+    settings = gpiod.LineSettings(direction=gpiod.line.Direction.INPUT, bias=gpiod.line.Bias.PULL_UP)
+    values = {}
+    for chip, pins in grouped.items():
+        try:
+            request = gpiod.request_lines(chip, consumer="PiAlarmAdapter", config={tuple(pins): settings})
+            try:
+                read = request.get_values(pins)
+            finally:
+                request.release()
+        except Exception as e:
+            logger.warning("Sensors on %s not read at startup: %s", chip, e)
+            continue
+        values.update((pin, getattr(value, "value", value)) for pin, value in zip(pins, read))
+    return values
+
+
+class StartupTimer:
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        age = process_age()
+        self.started = time.monotonic() - age
+        self.phases = {}
+        self.milestones = {}
+        if age:
+            self.phases["interpreter"] = age
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @contextmanager
+    def phase(self, name: str):
+        began = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - began
+
+    def mark(self, name: str) -> bool:
+        """Record a milestone the first time it is reached; returns whether it was new."""
+        if name in self.milestones:
+            return False
+        self.milestones[name] = self.elapsed()
+        return True
+
+    def report(self) -> str:
+        phases = ", ".join(f"{name} {seconds:.3f} s" for name, seconds in self.phases.items())
+        milestones = ", ".join(f"{name} at {seconds:.3f} s" for name, seconds in self.milestones.items())
+        return "; ".join(part for part in (phases, milestones) if part)
+
+    def log(self) -> None:
+        self.logger.info("Startup: %s", self.report())
+
+
+timer = StartupTimer()
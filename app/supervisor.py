@@ -0,0 +1,355 @@
+"""
+Multi-process runtime (``RUNTIME=processes``).  The GPIO chips and the I2C
+expanders are shared among worker processes, each running its own
+:class:`app.services.SensorsService` (sampling, debounce, fault detection)
+on its chips, so the reads of one bank are not delayed by the MQTT client,
+the logging or the other banks holding the GIL.
+
+A worker does not publish: it writes a fixed-size :data:`RECORD` for every
+accepted change, fault and heartbeat to a pipe, in one write per loop.  The
+main process reads the pipes of all the workers, hands the changes to its
+own :class:`SensorsService` (zones, digest) and :class:`MqttService`, and
+supervises the workers: one that exits or stays silent for
+``worker_timeout`` seconds is stopped and started again with an increasing
+delay.  A restarted worker sends a snapshot of its lines, and the changes
+it missed are published.
+"""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import struct
+import time
+
+from app.faults import CHECK_INTERVAL as FAULT_CHECK_INTERVAL, FAULTS
+from app.metrics import MetricsExporter
+from app.models import SensorsConfig, SimulatorConfig
+from app.mqtt_client import Backoff
+from app.reload import ConfigReloader
+from app.services import MqttService, RfidService, SensorsService
+from app.simulator import GpioSimulator
+from app.startup import timer
+
+# kind, value, pin, monotonic time (shared by all the processes of the host)
+RECORD = struct.Struct("<BBHd")
+STATE, SNAPSHOT, FAULT, HEARTBEAT = range(4)
+# FAULT records: index in app.faults.FAULTS, and this bit when the fault is active
+FAULT_ACTIVE = 0x80
+
+# Seconds between two heartbeats of a worker, also its longest wait for the lines
+HEARTBEAT_INTERVAL = 1.0
+# Longest wait of the main process for the workers before looking for a config change
+CHECK_INTERVAL = 1.0
+# Seconds a restarted worker must run before its restart delay starts again from the shortest
+STABLE_AFTER = 60.0
+
+
+class RecordSink:
+    """
+    Stands for the :class:`MqttService` of the :class:`SensorsService` of a
+    worker: the messages become records, buffered until :meth:`flush`.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = bytearray()
+
+    def _add(self, kind: int, pin: int, value: int, timestamp: float) -> None:
+        self.buffer += RECORD.pack(kind, value, pin, timestamp if timestamp is not None else time.monotonic())
+
+    def compile_routes(self, sensors: dict) -> None:
+        """The topics are resolved by the main process."""
+
+    def publish_state(self, pin: int, name: str, value: int, timestamp: float = None, qos: int = 2) -> None:
+        self._add(STATE, pin, value, timestamp)
+
+    def publish_snapshot(self, messages) -> None:
+        now = time.monotonic()
+        for msg in messages:
+            self._add(SNAPSHOT, msg.pin, int(msg.status != "closed"), now)
+
+    def publish_zone(self, zone, timestamp: float = None, snapshot: bool = False) -> None:
+        """The zones span the workers: they are evaluated by the main process."""
+
+    def publish_fault(self, pin: int, name: str, fault: str, active: bool) -> None:
+        self._add(FAULT, pin, FAULTS.index(fault) | (FAULT_ACTIVE if active else 0), None)
+
+    def heartbeat(self, now: float) -> None:
+        self._add(HEARTBEAT, 0, 0, now)
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.conn.send_bytes(self.buffer)
+            self.buffer = bytearray()
+
+
+def _stop_worker(signum, frame):
+    raise SystemExit(0)
+
+
+def worker_main(name: str, conn, sensors_config: SensorsConfig, simulator_config: SimulatorConfig) -> None:
+    """Entry point of a worker process: read the lines of ``sensors_config`` and report to ``conn``."""
+    logging.basicConfig(
+        format=f"%(asctime)s [%(levelname)s] {name}: %(message)s",
+        level=logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO")),
+    )
+    # Ctrl+C reaches the whole process group: the main process stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _stop_worker)
+    sink = RecordSink(conn)
+    simulator = None
+    if sensors_config.is_real_board():
+        service = SensorsService(sensors_config, sink)
+    else:
+        from app import fake_expander, fake_gpiod
+
+        for expander_name, expander in sensors_config.expanders.items():
+            fake_expander.attach(expander_name, expander, sensors_config.chip)
+        service = SensorsService(sensors_config, sink, gpio_backend=fake_gpiod, i2c_backend=fake_expander)
+        simulator = GpioSimulator(sensors_config, simulator_config)
+    try:
+        service.connect_sensors()
+        sink.flush()
+        if simulator is not None:
+            simulator.start()
+        next_heartbeat = next_fault_check = 0.0
+        while True:
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                sink.heartbeat(now)
+                next_heartbeat = now + HEARTBEAT_INTERVAL
+            if service.edge_mode:
+                service.wait_events(HEARTBEAT_INTERVAL)
+            else:
+                service.check_sensors()
+                time.sleep(min(service.config.poll_interval, HEARTBEAT_INTERVAL))
+            now = time.monotonic()
+            if now >= next_fault_check:
+                service.check_faults(now)
+                next_fault_check = now + FAULT_CHECK_INTERVAL
+            sink.flush()
+    except (BrokenPipeError, EOFError):
+        # the main process is gone
+        pass
+    finally:
+        if simulator is not None:
+            simulator.stop()
+        service.close()
+
+
+class Worker:
+    """A worker process, the chips it reads and its health."""
+
+    __slots__ = ("name", "chips", "process", "conn", "started", "last_seen", "restart_at", "restarts", "backoff")
+
+    def __init__(self, name: str, chips: list):
+        self.name = name
+        self.chips = chips
+        self.process = None
+        self.conn = None
+        self.started = 0.0
+        self.last_seen = 0.0
+        # monotonic time of the next start, None while running
+        self.restart_at = None
+        self.restarts = 0
+        self.backoff = Backoff(1.0, 60.0)
+
+
+class Supervisor:
+    """Starts the workers, applies their records and restarts the ones that fail."""
+
+    def __init__(
+        self,
+        sensors_service: SensorsService,
+        mqtt_service: MqttService,
+        simulator_config: SimulatorConfig,
+        context=None,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.sensors_service = sensors_service
+        self.mqtt_service = mqtt_service
+        self.simulator_config = simulator_config
+        # spawn: the main process runs threads (MQTT client, publisher), which fork does not copy
+        self.context = context if context is not None else multiprocessing.get_context("spawn")
+        self.workers = []
+        self.records = 0
+
+    @property
+    def config(self) -> SensorsConfig:
+        return self.sensors_service.config
+
+    @staticmethod
+    def partition(config: SensorsConfig) -> list:
+        """Chips of each worker: ``workers`` groups, or one chip per worker when it is 0."""
+        chips = list(config.pins_by_chip())
+        count = min(config.workers or len(chips), len(chips))
+        return [chips[index::count] for index in range(count)]
+
+    def _worker_config(self, worker: Worker) -> SensorsConfig:
+        by_chip = self.config.pins_by_chip()
+        sensors = {pin: self.config.sensors[pin] for chip in worker.chips for pin in by_chip.get(chip, [])}
+        return self.config.model_copy(update={"sensors": sensors, "zones": {}})
+
+    def _spawn(self, worker: Worker) -> None:
+        receiver, sender = self.context.Pipe(duplex=False)
+        worker.process = self.context.Process(
+            target=worker_main,
+            args=(worker.name, sender, self._worker_config(worker), self.simulator_config),
+            name=worker.name,
+            daemon=True,
+        )
+        worker.process.start()
+        sender.close()
+        worker.conn = receiver
+        worker.started = worker.last_seen = time.monotonic()
+        worker.restart_at = None
+        self.logger.info("Worker %s (pid %d) reads %s", worker.name, worker.process.pid, ", ".join(worker.chips))
+
+    def start(self) -> None:
+        self.sensors_service.local = False
+        self.mqtt_service.compile_routes(self.config.sensors)
+        self.workers = [Worker(f"worker{index}", chips) for index, chips in enumerate(self.partition(self.config))]
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def _kill(self, worker: Worker):
+        """Stop the process of a worker and return its exit code."""
+        if worker.conn is not None:
+            worker.conn.close()
+            worker.conn = None
+        process, worker.process = worker.process, None
+        if process is None:
+            return None
+        if process.is_alive():
+            process.terminate()
+            process.join(1.0)
+            if process.is_alive():
+                process.kill()
+        process.join()
+        return process.exitcode
+
+    def _failed(self, worker: Worker, reason: str) -> None:
+        exitcode = self._kill(worker)
+        delay = worker.backoff.next_delay()
+        worker.restart_at = time.monotonic() + delay
+        self.logger.error(
+            "Worker %s %s (exit code %s), restarting it in %.1f s", worker.name, reason, exitcode, delay
+        )
+
+    def _apply(self, worker: Worker, data: bytes) -> None:
+        snapshot = {}
+        for kind, value, pin, timestamp in RECORD.iter_unpack(data):
+            if kind == STATE:
+                self.sensors_service.apply_change(pin, value, timestamp)
+            elif kind == SNAPSHOT:
+                snapshot[pin] = value
+            elif kind == FAULT:
+                name = self.config.sensors.get(pin, str(pin))
+                self.mqtt_service.publish_fault(pin, name, FAULTS[value & ~FAULT_ACTIVE], bool(value & FAULT_ACTIVE))
+            self.records += 1
+        if snapshot:
+            self.sensors_service.apply_snapshot(snapshot, time.monotonic())
+        worker.last_seen = time.monotonic()
+
+    def poll(self, timeout: float) -> None:
+        """Wait up to ``timeout`` seconds for the records of the workers and apply them."""
+        conns = {worker.conn: worker for worker in self.workers if worker.conn is not None}
+        if not conns:
+            time.sleep(timeout)
+            return
+        for conn in multiprocessing.connection.wait(list(conns), timeout):
+            worker = conns[conn]
+            try:
+                data = conn.recv_bytes()
+            except (EOFError, OSError):
+                self._failed(worker, "closed its pipe")
+                continue
+            self._apply(worker, data)
+
+    def check(self, now: float) -> None:
+        """Restart the workers that exited or stopped sending heartbeats, once their delay expired."""
+        timeout = self.config.worker_timeout
+        for worker in self.workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.restarts += 1
+                    self._spawn(worker)
+            elif worker.process.exitcode is not None:
+                self._failed(worker, "exited")
+            elif now - worker.last_seen > timeout:
+                self._failed(worker, f"sent nothing for {now - worker.last_seen:.1f} s")
+            elif worker.backoff.attempts and now - worker.started >= STABLE_AFTER:
+                worker.backoff.reset()
+
+    def apply_config(self) -> None:
+        """Start the workers again with the sensors of the configuration applied to the sensors service."""
+        self.stop()
+        self.start()
+
+    def stop(self) -> None:
+        for worker in self.workers:
+            self._kill(worker)
+        self.workers = []
+
+    def stats(self) -> dict:
+        return {
+            "workers": sum(worker.process is not None for worker in self.workers),
+            "restarts": sum(worker.restarts for worker in self.workers),
+            "records": self.records,
+        }
+
+
+class ProcessRuntime:
+    """
+    The threads runtime with the sensors read by worker processes: the
+    main process publishes, serves the RFID readers and the metrics and
+    reloads the configuration.  In mock mode every worker simulates its
+    own sensors.
+    """
+
+    def __init__(
+        self,
+        mqtt_service: MqttService,
+        sensors_service: SensorsService,
+        rfid_service: RfidService,
+        gpio_simulator: GpioSimulator,
+        metrics_exporter: MetricsExporter,
+        config_reloader: ConfigReloader,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.mqtt_service = mqtt_service
+        self.sensors_service = sensors_service
+        self.rfid_service = rfid_service
+        self.metrics_exporter = metrics_exporter
+        self.config_reloader = config_reloader
+        self.supervisor = Supervisor(sensors_service, mqtt_service, gpio_simulator.config)
+
+    def run(self) -> None:
+        with timer.phase("workers"):
+            self.supervisor.start()
+        with timer.phase("mqtt"):
+            self.mqtt_service.connect()
+        with timer.phase("rfid"):
+            self.rfid_service.connect_sensors()
+            self.rfid_service.start()
+        self.metrics_exporter.start()
+        self.config_reloader.watch()
+        self.logger.info("Processes runtime started with %d workers", len(self.supervisor.workers))
+        timer.log()
+        try:
+            while True:
+                digest_in = self.sensors_service.publish_digest(time.monotonic())
+                self.supervisor.poll(CHECK_INTERVAL if digest_in is None else min(CHECK_INTERVAL, digest_in))
+                self.supervisor.check(time.monotonic())
+                changed = self.config_reloader.check()
+                if "sensors" in changed:
+                    self.supervisor.apply_config()
+                if "rfid" in changed:
+                    self.rfid_service.start()
+        except KeyboardInterrupt:
+            self.supervisor.stop()
+            self.rfid_service.stop()
+            self.metrics_exporter.stop()
+            self.config_reloader.close()
+            self.mqtt_service.disconnect()
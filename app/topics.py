@@ -0,0 +1,79 @@
+"""
+Topics of the sensor states.  A topic is written as a template relative to
+``topic_prefix`` with the fields ``{device}``, ``{name}``, ``{pin}`` and
+``{group}``; a sensor or a group of sensors can have its own templates,
+several of them to publish every change on more than one topic (for
+example its own topic and one shared by the sensors of a floor).  The
+state of a zone goes on ``zone_template``, with the zone as ``{name}``.  The
+templates are resolved once per sensor, by :class:`app.services.MqttService`
+when it builds its routing table.
+"""
+import string
+from typing import Dict, List
+
+FIELDS = {"device", "name", "pin", "group"}
+
+
+def check_template(template: str) -> str:
+    """Return the template, raising ``ValueError`` when it uses an unknown field."""
+    fields = {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+    unknown = fields - FIELDS
+    if unknown:
+        raise ValueError(f"Unknown fields {', '.join(sorted(unknown))} in topic template {template!r}")
+    return template
+
+
+class TopicTable:
+    """Templates of the topics, resolved for one sensor at a time by :meth:`topics_for`."""
+
+    def __init__(
+        self,
+        prefix: str = "alarm/",
+        template: str = "{name}/status",
+        device: str = "",
+        templates: Dict[str, List[str]] = None,
+        groups: Dict[str, List[str]] = None,
+        zone_template: str = "zone/{name}/status",
+    ):
+        self.device = device
+        self.prefix = check_template(prefix).format(device=device, name="", pin="", group="")
+        self.template = check_template(template)
+        self.zone_template = check_template(zone_template)
+        # sensor or group name -> templates of its topics
+        self.templates = {name: [check_template(t) for t in topics] for name, topics in (templates or {}).items()}
+        # sensor name -> groups it belongs to, in the order of the config
+        self.member_of = {}
+        for group, members in (groups or {}).items():
+            for member in members:
+                self.member_of.setdefault(member, []).append(group)
+
+    @classmethod
+    def from_config(cls, config) -> "TopicTable":
+        return cls(
+            config.topic_prefix, config.topic_template, config.device_id, config.topics, config.groups,
+            config.zone_template,
+        )
+
+    def _templates(self, name: str) -> list:
+        """(template, group) pairs of a sensor: its own templates, else those of its groups, else the default."""
+        groups = self.member_of.get(name, [])
+        if name in self.templates:
+            return [(template, groups[0] if groups else "") for template in self.templates[name]]
+        found = [(template, group) for group in groups for template in self.templates.get(group, [])]
+        return found or [(self.template, groups[0] if groups else "")]
+
+    def topics_for(self, pin: int, name: str) -> tuple:
+        """Topics of a sensor, without duplicates, the first from its first template."""
+        topics = (
+            self.prefix + template.format(device=self.device, name=name, pin=pin, group=group)
+            for template, group in self._templates(name)
+        )
+        return tuple(dict.fromkeys(topics))
+
+    def zone_topic(self, name: str) -> str:
+        """Topic of the aggregate state of a zone."""
+        return self.prefix + self.zone_template.format(device=self.device, name=name, pin="", group=name)
+
+    def event_topic(self, sub_topic: str) -> str:
+        """Topic of the messages that are not sensor states, such as the RFID tags."""
+        return self.prefix + sub_topic
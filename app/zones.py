@@ -0,0 +1,74 @@
+"""
+Zones of sensors, evaluated locally at every change.  A zone counts its
+open members and is open when the count reaches the threshold of its rule
+(``any`` member, ``all`` of them or a given number); a change of a sensor
+only updates the counters of the zones it belongs to, and the zone state is
+published by :class:`app.services.SensorsService` only when it flips.
+"""
+import logging
+from typing import Dict
+
+from app.models import ZoneConfig
+
+
+class Zone:
+    """Aggregate state of one zone."""
+
+    __slots__ = ("name", "pins", "threshold", "open", "active")
+
+    def __init__(self, name: str, pins: tuple, threshold: int):
+        self.name = name
+        self.pins = pins
+        self.threshold = threshold
+        # members currently open
+        self.open = 0
+        # open >= threshold
+        self.active = False
+
+    @property
+    def status(self) -> str:
+        return "open" if self.active else "closed"
+
+
+class ZoneEngine:
+
+    def __init__(self, zones: Dict[str, ZoneConfig] = None, sensors: Dict[int, str] = None):
+        self.logger = logging.getLogger(__name__)
+        pins = {name: pin for pin, name in (sensors or {}).items()}
+        self.zones = {}
+        # pin -> zones it belongs to
+        self.by_pin = {}
+        for name, config in (zones or {}).items():
+            unknown = [member for member in config.members if member not in pins]
+            if unknown:
+                self.logger.warning("Zone %s: unknown sensors %s ignored", name, ", ".join(unknown))
+            members = tuple(dict.fromkeys(pins[member] for member in config.members if member in pins))
+            if not members:
+                continue
+            zone = self.zones[name] = Zone(name, members, max(1, config.threshold(len(members))))
+            for pin in members:
+                self.by_pin.setdefault(pin, []).append(zone)
+
+    def reset(self, values: Dict[int, int]) -> None:
+        """Count the open members again from the value of every sensor, ``pin -> value``."""
+        for zone in self.zones.values():
+            zone.open = sum(values.get(pin) == 1 for pin in zone.pins)
+            zone.active = zone.open >= zone.threshold
+
+    def update(self, pin: int, old: int, new: int) -> list:
+        """Apply the change of a sensor and return the zones whose state flipped."""
+        zones = self.by_pin.get(pin)
+        if zones is None:
+            return []
+        # a value not read yet (-1) counts as closed
+        delta = (new == 1) - (old == 1)
+        if not delta:
+            return []
+        flipped = []
+        for zone in zones:
+            zone.open += delta
+            active = zone.open >= zone.threshold
+            if active is not zone.active:
+                zone.active = active
+                flipped.append(zone)
+        return flipped
@@ -0,0 +1,165 @@
+"""
+Minimal in-process MQTT broker stand-in for the benchmarks.  It speaks
+enough MQTT 3.1.1 and 5 to accept the adapter (CONNECT, PUBLISH with the
+QoS 1 and 2 handshakes, PINGREQ, DISCONNECT), records the time every
+message arrives and forwards nothing.
+"""
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+class Received:
+    __slots__ = ("arrived", "topic", "payload", "qos")
+
+    def __init__(self, arrived: float, topic: str, payload: bytes, qos: int):
+        self.arrived = arrived
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+
+
+def _read_exactly(sock, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("client closed the connection")
+        data += chunk
+    return data
+
+
+def _read_varint(data: bytes, offset: int) -> tuple:
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def setup(self) -> None:
+        self.server.connections.add(self.request)
+
+    def finish(self) -> None:
+        self.server.connections.discard(self.request)
+
+    def _read_packet(self) -> tuple:
+        header = _read_exactly(self.request, 1)[0]
+        length, shift = 0, 0
+        while True:
+            byte = _read_exactly(self.request, 1)[0]
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        return header, _read_exactly(self.request, length) if length else b""
+
+    def _send(self, packet_type: int, flags: int, body: bytes) -> None:
+        self.request.sendall(bytes([packet_type << 4 | flags, len(body)]) + body)
+
+    def _publish(self, flags: int, body: bytes, v5: bool) -> None:
+        arrived = time.monotonic()
+        qos = flags >> 1 & 3
+        (topic_len,) = struct.unpack_from("!H", body)
+        topic = body[2:2 + topic_len].decode()
+        offset = 2 + topic_len
+        packet_id = body[offset:offset + 2]
+        if qos:
+            offset += 2
+        if v5:
+            properties_len, offset = _read_varint(body, offset)
+            offset += properties_len
+        self.server.received(Received(arrived, topic, body[offset:], qos))
+        if qos == 1:
+            self._send(PUBACK, 0, packet_id)
+        elif qos == 2:
+            self._send(PUBREC, 0, packet_id)
+
+    def handle(self) -> None:
+        v5 = False
+        try:
+            while True:
+                header, body = self._read_packet()
+                packet_type, flags = header >> 4, header & 0x0F
+                if packet_type == CONNECT:
+                    # protocol name (2 + 4 bytes) then the protocol level
+                    v5 = body[6] == 5
+                    self._send(CONNACK, 0, b"\0\0\0" if v5 else b"\0\0")
+                elif packet_type == PUBLISH:
+                    self._publish(flags, body, v5)
+                elif packet_type == PUBREL:
+                    self._send(PUBCOMP, 0, body[:2])
+                elif packet_type == PINGREQ:
+                    self._send(PINGRESP, 0, b"")
+                elif packet_type == DISCONNECT:
+                    return
+                self.server.cpu_time[threading.get_ident()] = time.thread_time()
+        except (ConnectionError, OSError):
+            return
+
+
+class BrokerStandIn(socketserver.ThreadingTCPServer):
+    """
+    Listens on ``127.0.0.1`` (a free port by default) and keeps every
+    received message in :attr:`messages`.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.arrived = threading.Condition(self.lock)
+        self.cpu_time = {}
+        self.connections = set()
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    @property
+    def cpu_seconds(self) -> float:
+        """CPU time spent by the connection threads, to be taken out of the adapter's share."""
+        return sum(self.cpu_time.values())
+
+    def received(self, message: Received) -> None:
+        with self.lock:
+            self.messages.append(message)
+            self.arrived.notify_all()
+
+    def wait_for(self, count: int, timeout: float) -> bool:
+        """Wait until ``count`` messages have been received."""
+        with self.lock:
+            return self.arrived.wait_for(lambda: len(self.messages) >= count, timeout)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.messages = []
+
+    def drop_connections(self) -> None:
+        """Close the connection of every client, as a broker restart does."""
+        for sock in list(self.connections):
+            sock.shutdown(socket.SHUT_RDWR)
+
+    def start(self) -> "BrokerStandIn":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
@@ -0,0 +1,325 @@
+"""
+Benchmark of the sensor-to-MQTT hot path.
+
+The real :class:`SensorsService`, :class:`MqttService` and
+:class:`MqttClient` run against :mod:`app.fake_gpiod` and the in-process
+:class:`BrokerStandIn`, sweeping the number of sensors, the toggle rate and
+the QoS.  The results are written as JSON; with ``--baseline`` they are
+compared with a previous run and the exit status is 1 on a regression.
+
+    python -m benchmarks.hotpath --output results.json
+    python -m benchmarks.hotpath --sensors 8,64 --rates 100 --qos 1 --baseline results.json
+"""
+import argparse
+import bisect
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+from unittest.mock import patch
+
+from app import fake_gpiod
+from app.models import MessageModel, MqttConfig, SensorsConfig
+from app.mqtt_client import MqttClient
+from app.publisher import OutboundQueue
+from app.services import MqttService, SensorsService
+from benchmarks.broker import BrokerStandIn
+
+CHIP = "/dev/gpiochip0"
+# Keys where a higher value is better; every other numeric key is lower-is-better
+HIGHER_IS_BETTER = {"scans_per_second", "reads_per_second", "messages_per_second", "acks_per_second", "delivered"}
+SCENARIO_KEYS = ("benchmark", "mode", "sensors", "rate", "qos")
+
+
+def percentile(values: list, percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+class QosOverride:
+    """Hands the messages of the sensors to the MqttService with the QoS under test."""
+
+    def __init__(self, mqtt_service: MqttService, qos: int):
+        self.mqtt_service = mqtt_service
+        self.qos = qos
+
+    def publish_message(self, msg) -> None:
+        msg.qos = self.qos
+        self.mqtt_service.publish_message(msg)
+
+    def publish_state(self, pin: int, name: str, value: int, timestamp: float = None) -> None:
+        self.mqtt_service.publish_state(pin, name, value, timestamp, self.qos)
+
+    def compile_routes(self, sensors: dict) -> None:
+        self.mqtt_service.compile_routes(sensors)
+
+    def publish_snapshot(self, messages) -> None:
+        self.mqtt_service.publish_snapshot(messages)
+
+    def publish_zone(self, zone, timestamp: float = None, snapshot: bool = False) -> None:
+        self.mqtt_service.publish_zone(zone, timestamp, snapshot)
+
+    def publish_fault(self, pin: int, name: str, fault: str, active: bool) -> None:
+        self.mqtt_service.publish_fault(pin, name, fault, active)
+
+
+class Stack:
+    """Adapter services wired to the fake chip and the broker stand-in."""
+
+    def __init__(self, broker: BrokerStandIn, sensors: int, qos: int, edge_detection: bool, poll_interval: float):
+        fake_gpiod.reset()
+        self.chip = fake_gpiod.chip(CHIP)
+        mqtt_config = MqttConfig(
+            address="127.0.0.1", port=broker.port, username="", password="",
+            client_id=f"bench-{os.getpid()}", clean_session=True, spool_size=0,
+        )
+        sensors_config = SensorsConfig(
+            sensors={pin: f"sensor{pin}" for pin in range(sensors)},
+            chip=CHIP,
+            edge_detection=edge_detection,
+            poll_interval=poll_interval,
+            debounce=0,
+            # a bench toggles the lines far faster than a real sensor: the
+            # chatter faults would be counted as delivered states
+            fault_transitions=0,
+            fault_bounces=0,
+            fault_stuck=0,
+        )
+        self.client = MqttClient(mqtt_config)
+        self.mqtt_service = MqttService(self.client, OutboundQueue(mqtt_config.queue_size), mqtt_config.batch_size)
+        self.sensors_service = SensorsService(sensors_config, QosOverride(self.mqtt_service, qos))
+        self.patcher = patch.multiple("app.services", gpiod=fake_gpiod, GPIOD_AVAILABLE=True, create=True)
+
+    def __enter__(self) -> "Stack":
+        self.patcher.start()
+        self.mqtt_service.connect()
+        deadline = time.monotonic() + 5
+        while not self.client.is_connected():
+            if time.monotonic() > deadline:
+                raise RuntimeError("the broker stand-in did not accept the connection")
+            time.sleep(0.01)
+        self.sensors_service.connect_sensors()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.sensors_service.close()
+        self.mqtt_service.disconnect()
+        self.patcher.stop()
+        fake_gpiod.reset()
+
+
+def bench_scan(broker: BrokerStandIn, sensors: int, duration: float) -> dict:
+    """Reads of every sensor with no state change, as in polling mode."""
+    with Stack(broker, sensors, 0, False, 0) as stack:
+        service = stack.sensors_service
+        scans = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < duration:
+            service.check_sensors()
+            scans += 1
+        elapsed = time.perf_counter() - started
+    return {
+        "benchmark": "scan",
+        "sensors": sensors,
+        "scans_per_second": scans / elapsed,
+        "reads_per_second": scans * sensors / elapsed,
+    }
+
+
+def bench_publish(broker: BrokerStandIn, messages: int, qos: int, timeout: float) -> dict:
+    """Messages pushed through MqttService.publish_message until the broker acknowledges them."""
+    broker.clear()
+    with Stack(broker, 1, qos, False, 0) as stack:
+        service = stack.mqtt_service
+        started = time.perf_counter()
+        for index in range(messages):
+            service.publish_message(MessageModel("open" if index % 2 else "closed", 0, "sensor0", qos))
+        queued = time.perf_counter() - started
+        broker.wait_for(messages, timeout)
+        received = time.perf_counter() - started
+        while service.acknowledged < messages and time.perf_counter() - started < timeout:
+            time.sleep(0.001)
+        acked = time.perf_counter() - started
+        delivered = service.acknowledged
+    return {
+        "benchmark": "publish",
+        "qos": qos,
+        "messages": messages,
+        "delivered": delivered,
+        "enqueue_us": queued / messages * 1e6,
+        "messages_per_second": len(broker.messages) / received,
+        "acks_per_second": delivered / acked,
+    }
+
+
+class Toggler(threading.Thread):
+    """Flips the sensors round robin at ``rate`` changes per second."""
+
+    def __init__(self, chip, sensors: int, rate: float, duration: float):
+        super().__init__(daemon=True)
+        self.chip = chip
+        self.sensors = sensors
+        self.rate = rate
+        self.count = int(rate * duration)
+        # pin -> value -> monotonic times of the changes
+        self.changes = {pin: {0: [], 1: []} for pin in range(sensors)}
+
+    def run(self) -> None:
+        started = time.monotonic()
+        for index in range(self.count):
+            wake = started + index / self.rate
+            delay = wake - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pin = index % self.sensors
+            value = 1 - self.chip.values.get(pin, 1)
+            now = time.monotonic_ns()
+            self.chip.set_value(pin, value, now)
+            self.changes[pin][value].append(now / 1e9)
+
+    def changed_at(self, pin: int, value: int, arrived: float):
+        """Time of the last change of the pin to ``value`` before the message arrived."""
+        times = self.changes[pin][value]
+        index = bisect.bisect_right(times, arrived)
+        return times[index - 1] if index else None
+
+
+def bench_end_to_end(broker: BrokerStandIn, sensors: int, rate: float, qos: int, duration: float,
+                     edge_detection: bool, poll_interval: float) -> dict:
+    """Sensor changes detected by SensorsService until their message reaches the broker."""
+    broker.clear()
+    with Stack(broker, sensors, qos, edge_detection, poll_interval) as stack:
+        service = stack.sensors_service
+        toggler = Toggler(stack.chip, sensors, rate, duration)
+        cpu_started, broker_cpu_started = time.process_time(), broker.cpu_seconds
+        toggler.start()
+        deadline = time.monotonic() + duration + 5
+        while time.monotonic() < deadline:
+            # one more pass after the last change, to pick it up
+            finished = not toggler.is_alive()
+            if service.edge_mode:
+                service.wait_events(timeout=0.05)
+            else:
+                service.check_sensors()
+                time.sleep(poll_interval)
+            if finished and not service.pending:
+                break
+        toggler.join()
+        broker.wait_for(toggler.count, max(0.0, deadline - time.monotonic()))
+        cpu = time.process_time() - cpu_started - (broker.cpu_seconds - broker_cpu_started)
+        messages = list(broker.messages)
+
+    latencies = []
+    for message in messages:
+        pin = int(message.topic.split("/")[1][len("sensor"):])
+        changed = toggler.changed_at(pin, 0 if message.payload == b"closed" else 1, message.arrived)
+        if changed is not None:
+            latencies.append(message.arrived - changed)
+    return {
+        "benchmark": "end_to_end",
+        "mode": "edge" if edge_detection else "polling",
+        "sensors": sensors,
+        "rate": rate,
+        "qos": qos,
+        "events": toggler.count,
+        "delivered": len(messages),
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "latency_max_ms": max(latencies, default=0.0) * 1000,
+        "cpu_per_event_us": cpu / max(len(messages), 1) * 1e6,
+    }
+
+
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    """Return a description of every metric worse than the baseline by more than ``tolerance``."""
+    def scenario(result):
+        return tuple(result.get(key) for key in SCENARIO_KEYS)
+
+    previous = {scenario(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(scenario(result))
+        if old is None:
+            continue
+        for key, value in result.items():
+            if key in SCENARIO_KEYS or not isinstance(value, (int, float)) or not old.get(key):
+                continue
+            change = (value - old[key]) / old[key]
+            if key not in HIGHER_IS_BETTER:
+                change = -change
+            if change < -tolerance:
+                regressions.append(f"{dict(zip(SCENARIO_KEYS, scenario(result)))} {key}: {old[key]:.4g} -> {value:.4g}")
+    return regressions
+
+
+def _numbers(text: str, kind=int) -> list:
+    return [kind(value) for value in text.split(",") if value]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the sensor-to-MQTT hot path")
+    parser.add_argument("--sensors", type=_numbers, default=[1, 8, 64, 512], help="sensor counts to sweep")
+    parser.add_argument("--rates", type=lambda text: _numbers(text, float), default=[10.0, 100.0, 1000.0],
+                        help="sensor changes per second to sweep")
+    parser.add_argument("--qos", type=_numbers, default=[0, 1, 2], help="QoS levels to sweep")
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds of every measurement")
+    parser.add_argument("--messages", type=int, default=2000, help="messages of the publish benchmark")
+    parser.add_argument("--polling", action="store_true", help="sample the sensors instead of waiting for edges")
+    parser.add_argument("--poll-interval", type=float, default=0.01, help="seconds between two samples when polling")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative worsening reported as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    broker = BrokerStandIn().start()
+    results = []
+    try:
+        for sensors in args.sensors:
+            results.append(bench_scan(broker, sensors, args.duration))
+        for qos in args.qos:
+            results.append(bench_publish(broker, args.messages, qos, timeout=30))
+        for sensors in args.sensors:
+            for rate in args.rates:
+                for qos in args.qos:
+                    results.append(bench_end_to_end(
+                        broker, sensors, rate, qos, args.duration, not args.polling, args.poll_interval
+                    ))
+    finally:
+        broker.stop()
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
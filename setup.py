@@ -25,7 +25,8 @@ setup(
     install_requires=parse_requirements('requirements.txt'),
     entry_points={
         'console_scripts': [
-            'pi_alarm_adapter=app.__main__:main',
+            'pi_alarm_adapter=app.__main__:run',
+            'pi_alarm_journal=app.journal:main',
         ],
     },
 )
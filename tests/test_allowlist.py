@@ -0,0 +1,45 @@
+import unittest
+from unittest import TestCase
+
+from app.allowlist import AllowList
+
+
+class TestAllowList(TestCase):
+
+    def test_text(self):
+        allow_list = AllowList()
+        allow_list.load("# staff\nDEADBEEF Anna\n04:A1:B2:C3:D4:E5:F6, Marco\n\n01020304\n", "test")
+        self.assertEqual(len(allow_list), 3)
+        self.assertEqual(allow_list.lookup(bytes.fromhex("DEADBEEF")), "Anna")
+        self.assertEqual(allow_list.lookup(bytes.fromhex("04A1B2C3D4E5F6")), "Marco")
+        self.assertEqual(allow_list.lookup(bytes.fromhex("01020304")), "")
+        self.assertIsNone(allow_list.lookup(bytes.fromhex("CAFEBABE")))
+
+    def test_json(self):
+        allow_list = AllowList()
+        allow_list.load_payload(b'{"deadbeef": "Anna"}')
+        self.assertIn(bytes.fromhex("DEADBEEF"), allow_list)
+        allow_list.load_payload(b'["01020304"]')
+        self.assertNotIn(bytes.fromhex("DEADBEEF"), allow_list)
+        self.assertIn(bytes.fromhex("01020304"), allow_list)
+
+    def test_invalid_list_keeps_current_one(self):
+        allow_list = AllowList({bytes.fromhex("DEADBEEF"): "Anna"})
+        allow_list.load("not hex", "test")
+        self.assertIn(bytes.fromhex("DEADBEEF"), allow_list)
+
+    def test_json_with_uids_that_are_not_strings_is_rejected(self):
+        allow_list = AllowList({bytes.fromhex("DEADBEEF"): "Anna"})
+        for payload in (b'[123]', b'[null]', b'[["01020304"]]'):
+            with self.assertLogs("app.allowlist", "ERROR"):
+                allow_list.load_payload(payload)
+        self.assertIn(bytes.fromhex("DEADBEEF"), allow_list)
+
+    def test_missing_file(self):
+        allow_list = AllowList()
+        allow_list.load_file("/nonexistent/allow.txt")
+        self.assertEqual(len(allow_list), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,21 @@
 import queue
 import injector
 from unittest import TestCase
-from unittest.mock import patch, MagicMock
+from unittest.mock import ANY, patch, MagicMock
 import app.container
-from app.models import MqttConfig, SensorsConfig, RfidConfig
+from app import fake_expander, fake_gpiod
+from app.models import MqttConfig, SensorsConfig, RfidConfig, MetricsConfig, SimulatorConfig, OverflowPolicy, PayloadFormat
+from app.metrics import MetricsExporter
 from app.mqtt_client import MqttClient
-from app.services import MqttService, SensorsService, MockSensorService
+from app.publisher import OutboundQueue
+from app.fake_mfrc522 import FakeSpiBus
+from app.services import MqttService, RfidService, SensorsService
+from app.simulator import GpioSimulator
 
 
 class TestAppContainer(TestCase):
 
-    @patch("app.container.MockSensorService")
+    @patch("app.container.GpioSimulator")
     @patch("app.container.SensorsService")
     @patch("app.container.MqttService")
     @patch("app.container.MqttClient")
@@ -21,12 +26,38 @@ class TestAppContainer(TestCase):
         mock_mqtt_client,
         mock_mqtt_service,
         mock_sensors_service,
-        mock_mock_sensor_service,
+        mock_gpio_simulator,
     ):
         mqtt_cfg = MagicMock(spec=MqttConfig)
+        mqtt_cfg.queue_size = 10
+        mqtt_cfg.overflow_policy = OverflowPolicy.DROP_OLDEST
+        mqtt_cfg.batch_size = 5
+        mqtt_cfg.spool_size = 0
+        mqtt_cfg.journal_size = 0
+        mqtt_cfg.topic_prefix = "{device}/"
+        mqtt_cfg.topic_template = "{name}/status"
+        mqtt_cfg.device_id = "pi"
+        mqtt_cfg.topics = {}
+        mqtt_cfg.groups = {}
+        mqtt_cfg.zone_template = "zone/{name}/status"
+        mqtt_cfg.status_topic = "status"
+        mqtt_cfg.digest_topic = "digest"
+        mqtt_cfg.digest_interval = 60.0
+        mqtt_cfg.retain = True
+        mqtt_cfg.publish_snapshot = False
+        mqtt_cfg.payload_format = PayloadFormat.JSON
+        mqtt_cfg.coalesce = True
+        mqtt_cfg.coalesce_window = 0.2
+        mqtt_cfg.coalesce_max_latency = 1.0
         sensors_cfg = MagicMock(spec=SensorsConfig)
-        rfid_cfg = MagicMock(spec=RfidConfig)
-        mock_load_configs.return_value = (mqtt_cfg, sensors_cfg, rfid_cfg)
+        rfid_cfg = RfidConfig(sensors={"entrance": "8,25"})
+        sensors_cfg.is_real_board.return_value = False
+        sensors_cfg.expanders = {}
+        sensors_cfg.zones = {}
+        sensors_cfg.chip = "/dev/gpiochip0"
+        metrics_cfg = MetricsConfig()
+        simulator_cfg = SimulatorConfig()
+        mock_load_configs.return_value = (mqtt_cfg, sensors_cfg, rfid_cfg, metrics_cfg, simulator_cfg)
 
         inj = injector.Injector([app.container.AppModule()])
 
@@ -34,24 +65,57 @@ class TestAppContainer(TestCase):
         q1 = inj.get(queue.Queue)
         q2 = inj.get(queue.Queue)
         self.assertIs(q1, q2)
+        self.assertIsInstance(q1, OutboundQueue)
+        self.assertEqual(q1.maxsize, 10)
+        self.assertIs(q1.policy, OverflowPolicy.DROP_OLDEST)
+        self.assertTrue(q1.coalescing)
+        self.assertEqual(q1.window, 0.2)
 
         # Config da load_configs
         self.assertIs(inj.get(MqttConfig), mqtt_cfg)
         self.assertIs(inj.get(SensorsConfig), sensors_cfg)
         self.assertIs(inj.get(RfidConfig), rfid_cfg)
+        self.assertIs(inj.get(MetricsConfig), metrics_cfg)
+        self.assertIs(inj.get(SimulatorConfig), simulator_cfg)
 
         # Providers
         mqtt_client_obj = inj.get(MqttClient)
         mock_mqtt_client.assert_called_once_with(mqtt_cfg)
 
         mqtt_service_obj = inj.get(MqttService)
-        mock_mqtt_service.assert_called_once_with(mqtt_client_obj)
+        mock_mqtt_service.assert_called_once_with(
+            mqtt_client_obj, q1, 5, None, retain=True, snapshot=False, payload_format=PayloadFormat.JSON,
+            journal=None,
+            topics=ANY,
+            status_topic="status",
+            digest_topic="digest",
+            digest_interval=60.0,
+        )
+        self.assertEqual(mock_mqtt_service.call_args.kwargs["topics"].prefix, "pi/")
 
         sensors_service_obj = inj.get(SensorsService)
-        mock_sensors_service.assert_called_once_with(sensors_cfg, mqtt_service_obj)
+        mock_sensors_service.assert_called_once_with(
+            sensors_cfg, mqtt_service_obj, gpio_backend=fake_gpiod, i2c_backend=fake_expander
+        )
 
-        mock_sensor_obj = inj.get(MockSensorService)
-        mock_mock_sensor_service.assert_called_once_with(sensors_service_obj)
+        rfid_service = inj.get(RfidService)
+        self.assertIs(rfid_service.mqtt_service, mqtt_service_obj)
+        self.assertIsInstance(rfid_service.transport, FakeSpiBus)
+
+        inj.get(GpioSimulator)
+        mock_gpio_simulator.assert_called_once_with(sensors_cfg, simulator_cfg)
+
+        exporter = inj.get(MetricsExporter)
+        self.assertIs(exporter.sensors_service, sensors_service_obj)
+        self.assertIs(exporter.mqtt_service, mqtt_service_obj)
+
+
+    def test_parse_sensors_with_chip(self):
+        sensors, chips = app.container._parse_sensors(
+            {"porta": "27", "garage": "5, /dev/gpiochip1"}
+        )
+        self.assertEqual(sensors, {27: "porta", 5: "garage"})
+        self.assertEqual(chips, {5: "/dev/gpiochip1"})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+import unittest
+from unittest import TestCase
+
+from app.debounce import Debouncer
+
+
+class TestDebouncer(TestCase):
+
+    def test_first_change_accepted(self):
+        debouncer = Debouncer(settle=0.05)
+        self.assertTrue(debouncer.accept(1, 0, 100.0))
+        self.assertFalse(debouncer.pending)
+
+    def test_change_inside_settle_is_pending(self):
+        debouncer = Debouncer(settle=0.05)
+        debouncer.accept(1, 0, 100.0)
+        self.assertFalse(debouncer.accept(0, 1, 100.01))
+        self.assertTrue(debouncer.pending)
+        self.assertAlmostEqual(debouncer.retry_in(100.01), 0.04)
+        self.assertTrue(debouncer.accept(0, 1, 100.06))
+
+    def test_bounce_back_is_rejected(self):
+        debouncer = Debouncer(settle=0.05)
+        debouncer.accept(1, 0, 100.0)
+        debouncer.accept(0, 1, 100.01)
+        self.assertFalse(debouncer.accept(0, 0, 100.02))
+        self.assertFalse(debouncer.pending)
+        self.assertEqual(debouncer.rejected, 1)
+
+    def test_stable_samples(self):
+        debouncer = Debouncer(settle=0, samples=3)
+        self.assertFalse(debouncer.accept(1, 0, 1.0))
+        self.assertFalse(debouncer.accept(1, 0, 1.1))
+        self.assertTrue(debouncer.accept(1, 0, 1.2))
+
+    def test_stable_samples_restart_on_glitch(self):
+        debouncer = Debouncer(settle=0, samples=2)
+        debouncer.accept(1, 0, 1.0)
+        debouncer.accept(1, 1, 1.1)
+        self.assertFalse(debouncer.accept(1, 0, 1.2))
+        self.assertTrue(debouncer.accept(1, 0, 1.3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import select
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app import fake_gpiod
+from app.models import SensorsConfig
+from app.services import SensorsService
+
+
+class TestFakeGpiod(TestCase):
+
+    def tearDown(self):
+        fake_gpiod.reset()
+
+    def _request(self, edge=fake_gpiod.Edge.BOTH):
+        settings = fake_gpiod.LineSettings(direction=fake_gpiod.Direction.INPUT, edge_detection=edge)
+        return fake_gpiod.request_lines("/dev/gpiochip0", consumer="test", config={4: settings, 5: settings})
+
+    def test_lines_idle_high(self):
+        self.assertEqual(self._request().get_values([4, 5]), [1, 1])
+
+    def test_edge_events_wake_the_fd(self):
+        request = self._request()
+        self.assertEqual(select.select([request.fd], [], [], 0)[0], [])
+        fake_gpiod.chip("/dev/gpiochip0").set_value(4, 0, timestamp_ns=123)
+        self.assertEqual(select.select([request.fd], [], [], 0)[0], [request.fd])
+        events = request.read_edge_events()
+        self.assertEqual([(e.line_offset, e.timestamp_ns) for e in events], [(4, 123)])
+        self.assertEqual(select.select([request.fd], [], [], 0)[0], [])
+        self.assertEqual(request.get_values([4, 5]), [0, 1])
+
+    def test_no_events_without_edge_detection(self):
+        request = self._request(edge=fake_gpiod.Edge.NONE)
+        fake_gpiod.chip("/dev/gpiochip0").set_value(4, 0)
+        self.assertEqual(request.read_edge_events(), [])
+
+    def test_rejected_settings(self):
+        fake_gpiod.chip("/dev/gpiochip0", rejects={"edge_detection"})
+        with self.assertRaises(OSError):
+            self._request()
+        self._request(edge=fake_gpiod.Edge.NONE)
+
+    def test_drives_sensors_service(self):
+        mqtt_service = MagicMock()
+        config = SensorsConfig(sensors={4: "door"}, debounce=0)
+        service = SensorsService(config, mqtt_service)
+        with patch.multiple("app.services", gpiod=fake_gpiod, GPIOD_AVAILABLE=True, create=True):
+            service.connect_sensors()
+            self.assertTrue(service.edge_mode)
+            fake_gpiod.chip("/dev/gpiochip0").set_value(4, 0)
+            service.wait_events(timeout=1)
+        pin, name, value, _ = mqtt_service.publish_state.call_args[0]
+        self.assertEqual((pin, name, value), (4, "door", 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
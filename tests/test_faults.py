@@ -0,0 +1,115 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app import fake_gpiod
+from app.faults import BOUNCE, CHATTER, STUCK, FaultDetector, Ring
+from app.models import PayloadFormat, SensorsConfig
+from app.mqtt_client import MqttClient
+from app.publisher import FAULT_PAYLOAD
+from app.services import MqttService, SensorsService
+
+
+class TestRing(TestCase):
+
+    def test_full_within_looks_at_the_oldest_time(self):
+        ring = Ring(3)
+        ring.add(1.0)
+        ring.add(2.0)
+        self.assertFalse(ring.full_within(2.0, 10.0))
+        ring.add(3.0)
+        self.assertTrue(ring.full_within(3.0, 2.0))
+        ring.add(20.0)
+        # 2.0 is now the oldest of the last three
+        self.assertFalse(ring.full_within(20.0, 10.0))
+        self.assertEqual(len(ring.times), 3)
+
+
+class TestFaultDetector(TestCase):
+
+    def _detector(self, **settings):
+        return FaultDetector(SensorsConfig(**{"fault_window": 10.0, **settings}))
+
+    def test_chatter_is_raised_once_and_cleared(self):
+        detector = self._detector(fault_transitions=3)
+        self.assertEqual(detector.changed(27, 1.0), [])
+        self.assertEqual(detector.changed(27, 2.0), [])
+        self.assertEqual(detector.changed(27, 3.0), [(27, CHATTER, True)])
+        self.assertEqual(detector.changed(27, 4.0), [])
+        self.assertEqual(detector.check([27], 5.0), [])
+        self.assertEqual(detector.check([27], 13.0), [(27, CHATTER, False)])
+        self.assertEqual((detector.raised, detector.active), (1, 0))
+
+    def test_bounces(self):
+        detector = self._detector(fault_bounces=2)
+        self.assertEqual(detector.bounced(22, 1.0), [])
+        self.assertEqual(detector.bounced(22, 1.1), [(22, BOUNCE, True)])
+        self.assertEqual(detector.check([22], 20.0), [(22, BOUNCE, False)])
+
+    def test_stuck_line(self):
+        detector = self._detector(fault_stuck=100.0)
+        self.assertEqual(detector.check([27], 0.0), [])
+        self.assertEqual(detector.check([27], 100.0), [(27, STUCK, True)])
+        self.assertEqual(detector.check([27], 150.0), [])
+        self.assertEqual(detector.changed(27, 160.0), [(27, STUCK, False)])
+
+    def test_disabled(self):
+        detector = self._detector(fault_transitions=0, fault_bounces=0)
+        self.assertFalse(detector.enabled)
+        self.assertEqual([detector.changed(27, float(t)) for t in range(100)], [[]] * 100)
+
+
+class TestSensorsServiceFaults(TestCase):
+
+    def setUp(self):
+        self.config = SensorsConfig(
+            sensors={27: "porta"}, debounce=0.05, edge_detection=False, fault_transitions=2, fault_bounces=2,
+        )
+        self.mqtt_service_mock = MagicMock(spec=MqttService)
+        self.sensors_service = SensorsService(self.config, self.mqtt_service_mock, gpio_backend=fake_gpiod)
+        self.sensors_service.connect_sensors()
+
+    def tearDown(self):
+        fake_gpiod.reset()
+
+    def _faults(self):
+        return [c.args for c in self.mqtt_service_mock.publish_fault.call_args_list]
+
+    def test_chatter_and_bounces_are_published(self):
+        state = self.sensors_service.states[27]
+        self.sensors_service._update_sensor(state, 0, 1.0)
+        self.sensors_service._update_sensor(state, 1, 2.0)
+        self.assertEqual(self._faults(), [(27, "porta", CHATTER, True)])
+        # a change shorter than the debounce is rejected as a bounce
+        for value, now in ((0, 2.01), (1, 2.02), (0, 2.03), (1, 2.04)):
+            self.sensors_service._update_sensor(state, value, now)
+        self.assertEqual(self._faults()[-1], (27, "porta", BOUNCE, True))
+        self.sensors_service.check_faults(100.0)
+        self.assertEqual(self._faults()[-2:], [(27, "porta", CHATTER, False), (27, "porta", BOUNCE, False)])
+
+    def test_supervise_scans_the_lines_at_most_once_a_second(self):
+        with patch.object(self.sensors_service.faults, "check", return_value=[]) as check:
+            for now in (10.0, 10.2, 10.9, 11.0, 11.5):
+                self.sensors_service.supervise(now)
+        self.assertEqual([c.args[1] for c in check.call_args_list], [10.0, 11.0])
+
+    def test_reload_with_new_settings_clears_the_faults(self):
+        state = self.sensors_service.states[27]
+        self.sensors_service._update_sensor(state, 0, 1.0)
+        self.sensors_service._update_sensor(state, 1, 2.0)
+        self.sensors_service.apply_config(self.config.model_copy(update={"fault_transitions": 10}))
+        self.assertEqual(self._faults()[-1], (27, "porta", CHATTER, False))
+        self.assertEqual(self.sensors_service.faults.max_transitions, 10)
+
+    def test_mqtt_service_publishes_on_the_fault_topic(self):
+        client = MagicMock(spec=MqttClient)
+        service = MqttService(client, payload_format=PayloadFormat.BINARY)
+        service.publish_fault(27, "porta", BOUNCE, True)
+        service.drain(timeout=0)
+        topic, payload, qos, retain = client.publish_message.call_args.args[:4]
+        self.assertEqual((topic, qos, retain), ("alarm/porta/fault/bounce", 1, False))
+        self.assertEqual(FAULT_PAYLOAD.unpack(payload), (27, 1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
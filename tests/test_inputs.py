@@ -0,0 +1,101 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from app import fake_expander, fake_gpiod
+from app.inputs import Mcp23017Driver, Pcf8574Driver
+from app.models import ExpanderConfig, SensorsConfig
+from app.services import MqttService, SensorsService
+
+
+class TestExpanders(TestCase):
+
+    def setUp(self):
+        self.mqtt_service = MagicMock(spec=MqttService)
+
+    def tearDown(self):
+        fake_gpiod.reset()
+        fake_expander.reset()
+
+    def _service(self, expanders, sensors):
+        config = SensorsConfig(sensors=sensors, expanders=expanders, debounce=0)
+        for name, expander in config.expanders.items():
+            fake_expander.attach(name, expander)
+        service = SensorsService(config, self.mqtt_service, gpio_backend=fake_gpiod, i2c_backend=fake_expander)
+        service.connect_sensors()
+        return service
+
+    def test_config(self):
+        config = SensorsConfig(
+            sensors={27: "porta", 103: "garage"},
+            expanders={"ground": "mcp23017, 1, 0x20, 100, 17", "attic": "pcf8574, 1, 0x38, 200"},
+        )
+        self.assertEqual(config.expanders["ground"].address, 0x20)
+        self.assertIsNone(config.expanders["attic"].interrupt)
+        self.assertEqual(config.chip_for(103), "ground")
+        self.assertEqual(config.chip_for(207), "attic")
+        self.assertEqual(config.chip_for(27), "/dev/gpiochip0")
+        self.assertEqual(config.pins_by_chip(), {"/dev/gpiochip0": [27], "ground": [103]})
+
+    def test_pins_outside_the_expander(self):
+        with self.assertRaises(ValueError):
+            Pcf8574Driver("attic", [208], ExpanderConfig(kind="pcf8574", address=0x38, base=200), MagicMock())
+
+    def test_mcp23017_is_read_on_interrupt(self):
+        service = self._service(
+            {"ground": "mcp23017, 1, 0x20, 100, 17"}, {27: "porta", 100: "garage", 109: "cantina"}
+        )
+        expander = fake_expander.devices[1, 0x20]
+        self.assertTrue(service.edge_mode)
+        # interrupts only from the inputs with a sensor
+        self.assertEqual(expander.registers[Mcp23017Driver.GPINTEN], 0x01)
+        self.assertEqual(expander.registers[Mcp23017Driver.GPINTEN + 1], 0x02)
+        reads = expander.transactions
+
+        fake_gpiod.chip("ground").set_value(109, 0, 2_000_000_000)
+        service.wait_events(timeout=1)
+        self.mqtt_service.publish_state.assert_called_once_with(109, "cantina", 0, 2.0)
+        # one bulk read of both ports, and the interrupt line is released
+        self.assertEqual(expander.transactions, reads + 1)
+        self.assertEqual(fake_gpiod.chip("/dev/gpiochip0").values[17], 1)
+
+        # an input without a sensor does not interrupt
+        fake_gpiod.chip("ground").set_value(104, 0)
+        service.wait_events(timeout=0)
+        self.assertEqual(expander.transactions, reads + 1)
+        service.close()
+
+    def test_pcf8574_without_interrupt_is_polled(self):
+        service = self._service({"attic": "pcf8574, 1, 0x38, 200"}, {200: "lucernario", 201: "botola"})
+        self.assertFalse(service.edge_mode)
+        fake_gpiod.chip("attic").set_value(201, 0)
+        service.check_sensors()
+        self.mqtt_service.publish_state.assert_called_once()
+        self.assertEqual(self.mqtt_service.publish_state.call_args.args[:3], (201, "botola", 0))
+
+    def test_polled_expander_keeps_edge_events_on_the_other_chips(self):
+        service = self._service({"attic": "pcf8574, 1, 0x38, 200"}, {27: "porta", 201: "botola"})
+        self.assertTrue(service.edge_mode)
+        self.assertEqual(service.polled_chips, {"attic"})
+        # the first wait samples the polled chip, the next ones wait for poll_interval
+        service.wait_events(timeout=0)
+        self.assertAlmostEqual(service.poll_in(), service.config.poll_interval, delta=0.05)
+        fake_gpiod.chip("/dev/gpiochip0").set_value(27, 0, 2_000_000_000)
+        service.wait_events(timeout=1)
+        self.mqtt_service.publish_state.assert_called_once_with(27, "porta", 0, 2.0)
+        fake_gpiod.chip("attic").set_value(201, 0)
+        service.next_poll = 0.0
+        service.wait_events(timeout=1)
+        self.assertEqual(self.mqtt_service.publish_state.call_args.args[:3], (201, "botola", 0))
+        service.close()
+
+    def test_missing_expander_leaves_the_other_chips(self):
+        config = SensorsConfig(sensors={27: "porta", 100: "garage"}, expanders={"ground": "mcp23017, 1, 0x20, 100"})
+        service = SensorsService(config, self.mqtt_service, gpio_backend=fake_gpiod, i2c_backend=fake_expander)
+        with self.assertLogs("app.services", "ERROR"):
+            service.connect_sensors()
+        self.assertEqual(list(service.drivers), ["/dev/gpiochip0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app import journal
+from app.journal import ACKED, DROPPED, FILE_HEADER, PUBLISHED, QUEUED, RECORD, Journal, query, rotated_files
+from app.models import MessageModel
+from app.mqtt_client import MqttClient
+from app.publisher import OutboundMessage
+from app.services import MqttService
+
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def _message(seq, pin=17):
+        return OutboundMessage("alarm/door/status", "open", 1, pin=pin, timestamp=time.monotonic(), seq=seq)
+
+    def test_change_and_outcomes_are_appended(self):
+        j = Journal(self.path)
+        message = self._message(1)
+        j.changed(message, 1)
+        j.outcome(message, PUBLISHED)
+        j.outcome(message, ACKED)
+        # nothing more is recorded once the outcome is final
+        j.outcome(message, DROPPED)
+        j.close()
+
+        records = list(query(self.path, raw=True))
+        self.assertEqual([(r[2], r[3], r[4], r[5]) for r in records], [
+            (1, 17, 1, QUEUED), (1, 17, 1, PUBLISHED), (1, 17, 1, ACKED),
+        ])
+        self.assertEqual(list(query(self.path))[0][5], ACKED)
+
+    def test_messages_that_are_not_changes_are_ignored(self):
+        j = Journal(self.path)
+        j.outcome(self._message(5), PUBLISHED)
+        j.close()
+        self.assertEqual(list(query(self.path, raw=True)), [])
+
+    def test_rotation_keeps_the_newest_files(self):
+        j = Journal(self.path, max_bytes=FILE_HEADER.size + 2 * RECORD.size, files=2)
+        for seq in range(1, 9):
+            j.changed(self._message(seq), seq % 2)
+        j.close()
+
+        self.assertEqual(len(rotated_files(self.path)), 2)
+        self.assertEqual([r[2] for r in query(self.path)], [3, 4, 5, 6, 7, 8])
+
+    def test_sequence_numbers_restart_after_a_restart(self):
+        j = Journal(self.path)
+        j.changed(self._message(1), 1)
+        j.close()
+        j = Journal(self.path)
+        j.changed(self._message(1), 0)
+        j.close()
+        self.assertEqual([(r[2], r[4]) for r in query(self.path)], [(1, 1), (1, 0)])
+
+    def test_outcome_after_a_rotation_reaches_its_change(self):
+        j = Journal(self.path, max_bytes=FILE_HEADER.size + 2 * RECORD.size)
+        first, second = self._message(1), self._message(2)
+        j.changed(first, 1)
+        j.changed(second, 0)
+        # written to the next file
+        j.outcome(first, ACKED)
+        j.close()
+        self.assertEqual(len(rotated_files(self.path)), 1)
+        self.assertEqual([(r[2], r[5]) for r in query(self.path)], [(1, ACKED), (2, QUEUED)])
+
+    def test_torn_record_is_truncated_on_open(self):
+        j = Journal(self.path)
+        j.changed(self._message(1), 1)
+        j.close()
+        with open(os.path.join(self.path, "journal.bin"), "ab") as f:
+            f.write(b"\x01\x02\x03")
+
+        j = Journal(self.path)
+        j.changed(self._message(2), 0)
+        j.close()
+        self.assertEqual([r[2] for r in query(self.path)], [1, 2])
+
+    def test_query_filters_by_pin_and_time(self):
+        j = Journal(self.path)
+        j.changed(self._message(1, pin=17), 1)
+        j.changed(self._message(2, pin=27), 1)
+        j.close()
+        wall = [r[1] for r in query(self.path)]
+
+        self.assertEqual([r[3] for r in query(self.path, pins={27})], [27])
+        self.assertEqual([r[2] for r in query(self.path, since_ns=wall[1])], [2])
+        self.assertEqual([r[2] for r in query(self.path, until_ns=wall[0])], [1])
+
+    def test_cli_filters_by_sensor_name(self):
+        j = Journal(self.path)
+        j.changed(self._message(1, pin=17), 1)
+        j.changed(self._message(2, pin=27), 0)
+        j.close()
+        config = Path(self.path) / "config.ini"
+        with open(config, "w") as f:
+            f.write("[sensors]\nwindow = 27\n")
+
+        out = io.StringIO()
+        with patch("app.journal.get_config_path", return_value=config), redirect_stdout(out):
+            journal.main(["--path", self.path, "--sensor", "window", "--since", "1h", "--csv"])
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "time,monotonic,seq,pin,state,outcome")
+        self.assertEqual(lines[1].split(",")[2:], ["2", "27", "closed", "queued"])
+        self.assertEqual(len(lines), 2)
+
+
+class TestMqttServiceJournal(TestCase):
+
+    def test_outcomes_are_journaled(self):
+        client = MagicMock(spec=MqttClient)
+        client.is_connected.return_value = True
+        client.publish_message.return_value = 7
+        recorder = MagicMock(spec=Journal)
+        service = MqttService(client, journal=recorder)
+
+        service.publish_message(MessageModel("open", 17, "door", 1, time.monotonic()))
+        service.drain(timeout=0)
+        service._on_published(7)
+
+        message = recorder.changed.call_args[0][0]
+        recorder.changed.assert_called_once_with(message, 1)
+        self.assertEqual([c[0] for c in recorder.outcome.call_args_list], [(message, PUBLISHED), (message, ACKED)])
+        recorder.flush.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import socket
+import tempfile
+import unittest
+import urllib.request
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app.metrics import Histogram, LatencyStats, MetricsExporter
+from app.models import MetricsConfig
+from app.startup import StartupTimer
+
+
+class TestHistogram(TestCase):
+
+    def test_empty(self):
+        self.assertEqual(Histogram().summary(), {"count": 0, "p50": 0.0, "p99": 0.0, "max": 0.0})
+
+    def test_percentiles_within_bucket_error(self):
+        histogram = Histogram()
+        for millis in range(1, 101):
+            histogram.record(millis / 1000)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.percentile(50), 0.050, delta=0.005)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.01)
+        self.assertEqual(histogram.max, 0.1)
+        self.assertLessEqual(histogram.percentile(100), histogram.max)
+
+    def test_memory_is_bounded(self):
+        histogram = Histogram()
+        size = len(histogram.counts)
+        for value in (0, 1e-9, 1e-3, 10, 1e9):
+            histogram.record(value)
+        self.assertEqual(len(histogram.counts), size)
+        self.assertEqual(histogram.count, 5)
+
+
+class TestLatencyStats(TestCase):
+
+    def test_report_per_sensor(self):
+        stats = LatencyStats()
+        stats.record(27, "ack", 1.0, 1.02)
+        stats.record(22, "publish", 1.0, 1.001)
+        stats.record(None, "ack", 1.0, 2.0)
+        report = stats.report()
+        self.assertEqual(set(report), {22, 27})
+        self.assertAlmostEqual(report[27]["ack"]["max"], 0.02)
+        self.assertEqual(report[22]["publish"]["count"], 1)
+
+
+class TestMetricsExporter(TestCase):
+
+    def setUp(self):
+        self.mqtt_service = MagicMock()
+        self.mqtt_service.stats.return_value = {
+            "enqueued": 5, "published": 4, "acknowledged": 3, "dropped": 1, "coalesced": 0,
+            "failed": 0, "spooled": 2, "depth": 1, "spool_depth": 2,
+        }
+        self.mqtt_service.mqtt_client.reconnects = 2
+        latency = LatencyStats()
+        latency.record(27, "ack", 1.0, 1.01)
+        self.mqtt_service.latency = latency
+        self.sensors_service = MagicMock(
+            iterations=10, iteration_seconds=0.5, reads=12, read_seconds=0.1, debounce_rejections=3
+        )
+
+    def _exporter(self, **config):
+        return MetricsExporter(MetricsConfig(**config), self.mqtt_service, self.sensors_service)
+
+    def test_render(self):
+        text = self._exporter().render()
+        self.assertIn("# TYPE pialarm_poll_iterations_total counter\npialarm_poll_iterations_total 10\n", text)
+        self.assertIn("pialarm_debounce_rejections_total 3\n", text)
+        self.assertIn("pialarm_messages_acked_total 3\n", text)
+        self.assertIn("pialarm_queue_depth 1\n", text)
+        self.assertIn("pialarm_mqtt_reconnects_total 2\n", text)
+        self.assertIn("pialarm_process_resident_memory_bytes ", text)
+        self.assertIn('pialarm_state_change_latency_seconds_count{pin="27",stage="ack"} 1\n', text)
+
+    @patch("app.metrics.timer", new_callable=StartupTimer)
+    def test_render_startup_timing(self, timer):
+        timer.phases["gpio"] = 0.25
+        timer.milestones["first_publish"] = 1.5
+        text = self._exporter().render()
+        self.assertIn('pialarm_startup_phase_seconds{phase="gpio"} 0.25\n', text)
+        self.assertIn('pialarm_startup_milestone_seconds{milestone="first_publish"} 1.5\n', text)
+
+    def test_disabled_by_default(self):
+        exporter = self._exporter()
+        self.assertFalse(exporter.config.enabled)
+        exporter.start()
+        self.assertEqual(exporter.threads, [])
+        exporter.stop()
+
+    def test_http_endpoint(self):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        exporter = self._exporter(port=port)
+        exporter.start()
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+                self.assertEqual(response.status, 200)
+                self.assertIn(b"pialarm_messages_published_total 4", response.read())
+        finally:
+            exporter.stop()
+        self.assertEqual(exporter.threads, [])
+
+    def test_textfile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "pialarm.prom")
+            exporter = self._exporter(textfile=path)
+            exporter.write_textfile()
+            with open(path) as f:
+                self.assertIn("pialarm_gpio_reads_total 12", f.read())
+            self.assertFalse(os.path.exists(path + ".tmp"))
+
+
+if __name__ == "__main__":
+    unittest.main()
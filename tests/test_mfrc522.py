@@ -0,0 +1,62 @@
+import unittest
+from unittest import TestCase
+
+from app.fake_mfrc522 import FakeSpiBus
+from app.mfrc522 import MFRC522, crc_a
+
+
+class TestMfrc522(TestCase):
+
+    def setUp(self):
+        self.bus = FakeSpiBus()
+        self.chip = self.bus.add(8, 25)
+        self.reader = MFRC522(self.bus, 8, 25)
+        self.assertEqual(self.reader.init(), 0x92)
+
+    def _read(self):
+        self.reader.start_wake()
+        if not self.reader.poll_transceive():
+            return None
+        uid = self.reader.select()
+        self.reader.halt()
+        return uid
+
+    def test_crc_a(self):
+        # HLTA frame of ISO 14443-3
+        self.assertEqual(crc_a(bytes((0x50, 0x00))), bytes((0x57, 0xCD)))
+
+    def test_no_tag(self):
+        self.assertIsNone(self._read())
+
+    def test_single_size_uid(self):
+        self.chip.place(bytes.fromhex("DEADBEEF"))
+        self.assertEqual(self._read(), bytes.fromhex("DEADBEEF"))
+
+    def test_double_size_uid(self):
+        self.chip.place(bytes.fromhex("04A1B2C3D4E5F6"))
+        self.assertEqual(self._read(), bytes.fromhex("04A1B2C3D4E5F6"))
+
+    def test_halted_tag_is_read_again_after_wake(self):
+        self.chip.place(bytes.fromhex("DEADBEEF"))
+        self.assertIsNotNone(self._read())
+        self.assertEqual(self._read(), bytes.fromhex("DEADBEEF"))
+        self.chip.remove()
+        self.assertIsNone(self._read())
+
+    def test_readers_share_the_bus(self):
+        other_chip = self.bus.add(7, 24)
+        other = MFRC522(self.bus, 7, 24)
+        other.init()
+        other_chip.place(bytes.fromhex("01020304"))
+        self.reader.start_wake()
+        other.start_wake()
+        self.assertEqual(self.reader.poll_transceive(), b"")
+        self.assertEqual(other.poll_transceive(), bytes((0x04, 0x00)))
+        self.assertEqual(other.select(), bytes.fromhex("01020304"))
+
+    def test_missing_reader_reads_all_ones(self):
+        self.assertEqual(MFRC522(self.bus, 5, 6).init(), 0xFF)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,6 +18,26 @@ class TestMessageModel(TestCase):
         self.assertEqual(message.qos, 0)
 
 
+class TestSensorsConfig(TestCase):
+
+    def test_pins_by_chip(self):
+        config = SensorsConfig(
+            sensors={27: "porta", 5: "garage", 22: "finestra"},
+            chips={5: "/dev/gpiochip1"},
+        )
+        self.assertEqual(config.chip_for(27), "/dev/gpiochip0")
+        self.assertEqual(config.chip_for(5), "/dev/gpiochip1")
+        self.assertEqual(
+            config.pins_by_chip(),
+            {"/dev/gpiochip0": [27, 22], "/dev/gpiochip1": [5]},
+        )
+
+    def test_debounce_for(self):
+        config = SensorsConfig(sensors={27: "porta", 5: "garage"}, debounce_times={5: 0.2})
+        self.assertEqual(config.debounce_for(27), 0.05)
+        self.assertEqual(config.debounce_for(5), 0.2)
+
+
 @parameterized.expand(
     [
         ({"GPIO_MOCK": "true"}, False),
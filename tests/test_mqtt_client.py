@@ -2,7 +2,26 @@ import unittest
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
-from app.mqtt_client import MqttClient
+import paho.mqtt.client as mqtt
+
+from app.models import MqttConfig, MqttProtocol
+from app.mqtt_client import Backoff, MqttClient
+
+
+class TestBackoff(TestCase):
+
+    def test_delays_grow_up_to_max(self):
+        backoff = Backoff(1.0, 8.0)
+        with patch('app.mqtt_client.random.uniform', side_effect=lambda low, high: high):
+            delays = [backoff.next_delay() for _ in range(6)]
+        self.assertEqual(delays, [1.0, 2.0, 4.0, 8.0, 8.0, 8.0])
+
+    def test_reset(self):
+        backoff = Backoff(1.0, 8.0)
+        for _ in range(4):
+            backoff.next_delay()
+        backoff.reset()
+        self.assertLessEqual(backoff.next_delay(), 1.0)
 
 
 class TestMqttClient(TestCase):
@@ -16,13 +35,20 @@ class TestMqttClient(TestCase):
         self.config.password = 'test_password'
         self.config.address = 'mqtt://test-broker'
         self.config.port = 1883
+        self.config.client_id = 'adapter-test'
+        self.config.clean_session = False
+        self.config.keepalive = 120
+        self.config.reconnect_min_delay = 1.0
+        self.config.reconnect_max_delay = 8.0
+        self.config.protocol = MqttProtocol.V311
+        self.config.status_topic = ''
 
         self.mock_client = MagicMock()
         self.mock_client.username_pw_set.return_value = None
         self.mock_client.connect.return_value = None
 
         self.client_patcher = patch('app.mqtt_client.mqtt.Client', return_value=self.mock_client)
-        self.client_patcher.start()
+        self.client_class_mock = self.client_patcher.start()
         self.mqtt_client = MqttClient(self.config)
 
     def tearDown(self):
@@ -35,9 +61,138 @@ class TestMqttClient(TestCase):
             'mqtt://test-broker', 1883, 0
         )
 
-    def test_connect(self):
+    def test_persistent_session(self):
+        self.client_class_mock.assert_called_once_with(
+            client_id='adapter-test', clean_session=False, reconnect_on_failure=False
+        )
+
+    def test_on_connect_resets_backoff_and_notifies(self):
+        listener = MagicMock()
+        self.mqtt_client.add_connect_listener(listener)
+        self.mqtt_client.backoff.attempts = 3
+        self.mqtt_client._on_connect(None, None, None, 0)
+        self.assertEqual(self.mqtt_client.backoff.attempts, 0)
+        listener.assert_called_once()
+
+    def test_on_connect_refused_keeps_backoff(self):
+        listener = MagicMock()
+        self.mqtt_client.add_connect_listener(listener)
+        self.mqtt_client.backoff.attempts = 3
+        self.mqtt_client._on_connect(None, None, None, 5)
+        self.assertEqual(self.mqtt_client.backoff.attempts, 3)
+        listener.assert_not_called()
+
+    def test_subscribe_is_renewed_on_connect(self):
+        callback = MagicMock()
+        self.mock_client.is_connected.return_value = False
+        self.mqtt_client.subscribe('alarm/allow', callback)
+        self.mock_client.subscribe.assert_not_called()
+        self.mqtt_client._on_connect(self.mock_client, None, None, 0)
+        self.mock_client.subscribe.assert_called_once_with('alarm/allow', 1)
+        topic, handler = self.mock_client.message_callback_add.call_args.args
+        handler(self.mock_client, None, MagicMock(payload=b'DEADBEEF'))
+        callback.assert_called_once_with(b'DEADBEEF')
+
+    def test_reconfigure_reconnects_on_broker_change(self):
+        self.mqtt_client.config = MqttConfig(username='u', password='p', client_id='adapter-test')
+        self.mock_client.is_connected.return_value = True
+        new = MqttConfig(address='broker2', username='u', password='p', client_id='adapter-test')
+        self.assertTrue(self.mqtt_client.reconfigure(new))
+        self.assertTrue(self.mqtt_client.reconfigured)
+        self.mock_client.username_pw_set.assert_called_with('u', 'p')
+        self.mock_client.disconnect.assert_called_once()
+        self.assertEqual(self.mqtt_client.config.address, 'broker2')
+
+    def test_last_will_marks_the_adapter_offline(self):
+        self.mock_client.will_clear.assert_called_once()
+        self.mqtt_client.config = MqttConfig(username='u', password='p')
+        new = MqttConfig(username='u', password='p', topic_prefix='home/{device}/', device_id='pi1')
+        self.mqtt_client.reconfigure(new)
+        self.mock_client.will_set.assert_called_once_with('home/pi1/status', 'offline', qos=1, retain=True)
+
+    def test_reconfigure_keeps_connection(self):
+        self.mqtt_client.config = MqttConfig(username='u', password='p', client_id='adapter-test')
+        new = MqttConfig(username='u', password='p', client_id='other', reconnect_max_delay=30)
+        self.assertFalse(self.mqtt_client.reconfigure(new))
+        self.mock_client.disconnect.assert_not_called()
+        self.assertEqual(self.mqtt_client.config.client_id, 'adapter-test')
+        self.assertEqual(self.mqtt_client.backoff.max_delay, 30)
+
+    def test_run_connects_with_new_settings_without_backoff(self):
+        self.mqtt_client.config = MqttConfig(username='u', password='p')
+        loops = iter([lambda: setattr(self.mqtt_client, 'reconfigured', True), self.mqtt_client.stop_event.set])
+        self.mock_client.loop_forever.side_effect = lambda: next(loops)()
+        with patch.object(self.mqtt_client.backoff, 'next_delay') as delay_mock:
+            self.mqtt_client._run()
+        self.assertEqual(self.mock_client.connect.call_count, 2)
+        self.mock_client.reconnect.assert_not_called()
+        delay_mock.assert_not_called()
+
+    @patch('app.mqtt_client.threading.Thread')
+    def test_connect(self, thread_mock):
         self.mqtt_client.connect()
+        thread_mock.assert_called_once_with(target=self.mqtt_client._run, daemon=True)
+        thread_mock.return_value.start.assert_called_once()
+
+    def test_run_connects_once(self):
+        self.mock_client.loop_forever.side_effect = self.mqtt_client.stop_event.set
+        self.mqtt_client._run()
         self.mock_client.connect.assert_called_once_with('mqtt://test-broker', 1883, keepalive=120)
+        self.mock_client.reconnect.assert_not_called()
+
+    def test_run_reconnects_with_backoff(self):
+        self.mock_client.connect.side_effect = OSError("refused")
+        self.mock_client.reconnect.side_effect = OSError("refused")
+        self.mqtt_client.stop_event = MagicMock()
+        self.mqtt_client.stop_event.is_set.side_effect = [False, False, False, False, True]
+        self.mqtt_client._run()
+        self.assertEqual(self.mock_client.connect.call_count, 2)
+        self.mock_client.reconnect.assert_not_called()
+        waits = [c.args[0] for c in self.mqtt_client.stop_event.wait.call_args_list]
+        self.assertEqual(len(waits), 2)
+        self.assertTrue(all(1.0 <= delay <= 2.0 for delay in waits))
+
+    def test_run_survives_an_error_in_a_callback(self):
+        self.mock_client.loop_forever.side_effect = [AttributeError("bad payload"), None]
+        self.mqtt_client.stop_event = MagicMock()
+        self.mqtt_client.stop_event.is_set.side_effect = [False, False, False, False, False, True]
+        self.mqtt_client._run()
+        self.assertEqual(self.mock_client.loop_forever.call_count, 2)
+        self.logger_mock.exception.assert_called_once()
+
+    def test_run_uses_reconnect_after_first_connection(self):
+        self.mqtt_client.stop_event = MagicMock()
+        self.mqtt_client.stop_event.is_set.side_effect = [False, False, False, False, False, True]
+        self.mqtt_client._run()
+        self.mock_client.connect.assert_called_once()
+        self.mock_client.reconnect.assert_called_once()
+        self.assertEqual(self.mqtt_client.reconnects, 1)
+
+    def test_run_async_connects_off_the_event_loop(self):
+        import asyncio
+        import time
+
+        def slow_connect(*args, **kwargs):
+            time.sleep(0.3)
+            raise OSError("timed out")
+
+        self.mock_client.connect.side_effect = slow_connect
+
+        async def scenario():
+            task = asyncio.create_task(self.mqtt_client.run_async())
+            gaps = []
+            for _ in range(20):
+                started = time.monotonic()
+                await asyncio.sleep(0.01)
+                gaps.append(time.monotonic() - started)
+            self.assertEqual(self.mock_client.connect.call_count, 1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return max(gaps)
+
+        # the loop kept running while the connection attempt was blocked
+        self.assertLess(asyncio.run(scenario()), 0.2)
 
     def test_disconnect(self):
         self.mqtt_client.disconnect()
@@ -48,10 +203,84 @@ class TestMqttClient(TestCase):
         message = 'Test message'
         qos = 1
 
-        self.mqtt_client.publish_message(topic, message, qos)
+        self.mock_client.publish.return_value.mid = 7
+
+        mid = self.mqtt_client.publish_message(topic, message, qos, retain=True)
+
+        self.mock_client.publish.assert_called_once_with(topic, message, qos, True)
+        self.assertEqual(mid, 7)
+
+    def test_on_publish_notifies_listeners(self):
+        listener = MagicMock()
+        self.mqtt_client.add_publish_listener(listener)
+        self.mqtt_client._on_publish(None, None, 7)
+        listener.assert_called_once_with(7)
+
 
-        self.mock_client.publish.assert_called_once_with(topic, message, qos)
+class TestMqttClientV5(TestCase):
+
+    def setUp(self):
+        self.config = MqttConfig(
+            username='test_user', password='test_password', address='broker', client_id='adapter-test',
+            protocol=MqttProtocol.V5, message_expiry=30,
+        )
+        self.mock_client = MagicMock()
+        self.mock_client.publish.return_value.mid = 1
+        self.client_patcher = patch('app.mqtt_client.mqtt.Client', return_value=self.mock_client)
+        self.client_class_mock = self.client_patcher.start()
+        self.mqtt_client = MqttClient(self.config)
+
+    def tearDown(self):
+        self.client_patcher.stop()
+
+    def test_client_uses_v5(self):
+        self.client_class_mock.assert_called_once_with(
+            client_id='adapter-test', protocol=mqtt.MQTTv5, reconnect_on_failure=False
+        )
+
+    def test_connect_resumes_session(self):
+        self.mqtt_client._connect()
+        kwargs = self.mock_client.connect.call_args.kwargs
+        self.assertFalse(kwargs['clean_start'])
+        self.assertEqual(kwargs['properties'].SessionExpiryInterval, 86400)
+
+    def test_topic_alias_replaces_topic_after_first_publish(self):
+        self.mqtt_client._on_connect(None, None, None, 0, MagicMock(TopicAliasMaximum=1))
+        self.mqtt_client.publish_message('alarm/a/status', 'open', 0, user_properties=(('pin', '27'),))
+        self.mqtt_client.publish_message('alarm/a/status', 'closed', 0)
+        self.mqtt_client.publish_message('alarm/b/status', 'open', 0)
+        (first, second, third) = [c.args for c in self.mock_client.publish.call_args_list]
+        self.assertEqual(first[0], 'alarm/a/status')
+        self.assertEqual(first[4].TopicAlias, 1)
+        self.assertEqual(first[4].MessageExpiryInterval, 30)
+        self.assertEqual(first[4].UserProperty, [('pin', '27')])
+        self.assertEqual(second[0], '')
+        self.assertEqual(second[4].TopicAlias, 1)
+        self.assertEqual(third[0], 'alarm/b/status')
+        self.assertFalse(hasattr(third[4], 'TopicAlias'))
+
+    def test_messages_paho_may_resend_keep_their_topic(self):
+        self.mqtt_client._on_connect(None, None, None, 0, MagicMock(TopicAliasMaximum=5))
+        self.mqtt_client.publish_message('alarm/a/status', 'open', 0)
+        for qos in (1, 2):
+            self.mqtt_client.publish_message('alarm/a/status', 'closed', qos)
+            topic, _, _, _, properties = self.mock_client.publish.call_args.args
+            self.assertEqual(topic, 'alarm/a/status')
+            self.assertFalse(hasattr(properties, 'TopicAlias'))
+
+    def test_no_alias_when_broker_does_not_allow_them(self):
+        self.mqtt_client._on_connect(None, None, None, 0, None)
+        self.mqtt_client.publish_message('alarm/a/status', 'open', 0)
+        self.mqtt_client.publish_message('alarm/a/status', 'open', 0)
+        self.assertEqual(self.mock_client.publish.call_args.args[0], 'alarm/a/status')
 
+    def test_pre_connect_forgets_the_aliases(self):
+        self.mqtt_client._on_connect(None, None, None, 0, MagicMock(TopicAliasMaximum=5))
+        self.mqtt_client.publish_message('alarm/a/status', 'open', 0)
+        self.mqtt_client._on_pre_connect(MagicMock(), None)
+        self.assertEqual((self.mqtt_client.aliases, self.mqtt_client.alias_maximum), ({}, 0))
+        self.mqtt_client.publish_message('alarm/a/status', 'open', 0)
+        self.assertEqual(self.mock_client.publish.call_args.args[0], 'alarm/a/status')
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,207 @@
+import queue
+import threading
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from app.models import OverflowPolicy, PayloadFormat
+from app.publisher import (
+    DIGEST_HEADER, DeliveryTracker, OutboundMessage, OutboundQueue, encode_access, encode_digest, encode_payload,
+)
+
+
+class TestEncodePayload(TestCase):
+
+    def test_plain(self):
+        self.assertEqual(encode_payload(PayloadFormat.PLAIN, "open", 27, "porta"), "open")
+
+    def test_json(self):
+        self.assertEqual(
+            encode_payload(PayloadFormat.JSON, "closed", 27, "porta"),
+            '{"status":"closed","pin":27,"name":"porta"}',
+        )
+
+    def test_binary(self):
+        self.assertEqual(encode_payload(PayloadFormat.BINARY, "open", 27, "porta"), b"\x1b\x00\x01")
+        self.assertEqual(encode_payload(PayloadFormat.BINARY, "closed", 27, "porta"), b"\x1b\x00\x00")
+
+
+class TestEncodeAccess(TestCase):
+
+    def test_decision(self):
+        uid = bytes.fromhex("DEADBEEF")
+        self.assertEqual(encode_access(PayloadFormat.PLAIN, "entrance", uid, "Anna"), "granted")
+        self.assertEqual(encode_access(PayloadFormat.PLAIN, "entrance", uid, None), "denied")
+        self.assertEqual(encode_access(PayloadFormat.BINARY, "entrance", uid, ""), b"\x01")
+        self.assertEqual(
+            encode_access(PayloadFormat.JSON, "entrance", uid, None),
+            '{"uid":"DEADBEEF","reader":"entrance","granted":false,"label":""}',
+        )
+
+
+class TestEncodeDigest(TestCase):
+
+    def test_bitmap_of_the_states(self):
+        values = [True, False, True] + [False] * 6 + [True]
+        self.assertEqual(encode_digest(PayloadFormat.PLAIN, 7, values), "7,10,0502")
+        self.assertEqual(encode_digest(PayloadFormat.JSON, 7, values), '{"seq":7,"sensors":10,"bitmap":"0502"}')
+        payload = encode_digest(PayloadFormat.BINARY, 7, values)
+        self.assertEqual(DIGEST_HEADER.unpack_from(payload), (7, 10))
+        self.assertEqual(payload[DIGEST_HEADER.size:], b"\x05\x02")
+
+
+class TestOutboundQueue(TestCase):
+
+    def test_get_batch_preserves_order(self):
+        q = OutboundQueue(10)
+        for i in range(5):
+            q.put(OutboundMessage(f"t{i}", "open"))
+        batch = q.get_batch(3, timeout=0)
+        self.assertEqual([m.topic for m in batch], ["t0", "t1", "t2"])
+        self.assertEqual(q.qsize(), 2)
+
+    def test_get_batch_timeout_returns_empty(self):
+        self.assertEqual(OutboundQueue(10).get_batch(5, timeout=0.01), [])
+
+    def test_block_policy_raises_when_full_without_blocking(self):
+        q = OutboundQueue(1, OverflowPolicy.BLOCK)
+        q.put(OutboundMessage("a", "open"))
+        with self.assertRaises(queue.Full):
+            q.put(OutboundMessage("b", "open"), block=False)
+        with self.assertRaises(queue.Full):
+            q.put(OutboundMessage("b", "open"), timeout=0.01)
+
+    def test_block_policy_waits_for_consumer(self):
+        q = OutboundQueue(1, OverflowPolicy.BLOCK)
+        q.put(OutboundMessage("a", "open"))
+        consumer = threading.Timer(0.05, q.get_batch, args=(1, 0))
+        consumer.start()
+        q.put(OutboundMessage("b", "open"), timeout=2)
+        consumer.join()
+        self.assertEqual([m.topic for m in q.get_batch(5, timeout=0)], ["b"])
+
+    def test_drop_oldest_policy(self):
+        q = OutboundQueue(2, OverflowPolicy.DROP_OLDEST)
+        for topic in ("a", "b", "c"):
+            q.put(OutboundMessage(topic, "open"))
+        self.assertEqual([m.topic for m in q.get_batch(5, timeout=0)], ["b", "c"])
+        self.assertEqual(q.counters["dropped"], 1)
+        self.assertEqual(q.counters["max_depth"], 2)
+
+    def test_coalesce_policy_replaces_same_topic(self):
+        q = OutboundQueue(2, OverflowPolicy.COALESCE)
+        q.put(OutboundMessage("a", "open"))
+        q.put(OutboundMessage("b", "open"))
+        q.put(OutboundMessage("a", "closed"))
+        batch = q.get_batch(5, timeout=0)
+        self.assertEqual([(m.topic, m.payload) for m in batch], [("a", "closed"), ("b", "open")])
+        self.assertEqual(q.counters["coalesced"], 1)
+        self.assertEqual(q.counters["dropped"], 0)
+
+    def test_coalesce_policy_drops_oldest_for_new_topic(self):
+        q = OutboundQueue(2, OverflowPolicy.COALESCE)
+        for topic in ("a", "b", "c"):
+            q.put(OutboundMessage(topic, "open"))
+        self.assertEqual([m.topic for m in q.get_batch(5, timeout=0)], ["b", "c"])
+
+
+    def test_coalesce_keeps_latest_state_per_topic(self):
+        q = OutboundQueue(10, OverflowPolicy.BLOCK, coalesce=True)
+        for payload in ("open", "closed", "open"):
+            q.put(OutboundMessage("a", payload))
+        q.put(OutboundMessage("b", "open"))
+        batch = q.get_batch(5, timeout=0)
+        self.assertEqual([(m.topic, m.payload) for m in batch], [("a", "open"), ("b", "open")])
+        self.assertEqual(q.counters["coalesced"], 2)
+
+    @patch("app.publisher.time.monotonic")
+    def test_window_holds_until_topic_is_quiet(self, monotonic_mock):
+        q = OutboundQueue(10, coalesce=True, window=0.1, max_latency=1.0)
+        monotonic_mock.return_value = 100.0
+        q.put(OutboundMessage("a", "open"))
+        monotonic_mock.return_value = 100.05
+        q.put(OutboundMessage("a", "closed"))
+        self.assertEqual(q.get_batch(5, timeout=0), [])
+        monotonic_mock.return_value = 100.16
+        self.assertEqual([m.payload for m in q.get_batch(5, timeout=0)], ["closed"])
+
+    @patch("app.publisher.time.monotonic")
+    def test_window_bounded_by_max_latency(self, monotonic_mock):
+        q = OutboundQueue(10, coalesce=True, window=0.1, max_latency=0.3)
+        for step in range(4):
+            monotonic_mock.return_value = 100.0 + step * 0.09
+            q.put(OutboundMessage("a", str(step)))
+        self.assertEqual(q.get_batch(5, timeout=0), [])
+        monotonic_mock.return_value = 100.3
+        self.assertEqual([m.payload for m in q.get_batch(5, timeout=0)], ["3"])
+
+    def test_get_batch_waits_for_window(self):
+        q = OutboundQueue(10, coalesce=True, window=0.05)
+        q.put(OutboundMessage("a", "open"))
+        self.assertEqual([m.topic for m in q.get_batch(5, timeout=1)], ["a"])
+
+    def test_flush_ignores_window(self):
+        q = OutboundQueue(10, coalesce=True, window=10)
+        q.put(OutboundMessage("a", "open"))
+        self.assertEqual([m.topic for m in q.get_batch(5, timeout=0, flush=True)], ["a"])
+
+    def test_wake_interrupts_wait(self):
+        q = OutboundQueue(10)
+        threading.Timer(0.05, q.wake).start()
+        self.assertEqual(q.get_batch(5, timeout=5), [])
+
+    def test_on_ready_and_ready_in(self):
+        calls = []
+        q = OutboundQueue(10, coalesce=True, window=10, max_latency=20)
+        q.on_ready = lambda: calls.append(1)
+        self.assertIsNone(q.ready_in())
+        q.put(OutboundMessage("a", "open"))
+        q.put(OutboundMessage("a", "closed"))
+        q.wake()
+        self.assertEqual(len(calls), 3)
+        self.assertAlmostEqual(q.ready_in(), 10, delta=0.1)
+
+    def test_on_discard_reports_dropped_and_replaced(self):
+        discarded = []
+        q = OutboundQueue(1, OverflowPolicy.COALESCE)
+        q.on_discard = discarded.append
+        q.put(OutboundMessage("a", "open"))
+        q.put(OutboundMessage("a", "closed"))
+        q.put(OutboundMessage("b", "open"))
+        self.assertEqual([(m.topic, m.payload) for m in discarded], [("a", "open"), ("a", "closed")])
+
+
+class TestDeliveryTracker(TestCase):
+
+    def test_ack_records_broker_state(self):
+        tracker = DeliveryTracker()
+        message = OutboundMessage("a", "open", 2)
+        tracker.queued(message)
+        tracker.sent(message, 1)
+        self.assertFalse(tracker.is_delivered(message))
+        tracker.acknowledged(1)
+        self.assertEqual(tracker.acked, {"a": b"open"})
+        self.assertTrue(tracker.is_delivered(message))
+        self.assertEqual(tracker.out_of_sync(), [])
+
+    def test_ack_before_sent(self):
+        tracker = DeliveryTracker()
+        message = OutboundMessage("a", "open")
+        tracker.queued(message)
+        tracker.acknowledged(5)
+        tracker.sent(message, 5)
+        self.assertEqual(tracker.inflight, {})
+        self.assertTrue(tracker.is_delivered(message))
+
+    def test_out_of_sync_skips_pending_topics(self):
+        tracker = DeliveryTracker()
+        lost = OutboundMessage("a", "open")
+        waiting = OutboundMessage("b", "open")
+        tracker.queued(lost)
+        tracker.queued(waiting)
+        tracker.discarded(lost)
+        self.assertEqual(tracker.out_of_sync(), [lost])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app.models import MetricsConfig, MqttConfig, RfidConfig, SensorsConfig, SimulatorConfig
+from app.reload import ConfigReloader, FileWatcher
+from app.services import MqttService, RfidService, SensorsService
+
+
+class TestFileWatcher(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "config.ini")
+        with open(self.path, "w") as f:
+            f.write("[mqtt]\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, path):
+        with open(path, "w") as f:
+            f.write("[sensors]\n")
+
+    def test_inotify(self):
+        watcher = FileWatcher(self.path)
+        self.addCleanup(watcher.close)
+        self.assertIsNotNone(watcher.fd)
+        self.assertFalse(watcher.changed())
+        self._write(os.path.join(self.directory.name, "other.ini"))
+        self.assertFalse(watcher.changed())
+        self._write(self.path)
+        self.assertTrue(watcher.changed())
+        self.assertFalse(watcher.changed())
+
+    def test_replaced_by_rename(self):
+        watcher = FileWatcher(self.path)
+        self.addCleanup(watcher.close)
+        self._write(self.path + ".tmp")
+        os.replace(self.path + ".tmp", self.path)
+        self.assertTrue(watcher.changed())
+
+    def test_modification_time_without_inotify(self):
+        with patch("ctypes.CDLL", side_effect=OSError("no libc")):
+            watcher = FileWatcher(self.path)
+        self.assertIsNone(watcher.fd)
+        self.assertFalse(watcher.changed())
+        os.utime(self.path, ns=(0, 0))
+        self.assertTrue(watcher.changed())
+
+
+class TestConfigReloader(TestCase):
+
+    def setUp(self):
+        self.configs = (
+            MqttConfig(username="u", password="p", client_id="adapter"),
+            SensorsConfig(sensors={27: "porta"}),
+            RfidConfig(sensors={}),
+            MetricsConfig(),
+            SimulatorConfig(interval=10),
+        )
+        self.loader = MagicMock(return_value=self.configs)
+        self.mqtt_service = MagicMock(spec=MqttService)
+        self.sensors_service = MagicMock(spec=SensorsService)
+        self.rfid_service = MagicMock(spec=RfidService)
+        self.reloader = ConfigReloader(
+            self.mqtt_service, self.sensors_service, self.rfid_service, self.configs, "config.ini", self.loader
+        )
+
+    def _load(self, **changes):
+        configs = list(self.configs)
+        for index, update in changes.items():
+            configs[int(index[1:])] = configs[int(index[1:])].model_copy(update=update)
+        self.loader.return_value = tuple(configs)
+
+    def test_nothing_changed(self):
+        self.assertEqual(self.reloader.reload(), set())
+        self.mqtt_service.apply_config.assert_not_called()
+        self.sensors_service.apply_config.assert_not_called()
+        self.rfid_service.apply_config.assert_not_called()
+
+    def test_only_changed_parts_are_applied(self):
+        self._load(c1={"sensors": {27: "porta", 22: "finestra"}})
+        self.assertEqual(self.reloader.reload(), {"sensors"})
+        self.sensors_service.apply_config.assert_called_once_with(self.loader.return_value[1])
+        self.mqtt_service.apply_config.assert_not_called()
+        # the new config is the running one now
+        self.assertEqual(self.reloader.reload(), set())
+
+    def test_restart_only_sections(self):
+        self._load(c3={"port": 9100}, c0={"address": "broker2"})
+        with self.assertLogs("app.reload", "WARNING"):
+            self.assertEqual(self.reloader.reload(), {"mqtt"})
+        self.assertEqual(self.reloader.configs[3], self.configs[3])
+
+    def test_invalid_config_is_ignored(self):
+        self.loader.side_effect = ValueError("bad pin")
+        with self.assertLogs("app.reload", "ERROR"):
+            self.assertEqual(self.reloader.reload(), set())
+        self.assertIs(self.reloader.configs, self.configs)
+
+    def test_check_on_request(self):
+        self._load(c2={"dedup_window": 5})
+        self.assertEqual(self.reloader.check(), set())
+        self.reloader.request()
+        self.assertEqual(self.reloader.check(), {"rfid"})
+        self.assertEqual(self.reloader.check(), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import signal
+import unittest
+from unittest import TestCase
+
+from app import fake_gpiod
+from app.metrics import MetricsExporter
+from app.fake_mfrc522 import FakeSpiBus
+from app.models import MetricsConfig, MqttConfig, RfidConfig, SensorsConfig, SimulatorConfig
+from app.mqtt_client import MqttClient
+from app.publisher import OutboundQueue
+from app.reload import ConfigReloader
+from app.runtime import AsyncRuntime
+from app.services import MqttService, RfidService, SensorsService
+from app.simulator import GpioSimulator
+from benchmarks.broker import BrokerStandIn
+
+
+class TestAsyncRuntime(TestCase):
+
+    def setUp(self):
+        self.broker = BrokerStandIn().start()
+        mqtt_config = MqttConfig(
+            address="127.0.0.1", port=self.broker.port, username="", password="",
+            client_id="runtime-test", spool_size=0, reconnect_min_delay=0.05,
+        )
+        sensors_config = SensorsConfig(sensors={4: "door", 5: "window"}, debounce=0.02)
+        self.configs = (mqtt_config, sensors_config, RfidConfig(sensors={"entrance": "8,25"}), MetricsConfig(),
+                        SimulatorConfig())
+        self.client = MqttClient(mqtt_config)
+        self.mqtt_service = MqttService(self.client, OutboundQueue())
+        self.sensors_service = SensorsService(sensors_config, self.mqtt_service, gpio_backend=fake_gpiod)
+        self.spi_bus = FakeSpiBus()
+        self.reader = self.spi_bus.add(8, 25)
+        rfid_service = RfidService(self.configs[2], self.mqtt_service, self.spi_bus)
+        self.reloader = ConfigReloader(
+            self.mqtt_service, self.sensors_service, rfid_service, self.configs, "/nonexistent/config.ini",
+            lambda: self.configs,
+        )
+        self.runtime = AsyncRuntime(
+            self.mqtt_service,
+            self.sensors_service,
+            rfid_service,
+            GpioSimulator(sensors_config, SimulatorConfig()),
+            MetricsExporter(MetricsConfig(), self.mqtt_service, self.sensors_service),
+            self.reloader,
+        )
+
+    def tearDown(self):
+        self.broker.stop()
+        fake_gpiod.reset()
+
+    async def _wait(self, condition, timeout=5.0):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not condition():
+            self.assertLess(asyncio.get_running_loop().time(), deadline)
+            await asyncio.sleep(0.005)
+
+    def test_edges_published_and_clean_shutdown_on_sigterm(self):
+        async def scenario():
+            task = asyncio.create_task(self.runtime.run())
+            await self._wait(self.client.is_connected)
+            chip = fake_gpiod.chip("/dev/gpiochip0")
+            chip.set_value(4, 0)
+            # bounce: back and forth inside the debounce window
+            chip.set_value(5, 0)
+            chip.set_value(5, 1)
+            await self._wait(lambda: len(self.broker.messages) >= 1)
+            await asyncio.sleep(0.05)
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.wait_for(task, 5)
+
+        asyncio.run(scenario())
+        self.assertEqual([(m.topic, m.payload) for m in self.broker.messages], [("alarm/door/status", b"closed")])
+        self.assertFalse(self.client.is_connected())
+        self.assertEqual(self.mqtt_service.acknowledged, 1)
+
+    def test_reconnects_when_the_broker_drops_the_connection(self):
+        async def scenario():
+            task = asyncio.create_task(self.runtime.run())
+            await self._wait(self.client.is_connected)
+            self.broker.drop_connections()
+            await self._wait(lambda: self.client.reconnects >= 1 and self.client.is_connected())
+            fake_gpiod.chip("/dev/gpiochip0").set_value(4, 0)
+            await self._wait(lambda: len(self.broker.messages) >= 1)
+            self.runtime.stop()
+            await asyncio.wait_for(task, 5)
+
+        asyncio.run(scenario())
+
+    def test_rfid_reads_published(self):
+        async def scenario():
+            task = asyncio.create_task(self.runtime.run())
+            await self._wait(self.client.is_connected)
+            self.reader.place(bytes.fromhex("04A1B2C3D4E5F6"))
+            await self._wait(lambda: len(self.broker.messages) >= 1)
+            self.runtime.stop()
+            await asyncio.wait_for(task, 5)
+
+        asyncio.run(scenario())
+        self.assertEqual((self.broker.messages[0].topic, self.broker.messages[0].payload),
+                         ("alarm/entrance/tag", b"04A1B2C3D4E5F6"))
+        self.assertFalse(self.spi_bus.opened)
+
+    def test_sighup_reloads_the_sensors(self):
+        async def scenario():
+            task = asyncio.create_task(self.runtime.run())
+            await self._wait(self.client.is_connected)
+            sensors_config = self.configs[1].model_copy(update={"sensors": {4: "door", 6: "garage"}})
+            self.configs = (self.configs[0], sensors_config) + self.configs[2:]
+            os.kill(os.getpid(), signal.SIGHUP)
+            await self._wait(lambda: self.reloader.reloads == 1)
+            fake_gpiod.chip("/dev/gpiochip0").set_value(6, 0)
+            await self._wait(lambda: len(self.broker.messages) >= 1)
+            self.runtime.stop()
+            await asyncio.wait_for(task, 5)
+
+        asyncio.run(scenario())
+        self.assertEqual([(m.topic, m.payload) for m in self.broker.messages], [("alarm/garage/status", b"closed")])
+        self.assertFalse(self.client.is_connected())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,18 @@
 import os
+import tempfile
 import unittest
 import threading
 from unittest import TestCase
 from unittest.mock import MagicMock, patch, call
-from app.models import MessageModel
+from app import fake_gpiod
+from app.fake_mfrc522 import FakeSpiBus
+from app.inputs import GpiodDriver
+from app.models import MessageModel, MqttConfig, PayloadFormat, RfidConfig, SensorsConfig
 from app.mqtt_client import MqttClient
-from app.services import MqttService, SensorsService, MockSensorService
+from app.publisher import OutboundQueue
+from app.services import MqttService, RfidService, SensorsService, SensorState
+from app.spool import MessageSpool
+from app.topics import TopicTable
 
 
 class TestMqttService(TestCase):
@@ -14,12 +21,219 @@ class TestMqttService(TestCase):
         self.mqtt_client_mock = MagicMock(spec=MqttClient)
         self.mqtt_service = MqttService(self.mqtt_client_mock)
 
+    def _published(self):
+        return [c.args[:4] for c in self.mqtt_client_mock.publish_message.call_args_list]
+
     def test_publish_message(self):
         message = MessageModel(status="open", name="test", pin=1)
         self.mqtt_service.publish_message(message)
-        self.mqtt_client_mock.publish_message.assert_called_once_with(
-            "alarm/test/status", "open", 0
-        )
+        self.mqtt_client_mock.publish_message.assert_not_called()
+        self.assertEqual(self.mqtt_service.drain(timeout=0), 1)
+        self.mqtt_client_mock.publish_message.assert_called_once()
+        self.assertEqual(self._published()[0], ("alarm/test/status", "open", 0, False))
+
+    def test_publish_state_encodes_each_sensor_once(self):
+        self.mqtt_service.publish_state(27, "porta", 1, 1.0)
+        self.mqtt_service.publish_state(27, "porta", 0, 2.0)
+        route = self.mqtt_service.routes[27]
+        self.mqtt_service.publish_state(27, "ingresso", 1, 3.0)
+        self.mqtt_service.drain(timeout=0)
+        self.assertIsNot(self.mqtt_service.routes[27], route)
+        self.assertEqual(self._published(), [
+            ("alarm/porta/status", "open", 2, False),
+            ("alarm/porta/status", "closed", 2, False),
+            ("alarm/ingresso/status", "open", 2, False),
+        ])
+
+    def test_publish_state_fans_out_to_every_topic(self):
+        self.mqtt_service = MqttService(self.mqtt_client_mock, topics=TopicTable(
+            templates={"ground": ["{name}/status", "zone/{group}"]}, groups={"ground": ["porta"]}
+        ))
+        self.mqtt_service.compile_routes({27: "porta"})
+        self.mqtt_service.publish_state(27, "porta", 1, 1.0)
+        self.mqtt_service.drain(timeout=0)
+        self.assertEqual(self._published(), [
+            ("alarm/porta/status", "open", 2, False),
+            ("alarm/zone/ground", "open", 2, False),
+        ])
+
+    def test_apply_config(self):
+        self.mqtt_client_mock.config = MqttConfig(username="u", password="p")
+        self.mqtt_client_mock.reconfigure.return_value = False
+        config = MqttConfig(username="u", password="p", retain=True, payload_format="json", queue_size=10)
+        with self.assertLogs("app.services", "WARNING"):
+            self.assertFalse(self.mqtt_service.apply_config(config))
+        self.assertTrue(self.mqtt_service.retain)
+        self.assertEqual(self.mqtt_service.payload_format, PayloadFormat.JSON)
+        self.assertEqual(self.mqtt_service.routes, {})
+        self.mqtt_client_mock.reconfigure.assert_called_once_with(config)
+
+    def test_publish_tag(self):
+        self.mqtt_service.publish_tag("entrance", bytes.fromhex("deadbeef"))
+        self.mqtt_service.payload_format = PayloadFormat.JSON
+        self.mqtt_service.publish_tag("entrance", bytes.fromhex("deadbeef"))
+        self.mqtt_service.drain(timeout=0)
+        self.assertEqual(self._published(), [
+            ("alarm/entrance/tag", "DEADBEEF", 1, False),
+            ("alarm/entrance/tag", '{"uid":"DEADBEEF","reader":"entrance"}', 1, False),
+        ])
+
+    def test_drain_counts_failures(self):
+        self.mqtt_client_mock.publish_message.side_effect = [RuntimeError("boom"), None]
+        self.mqtt_service.publish_message(MessageModel(status="open", name="a", pin=1))
+        self.mqtt_service.publish_message(MessageModel(status="open", name="b", pin=2))
+        self.mqtt_service.drain(timeout=0)
+        stats = self.mqtt_service.stats()
+        self.assertEqual(stats["enqueued"], 2)
+        self.assertEqual(stats["published"], 1)
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["depth"], 0)
+
+    def test_publisher_thread_flushes_on_disconnect(self):
+        self.mqtt_service.connect()
+        self.assertTrue(self.mqtt_service.thread.is_alive())
+        for pin in range(3):
+            self.mqtt_service.publish_message(MessageModel(status="open", name=f"s{pin}", pin=pin))
+        self.mqtt_service.disconnect()
+        self.assertIsNone(self.mqtt_service.thread)
+        self.assertEqual(self.mqtt_client_mock.publish_message.call_count, 3)
+        self.mqtt_client_mock.disconnect.assert_called_once()
+
+    def test_offline_messages_are_spooled_and_replayed(self):
+        spool = MagicMock(spec=MessageSpool)
+        spool.depth = 0
+
+        def append(message):
+            spool.depth += 1
+
+        spool.append.side_effect = append
+        self.mqtt_service = MqttService(self.mqtt_client_mock, spool=spool)
+        self.mqtt_client_mock.is_connected.return_value = False
+        self.mqtt_service.publish_message(MessageModel(status="open", name="test", pin=1, qos=2))
+        self.mqtt_service.drain(timeout=0)
+        self.mqtt_client_mock.publish_message.assert_not_called()
+        spool.append.assert_called_once()
+        spool.sync.assert_called_once()
+
+        spool.pending.return_value = [spool.append.call_args[0][0]]
+        self.mqtt_client_mock.is_connected.return_value = True
+        self.mqtt_service.drain(timeout=0)
+        self.assertEqual(self._published(), [("alarm/test/status", "open", 2, False)])
+        spool.consume.assert_called_once_with(1)
+        self.assertEqual(self.mqtt_service.stats()["replayed"], 1)
+
+    def test_listeners_registered_on_client(self):
+        self.mqtt_client_mock.add_connect_listener.assert_called_once_with(self.mqtt_service._on_connected)
+        self.mqtt_client_mock.add_publish_listener.assert_called_once_with(self.mqtt_service._on_published)
+
+    def test_snapshot_is_retained_and_skips_delivered_states(self):
+        self.mqtt_service = MqttService(self.mqtt_client_mock, retain=True, snapshot=True)
+        self.mqtt_service.tracker.acked["alarm/porta/status"] = b"closed"
+        self.mqtt_service.publish_snapshot([
+            MessageModel(status="closed", name="porta", pin=27, qos=2),
+            MessageModel(status="open", name="finestra", pin=22, qos=2),
+        ])
+        self.mqtt_service.drain(timeout=0)
+        self.assertEqual(self._published(), [("alarm/finestra/status", "open", 2, True)])
+
+    def test_snapshot_larger_than_the_queue_waits_for_the_publisher(self):
+        sensors = {pin: f"s{pin}" for pin in range(1200)}
+        self.mqtt_service = MqttService(self.mqtt_client_mock, OutboundQueue(maxsize=1000), snapshot=True)
+        sensors_service = SensorsService(SensorsConfig(sensors=sensors), self.mqtt_service, gpio_backend=fake_gpiod)
+        # before the MQTT connection nothing empties the queue: the call must not block
+        thread = threading.Thread(target=sensors_service.connect_sensors, daemon=True)
+        thread.start()
+        thread.join(5.0)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.mqtt_service.stats()["depth"], 1200)
+        self.mqtt_service.connect()
+        self.mqtt_service.disconnect()
+        sensors_service.close()
+        fake_gpiod.reset()
+        self.assertEqual(self.mqtt_service.published, 1200)
+        self.assertEqual(self._published()[-1][0], "alarm/s1199/status")
+
+    def test_snapshot_disabled(self):
+        self.mqtt_service.publish_snapshot([MessageModel(status="open", name="porta", pin=27)])
+        self.assertEqual(self.mqtt_service.queue.qsize(), 0)
+
+    def test_reconnect_republishes_only_changed_states(self):
+        self.mqtt_client_mock.publish_message.side_effect = [1, 2, 3]
+        for name in ("porta", "finestra"):
+            self.mqtt_service.publish_message(MessageModel(status="open", name=name, pin=1, qos=2))
+        self.mqtt_service._on_connected()
+        self.mqtt_service.drain(timeout=0)
+        self.mqtt_service.tracker.acknowledged(1)  # solo porta confermata
+
+        self.mqtt_service._on_connected()
+        self.assertTrue(self.mqtt_service.resync_requested)
+        self.mqtt_service.tracker.discarded(self.mqtt_service.tracker.inflight.pop(2))
+        self.mqtt_service.drain(timeout=0)
+        self.assertEqual(self.mqtt_client_mock.publish_message.call_count, 3)
+        self.assertEqual(self._published()[-1], ("alarm/finestra/status", "open", 2, False))
+        self.assertEqual(self.mqtt_service.stats()["republished"], 1)
+
+    def test_reconnect_does_not_replay_lost_events(self):
+        self.mqtt_client_mock.publish_message.side_effect = [1, 2]
+        self.mqtt_service.publish_access("entrance", bytes.fromhex("DEADBEEF"), "admin")
+        self.mqtt_service.publish_tag("entrance", bytes.fromhex("DEADBEEF"))
+        self.mqtt_service.drain(timeout=0)
+        # both lost with the connection
+        for mid in (1, 2):
+            self.mqtt_service.tracker.discarded(self.mqtt_service.tracker.inflight.pop(mid))
+        self.mqtt_service._on_connected()
+        self.mqtt_service._on_connected()
+        self.assertEqual(self.mqtt_service.tracker.out_of_sync(), [])
+        self.mqtt_service.drain(timeout=0)
+        self.assertEqual(self.mqtt_client_mock.publish_message.call_count, 2)
+
+    def test_user_properties_and_payload_format(self):
+        from app.models import PayloadFormat
+
+        self.mqtt_service = MqttService(self.mqtt_client_mock, payload_format=PayloadFormat.JSON)
+        self.mqtt_service.publish_message(MessageModel(status="open", name="porta", pin=27, timestamp=1.5))
+        self.mqtt_service.publish_message(MessageModel(status="closed", name="porta", pin=27, timestamp=2.0))
+        self.mqtt_service.drain(timeout=0)
+        first, second = self.mqtt_client_mock.publish_message.call_args_list
+        self.assertEqual(first.args[1], '{"status":"open","pin":27,"name":"porta"}')
+        self.assertEqual(first.args[4], (("pin", "27"), ("ts", "1500000000"), ("seq", "1")))
+        self.assertEqual(second.args[4][2], ("seq", "2"))
+
+    @patch("app.services.time.monotonic")
+    def test_latency_recorded_per_stage(self, monotonic_mock):
+        self.mqtt_client_mock.publish_message.return_value = 9
+        monotonic_mock.return_value = 10.001
+        self.mqtt_service.publish_message(MessageModel(status="open", name="porta", pin=27, qos=2, timestamp=10.0))
+        monotonic_mock.return_value = 10.003
+        self.mqtt_service.drain(timeout=0)
+        monotonic_mock.return_value = 10.010
+        self.mqtt_service._on_published(9)
+        report = self.mqtt_service.latency.report()[27]
+        self.assertEqual(set(report), {"enqueue", "publish", "ack"})
+        self.assertAlmostEqual(report["enqueue"]["max"], 0.001)
+        self.assertAlmostEqual(report["publish"]["max"], 0.003)
+        self.assertAlmostEqual(report["ack"]["max"], 0.010)
+        self.assertEqual(report["ack"]["count"], 1)
+
+    def test_status_is_online_while_connected(self):
+        self.mqtt_service = MqttService(self.mqtt_client_mock, status_topic="status")
+        self.mqtt_client_mock.is_connected.return_value = True
+        self.mqtt_service._on_connected()
+        self.mqtt_service.disconnect()
+        self.mqtt_service.drain(timeout=0)
+        self.assertEqual(self._published(), [("alarm/status", "online", 1, True), ("alarm/status", "offline", 1, True)])
+
+    def test_digest_is_scheduled_and_skipped_offline(self):
+        self.mqtt_service = MqttService(self.mqtt_client_mock, digest_interval=60.0)
+        self.assertEqual(self.mqtt_service.digest_in(100.0), 0.0)
+        self.mqtt_client_mock.is_connected.return_value = False
+        self.mqtt_service.publish_digest([True], 100.0)
+        self.assertEqual(self.mqtt_service.digest_in(130.0), 30.0)
+        self.mqtt_client_mock.is_connected.return_value = True
+        self.mqtt_service.publish_digest([True, False], 160.0)
+        self.mqtt_service.drain(timeout=0)
+        self.assertEqual(self._published(), [("alarm/digest", "1,2,01", 0, False)])
+        self.assertIsNone(MqttService(self.mqtt_client_mock).digest_in(0.0))
 
     def test_get_topic(self):
         self.assertEqual(self.mqtt_service._get_topic("test/status"), "alarm/test/status")
@@ -38,7 +252,13 @@ class TestSensorsService(TestCase):
     def setUp(self):
         self.sensors_config_mock = MagicMock()
         self.sensors_config_mock.sensors = {27: "porta", 22: "finestra"}
-        self.sensors_config_mock.is_real_board = False
+        self.sensors_config_mock.is_real_board.return_value = False
+        self.sensors_config_mock.debounce_for.return_value = 0.05
+        self.sensors_config_mock.debounce_samples = 1
+        self.sensors_config_mock.fault_window = 60.0
+        self.sensors_config_mock.fault_transitions = 30
+        self.sensors_config_mock.fault_bounces = 100
+        self.sensors_config_mock.fault_stuck = 0.0
         self.mqtt_service_mock = MagicMock(spec=MqttService)
         self.sensors_service = SensorsService(
             sensors_config=self.sensors_config_mock, mqtt_service=self.mqtt_service_mock
@@ -49,115 +269,459 @@ class TestSensorsService(TestCase):
         self.assertEqual(self.sensors_service.name_from_pin(1), "test1")
 
     def test_is_real_board_delegates_to_config(self):
-        self.sensors_config_mock.is_real_board = True
+        self.sensors_config_mock.is_real_board.return_value = True
         self.assertTrue(self.sensors_service.is_real_board)
-        self.sensors_config_mock.is_real_board = False
+        self.sensors_config_mock.is_real_board.return_value = False
         self.assertFalse(self.sensors_service.is_real_board)
 
     def test_connect_sensors_mock_mode_skips_gpio(self):
         self.sensors_service.connect_sensors()
-        self.assertEqual(self.sensors_service.lines, {})
+        self.assertEqual(self.sensors_service.states, {})
 
     def test_connect_sensors_gpiod_unavailable(self):
-        self.sensors_config_mock.is_real_board = True
+        self.sensors_config_mock.is_real_board.return_value = True
         with patch("app.services.GPIOD_AVAILABLE", False):
             self.sensors_service.connect_sensors()
-        self.assertEqual(self.sensors_service.lines, {})
+        self.assertEqual(self.sensors_service.states, {})
 
     def test_check_sensors_no_lines_does_nothing(self):
-        self.sensors_service.lines = {}
         self.sensors_service.check_sensors()
-        self.mqtt_service_mock.publish_message.assert_not_called()
+        self.mqtt_service_mock.publish_state.assert_not_called()
+
+    def _connect_lines(self, line_mock, value=1, pins=(27,)):
+        """Line request of the default chip for ``pins``, last read with ``value``."""
+        states = [SensorState(pin, self.sensors_config_mock.sensors[pin], "/dev/gpiochip0", value) for pin in pins]
+        driver = GpiodDriver("/dev/gpiochip0", list(pins), MagicMock(), self.sensors_config_mock)
+        driver.request, driver.edge = line_mock, True
+        self.sensors_service.drivers = {"/dev/gpiochip0": (driver, states)}
+        self.sensors_service.states = {state.pin: state for state in states}
+        self.sensors_config_mock.chip_for.return_value = "/dev/gpiochip0"
+
+    def _values(self):
+        return {pin: state.value for pin, state in self.sensors_service.states.items()}
 
     def test_check_sensors_publishes_on_change(self):
         line_mock = MagicMock()
-        line_mock.get_value.return_value = 0  # closed
-        self.sensors_service.lines = {27: (line_mock, "porta")}
-        self.sensors_service.last_values = {27: 1}  # era open, ora closed
+        line_mock.get_values.return_value = [0]  # closed
+        self._connect_lines(line_mock)  # era open, ora closed
+        self.sensors_service.check_sensors()
+        self.mqtt_service_mock.publish_state.assert_called_once()
+        pin, name, value, _ = self.mqtt_service_mock.publish_state.call_args[0]
+        self.assertEqual((pin, name, value), (27, "porta", 0))
+        self.assertEqual(self._values(), {27: 0})
+
+    def test_check_sensors_counts_iterations_and_reads(self):
+        line_mock = MagicMock()
+        line_mock.get_values.return_value = [1]
+        self._connect_lines(line_mock)
+        self.sensors_service.check_sensors()
         self.sensors_service.check_sensors()
-        self.mqtt_service_mock.publish_message.assert_called_once()
-        args = self.mqtt_service_mock.publish_message.call_args[0][0]
-        self.assertEqual(args.status, "closed")
-        self.assertEqual(args.pin, 27)
-        self.assertEqual(args.name, "porta")
+        self.assertEqual(self.sensors_service.iterations, 2)
+        self.assertEqual(self.sensors_service.reads, 2)
+        self.assertGreaterEqual(self.sensors_service.read_seconds, 0)
 
     def test_check_sensors_no_publish_without_change(self):
         line_mock = MagicMock()
-        line_mock.get_value.return_value = 1  # open
-        self.sensors_service.lines = {27: (line_mock, "porta")}
-        self.sensors_service.last_values = {27: 1}  # stesso valore
+        line_mock.get_values.return_value = [1]  # open
+        self._connect_lines(line_mock)  # stesso valore
         self.sensors_service.check_sensors()
-        self.mqtt_service_mock.publish_message.assert_not_called()
+        self.mqtt_service_mock.publish_state.assert_not_called()
 
     def test_check_sensors_debounce_blocks_rapid_change(self):
         import time
 
         line_mock = MagicMock()
-        line_mock.get_value.return_value = 0
-        self.sensors_service.lines = {27: (line_mock, "porta")}
-        self.sensors_service.last_values = {27: 1}
-        self.sensors_service.last_change[27] = time.time()  # appena cambiato
+        line_mock.get_values.return_value = [0]
+        self._connect_lines(line_mock)
+        self.sensors_service._debouncer(27).last_change = time.monotonic()  # appena cambiato
         self.sensors_service.check_sensors()
-        self.mqtt_service_mock.publish_message.assert_not_called()
+        self.mqtt_service_mock.publish_state.assert_not_called()
+
+    def _real_board_with_gpiod(self, request_lines_side_effect, sensors=None):
+        from app.models import SensorsConfig
 
+        self.sensors_service.config = SensorsConfig(
+            sensors=sensors or {27: "porta"}, chips={5: "/dev/gpiochip1"}, edge_detection=True
+        )
+        gpiod_mock = MagicMock()
+        gpiod_mock.request_lines.side_effect = request_lines_side_effect
+        return patch.multiple("app.services", gpiod=gpiod_mock, GPIOD_AVAILABLE=True, create=True), gpiod_mock
 
-class TestMockSensorService(TestCase):
+    def test_connect_sensors_enables_edge_mode(self):
+        request_mock = MagicMock()
+        request_mock.fd = 10
+        request_mock.get_values.return_value = [MagicMock(value=1)]
+        patcher, gpiod_mock = self._real_board_with_gpiod([request_mock])
+        with patcher:
+            self.sensors_service.connect_sensors()
+        self.assertTrue(self.sensors_service.edge_mode)
+        self.assertEqual(self.sensors_service.edge_fds, {10: "/dev/gpiochip0"})
+        self.assertEqual(self._values(), {27: 1})
+        settings_kwargs = gpiod_mock.LineSettings.call_args.kwargs
+        self.assertEqual(settings_kwargs["edge_detection"], gpiod_mock.line.Edge.BOTH)
+        snapshot = list(self.mqtt_service_mock.publish_snapshot.call_args[0][0])
+        self.assertEqual([(m.name, m.status) for m in snapshot], [("porta", "open")])
 
-    def setUp(self):
-        self.sensors_service_mock = MagicMock()
-        self.sensors_service_mock.config.sensors = {27: "porta", 22: "finestra"}
-        self.sensors_service_mock.mqtt_service = MagicMock()
-        self.mock_service = MockSensorService(self.sensors_service_mock)
-        self.mock_service.interval = 0.01  # Veloce per i test
-        self.stop_event_mock = MagicMock()
-        self.stop_event_mock.is_set.side_effect = [False, True]
-        self.mock_service.stop_event = self.stop_event_mock
-
-    def test_mock_states_initialized_from_config(self):
-        self.assertIn(27, self.mock_service.mock_states)
-        self.assertIn(22, self.mock_service.mock_states)
-        self.assertEqual(self.mock_service.mock_states[27], 1)
-        self.assertEqual(self.mock_service.mock_states[22], 1)
-
-    def test_toggle_state_publishes_for_all_sensors(self):
-        self.mock_service._toggle_state()
-        publish_calls = (
-            self.sensors_service_mock.mqtt_service.publish_message.call_count
+    def test_connect_sensors_one_request_per_chip(self):
+        chip0_request, chip1_request = MagicMock(fd=10), MagicMock(fd=11)
+        chip0_request.get_values.return_value = [1, 0]
+        chip1_request.get_values.return_value = [0]
+        patcher, gpiod_mock = self._real_board_with_gpiod(
+            [chip0_request, chip1_request], sensors={27: "porta", 22: "finestra", 5: "garage"}
         )
-        # Un ciclo con 2 sensori = 2 messaggi
-        self.assertEqual(publish_calls, 2)
-
-    def test_toggle_state_changes_value(self):
-        self.mock_service._toggle_state()
-        self.assertEqual(self.mock_service.mock_states[27], 0)  # 1 → 0
-        self.assertEqual(self.mock_service.mock_states[22], 0)
-
-    def test_toggle_publishes_correct_status(self):
-        self.mock_service._toggle_state()
-        calls = self.sensors_service_mock.mqtt_service.publish_message.call_args_list
-        msg_porta = calls[0][0][0]
-        self.assertEqual(msg_porta.status, "closed")  # 0=closed
-        self.assertEqual(msg_porta.pin, 27)
-        self.assertEqual(msg_porta.name, "porta")
-
-    @patch("threading.Thread")
-    def test_start(self, mock_thread):
-        thread_instance = MagicMock()
-        mock_thread.return_value = thread_instance
-        self.mock_service.start()
-        mock_thread.assert_called_once_with(
-            target=self.mock_service._toggle_state, daemon=True
+        with patcher:
+            self.sensors_service.connect_sensors()
+        self.assertEqual(gpiod_mock.request_lines.call_count, 2)
+        first_call, second_call = gpiod_mock.request_lines.call_args_list
+        self.assertEqual(first_call.args[0], "/dev/gpiochip0")
+        self.assertEqual(list(first_call.kwargs["config"]), [27, 22])
+        self.assertEqual(second_call.args[0], "/dev/gpiochip1")
+        self.assertEqual(self._values(), {27: 1, 22: 0, 5: 0})
+        self.assertEqual(self.sensors_service.drivers["/dev/gpiochip1"][0].request, chip1_request)
+        self.assertEqual(self.sensors_service.states[5].name, "garage")
+
+    def test_connect_sensors_falls_back_to_polling_without_edges(self):
+        request_mock = MagicMock()
+        request_mock.get_values.return_value = [0]
+        patcher, gpiod_mock = self._real_board_with_gpiod([OSError("not supported"), request_mock])
+        with patcher:
+            self.sensors_service.connect_sensors()
+        self.assertFalse(self.sensors_service.edge_mode)
+        driver = self.sensors_service.drivers["/dev/gpiochip0"][0]
+        self.assertEqual((driver.request, driver.pins), (request_mock, [27]))
+        self.assertNotIn("edge_detection", gpiod_mock.LineSettings.call_args.kwargs)
+
+    def test_check_sensors_reads_bank_with_one_call(self):
+        line_mock = MagicMock()
+        line_mock.get_values.return_value = [0, 1]
+        self._connect_lines(line_mock, pins=(27, 22))
+        self.sensors_service.states[22].value = 0
+        self.sensors_service.check_sensors()
+        line_mock.get_values.assert_called_once_with([27, 22])
+        self.assertEqual(self.mqtt_service_mock.publish_state.call_count, 2)
+
+    @patch("app.services.select.select")
+    def test_wait_events_publishes_on_edge(self, select_mock):
+        request_mock = MagicMock()
+        request_mock.get_values.return_value = [0]
+        self._connect_lines(request_mock)
+        self.sensors_service.edge_fds = {10: "/dev/gpiochip0"}
+        self.sensors_service.edge_mode = True
+        select_mock.return_value = ([10], [], [])
+        self.sensors_service.wait_events()
+        select_mock.assert_called_once_with([10], [], [], None)
+        request_mock.read_edge_events.assert_called_once()
+        self.assertEqual(self.mqtt_service_mock.publish_state.call_args[0][2], 0)
+
+    @patch("app.services.select.select")
+    def test_wait_events_uses_kernel_timestamp(self, select_mock):
+        request_mock = MagicMock()
+        request_mock.get_values.return_value = [0]
+        request_mock.read_edge_events.return_value = [
+            MagicMock(line_offset=27, timestamp_ns=1_000_000_000),
+            MagicMock(line_offset=27, timestamp_ns=1_500_000_000),
+        ]
+        self._connect_lines(request_mock)
+        self.sensors_service.edge_fds = {10: "/dev/gpiochip0"}
+        self.sensors_service.edge_mode = True
+        select_mock.return_value = ([10], [], [])
+        self.sensors_service.wait_events()
+        self.assertEqual(self.mqtt_service_mock.publish_state.call_args[0][3], 1.5)
+        self.assertEqual(self.sensors_service.states[27].debouncer.last_change, 1.5)
+
+    def test_check_sensors_needs_stable_samples(self):
+        self.sensors_config_mock.debounce_samples = 3
+        line_mock = MagicMock()
+        line_mock.get_values.return_value = [0]
+        self._connect_lines(line_mock)
+        self.sensors_service.check_sensors()
+        self.sensors_service.check_sensors()
+        self.mqtt_service_mock.publish_state.assert_not_called()
+        self.assertEqual(self.sensors_service.pending, {27})
+        self.sensors_service.check_sensors()
+        self.mqtt_service_mock.publish_state.assert_called_once()
+
+    def test_per_sensor_debounce(self):
+        self.sensors_config_mock.debounce_for.side_effect = lambda pin: {27: 0.5}.get(pin, 0.01)
+        self._connect_lines(MagicMock(), pins=(27, 22))
+        self.assertEqual(self.sensors_service._debouncer(27).settle, 0.5)
+        self.assertEqual(self.sensors_service._debouncer(22).settle, 0.01)
+
+    def test_connect_sensors_with_hardware_debounce(self):
+        request_mock = MagicMock(fd=10)
+        request_mock.get_values.return_value = [1]
+        patcher, gpiod_mock = self._real_board_with_gpiod([request_mock])
+        self.sensors_service.config.hardware_debounce = True
+        self.sensors_service.config.debounce_times = {27: 0.02}
+        with patcher:
+            self.sensors_service.connect_sensors()
+        settings_kwargs = gpiod_mock.LineSettings.call_args.kwargs
+        self.assertEqual(settings_kwargs["debounce_period"].total_seconds(), 0.02)
+        self.assertEqual(self.sensors_service._debouncer(27).settle, 0.0)
+
+    def test_connect_sensors_hardware_debounce_rejected(self):
+        request_mock = MagicMock(fd=10)
+        request_mock.get_values.return_value = [1]
+        patcher, gpiod_mock = self._real_board_with_gpiod([OSError("not supported"), request_mock])
+        self.sensors_service.config.hardware_debounce = True
+        with patcher:
+            self.sensors_service.connect_sensors()
+        self.assertTrue(self.sensors_service.edge_mode)
+        self.assertNotIn("debounce_period", gpiod_mock.LineSettings.call_args.kwargs)
+        self.assertEqual(self.sensors_service._debouncer(27).settle, 0.05)
+
+    @patch("app.services.select.select")
+    def test_wait_events_rechecks_debounced_pin(self, select_mock):
+        import time
+
+        request_mock = MagicMock()
+        request_mock.get_values.return_value = [0]
+        self._connect_lines(request_mock)
+        self.sensors_service.edge_fds = {10: "/dev/gpiochip0"}
+        self.sensors_service._debouncer(27).last_change = time.monotonic()
+        self.sensors_service.edge_mode = True
+        select_mock.return_value = ([10], [], [])
+        self.sensors_service.wait_events()
+        self.mqtt_service_mock.publish_state.assert_not_called()
+        self.assertEqual(self.sensors_service.pending, {27})
+
+        self.sensors_service._debouncer(27).last_change -= 0.05
+        select_mock.return_value = ([], [], [])
+        self.sensors_service.wait_events()
+        self.assertLessEqual(select_mock.call_args[0][3], 0.05)
+        self.mqtt_service_mock.publish_state.assert_called_once()
+        self.assertEqual(self.sensors_service.pending, set())
+
+    def test_publish_digest_in_pin_order(self):
+        self.mqtt_service_mock.digest_in.side_effect = [0.0, 60.0]
+        self._connect_lines(MagicMock(), value=0, pins=(27,))
+        self.assertEqual(self.sensors_service.publish_digest(10.0), 60.0)
+        # finestra (22) has not been read yet and counts as open
+        self.mqtt_service_mock.publish_digest.assert_called_once_with([True, False], 10.0)
+
+    def test_wait_events_noop_in_polling_mode(self):
+        self.sensors_service.wait_events(timeout=0)
+        self.mqtt_service_mock.publish_state.assert_not_called()
+
+
+class TestSensorsServiceApplyConfig(TestCase):
+
+    def setUp(self):
+        self.config = SensorsConfig(sensors={27: "porta", 22: "finestra"}, chips={5: "/dev/gpiochip1"})
+        self.mqtt_service_mock = MagicMock(spec=MqttService)
+        self.sensors_service = SensorsService(self.config, self.mqtt_service_mock, gpio_backend=fake_gpiod)
+        self.sensors_service.connect_sensors()
+
+    def tearDown(self):
+        fake_gpiod.reset()
+
+    def _published(self):
+        return [c.args[1:3] for c in self.mqtt_service_mock.publish_state.call_args_list]
+
+    def test_unchanged_chip_keeps_its_request(self):
+        driver = self.sensors_service.drivers["/dev/gpiochip0"][0]
+        debouncer = self.sensors_service._debouncer(27)
+        self.sensors_service.apply_config(self.config.model_copy(
+            update={"sensors": {27: "porta", 22: "finestra", 5: "garage"}}
+        ))
+        self.assertIs(self.sensors_service.drivers["/dev/gpiochip0"][0], driver)
+        self.assertIs(self.sensors_service._debouncer(27), debouncer)
+        self.assertEqual(self.sensors_service.drivers["/dev/gpiochip1"][0].pins, [5])
+        self.assertTrue(self.sensors_service.edge_mode)
+        snapshot = list(self.mqtt_service_mock.publish_snapshot.call_args.args[0])
+        self.assertEqual([message.name for message in snapshot], ["garage"])
+
+    def test_changed_chip_is_requested_again_keeping_state(self):
+        old_request = self.sensors_service.drivers["/dev/gpiochip0"][0].request
+        debouncer = self.sensors_service._debouncer(27)
+        fake_gpiod.chip("/dev/gpiochip0").set_value(27, 0)
+        self.sensors_service.apply_config(self.config.model_copy(update={"sensors": {27: "porta", 17: "cantina"}}))
+        self.assertTrue(old_request.released)
+        self.assertEqual(self.sensors_service.drivers["/dev/gpiochip0"][0].pins, [27, 17])
+        self.assertIs(self.sensors_service._debouncer(27), debouncer)
+        self.assertNotIn(22, self.sensors_service.states)
+        self.assertEqual(list(self.sensors_service.edge_fds.values()), ["/dev/gpiochip0"])
+        # the change during the reload is published as any other change
+        self.assertEqual(self._published(), [("porta", 0)])
+
+    def test_renamed_sensor_and_new_debounce(self):
+        debouncer = self.sensors_service._debouncer(27)
+        self.sensors_service._debouncer(22)
+        self.sensors_service.apply_config(self.config.model_copy(
+            update={"sensors": {27: "ingresso", 22: "finestra"}, "debounce_times": {22: 0.2}}
+        ))
+        self.assertEqual(self.sensors_service.states[27].name, "ingresso")
+        self.assertIs(self.sensors_service._debouncer(27), debouncer)
+        self.assertEqual(self.sensors_service._debouncer(22).settle, 0.2)
+
+    def test_connect_sensors_reports_the_values_read_at_startup(self):
+        service = SensorsService(self.config, self.mqtt_service_mock, gpio_backend=fake_gpiod)
+        fake_gpiod.chip("/dev/gpiochip0").set_value(22, 0)
+        snapshots = []
+        self.mqtt_service_mock.publish_snapshot.side_effect = lambda messages: snapshots.append(
+            [(message.name, message.status) for message in messages]
         )
-        thread_instance.start.assert_called_once()
-        self.assertEqual(self.mock_service.thread, thread_instance)
-
-    def test_stop(self):
-        thread_mock = MagicMock()
-        self.mock_service.thread = thread_mock
-        self.mock_service.stop_event = MagicMock()
-        self.mock_service.stop()
-        self.mock_service.stop_event.set.assert_called_once()
-        thread_mock.join.assert_called_once()
+        service.connect_sensors({27: 0, 22: 0})
+        self.assertEqual(snapshots, [[("porta", "closed"), ("finestra", "closed")]])
+        # porta opened after the first read
+        self.assertEqual(self._published(), [("porta", 1)])
+
+    def test_chip_failing_to_reopen_does_not_stop_the_others(self):
+        connect_chip = self.sensors_service._connect_chip
+
+        def failing(chip, pins):
+            if chip == "/dev/gpiochip0":
+                raise OSError("Device or resource busy")
+            connect_chip(chip, pins)
+
+        self.sensors_service.pending.add(27)
+        with patch.object(self.sensors_service, "_connect_chip", side_effect=failing):
+            self.sensors_service.apply_config(self.config.model_copy(
+                update={"sensors": {27: "porta", 17: "cantina", 5: "garage"}}
+            ))
+        self.assertNotIn("/dev/gpiochip0", self.sensors_service.drivers)
+        self.assertEqual(self.sensors_service.drivers["/dev/gpiochip1"][0].pins, [5])
+        self.assertEqual(set(self.sensors_service.states), {5})
+        self.assertEqual(self.sensors_service.pending, set())
+        fake_gpiod.chip("/dev/gpiochip1").set_value(5, 1)
+        self.sensors_service.wait_events(timeout=0)
+
+
+class TestRfidService(TestCase):
+
+    def setUp(self):
+        self.bus = FakeSpiBus()
+        self.entrance = self.bus.add(8, 25)
+        self.garage = self.bus.add(7, 24)
+        self.config = RfidConfig(sensors={"entrance": "8,25", "garage": "7,24"})
+        self.mqtt_service_mock = MagicMock(spec=MqttService)
+        self.rfid_service = RfidService(self.config, self.mqtt_service_mock, self.bus)
+
+    def test_connect_sensors(self):
+        self.rfid_service.connect_sensors()
+        self.assertTrue(self.bus.opened)
+        self.assertEqual([reader.name for reader in self.rfid_service.readers], ["entrance", "garage"])
+
+    def test_reader_not_answering_is_skipped(self):
+        del self.bus.readers[7]
+        self.rfid_service.connect_sensors()
+        self.assertEqual([reader.name for reader in self.rfid_service.readers], ["entrance"])
+
+    def test_without_spidev_readers_are_disabled(self):
+        service = RfidService(self.config, self.mqtt_service_mock)
+        with patch("app.services.SPIDEV_AVAILABLE", False):
+            service.connect_sensors()
+        self.assertEqual(service.readers, [])
+
+    def test_poll_publishes_and_backs_off_while_idle(self):
+        self.rfid_service.connect_sensors()
+        self.entrance.place(bytes.fromhex("DEADBEEF"))
+        self.rfid_service.poll(100.0)
+        self.mqtt_service_mock.publish_tag.assert_called_once_with("entrance", bytes.fromhex("DEADBEEF"))
+        entrance, garage = self.rfid_service.readers
+        self.assertEqual(entrance.interval, 0.05)
+        self.assertAlmostEqual(garage.interval, 0.075)
+        for _ in range(10):
+            self.rfid_service.poll(garage.next_poll)
+        self.assertEqual(garage.interval, 0.3)
+
+    def test_only_due_readers_are_polled(self):
+        self.rfid_service.connect_sensors()
+        self.rfid_service.poll(100.0)
+        transceives = self.garage.transceives
+        self.rfid_service.readers[1].next_poll = 200.0
+        self.rfid_service.poll(150.0)
+        self.assertEqual(self.garage.transceives, transceives)
+
+    def test_thread_start_stop(self):
+        self.rfid_service.connect_sensors()
+        self.rfid_service.start()
+        self.entrance.place(bytes.fromhex("01020304"))
+        for _ in range(200):
+            if self.mqtt_service_mock.publish_tag.called:
+                break
+            threading.Event().wait(0.01)
+        self.rfid_service.stop()
+        self.mqtt_service_mock.publish_tag.assert_called_with("entrance", bytes.fromhex("01020304"))
+        self.assertFalse(self.bus.opened)
+
+    def test_held_tag_is_published_once(self):
+        self.rfid_service.connect_sensors()
+        self.entrance.place(bytes.fromhex("DEADBEEF"))
+        for step in range(20):
+            self.rfid_service.poll(100.0 + step * 0.05)
+        self.mqtt_service_mock.publish_tag.assert_called_once()
+        self.assertEqual(self.rfid_service.duplicates, 19)
+        self.entrance.remove()
+        self.rfid_service.poll(102.0)
+        self.entrance.place(bytes.fromhex("DEADBEEF"))
+        self.rfid_service.poll(103.5)
+        self.assertEqual(self.mqtt_service_mock.publish_tag.call_count, 2)
+
+    def test_another_tag_is_published_within_the_window(self):
+        self.rfid_service.connect_sensors()
+        self.entrance.place(bytes.fromhex("DEADBEEF"))
+        self.rfid_service.poll(100.0)
+        self.entrance.place(bytes.fromhex("01020304"))
+        self.rfid_service.poll(100.05)
+        self.assertEqual(self.mqtt_service_mock.publish_tag.call_count, 2)
+
+    def test_allow_list_from_file(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+            f.write("# front door\nDEADBEEF Anna\n")
+        self.addCleanup(os.unlink, f.name)
+        config = self.config.model_copy(update={"allow_list": f.name})
+        service = RfidService(config, self.mqtt_service_mock, self.bus)
+        service.connect_sensors()
+        self.entrance.place(bytes.fromhex("DEADBEEF"))
+        self.garage.place(bytes.fromhex("01020304"))
+        service.poll(100.0)
+        self.mqtt_service_mock.publish_access.assert_has_calls([
+            call("entrance", bytes.fromhex("DEADBEEF"), "Anna"),
+            call("garage", bytes.fromhex("01020304"), None),
+        ])
+
+    def test_allow_list_from_retained_topic(self):
+        config = self.config.model_copy(update={"allow_list_topic": "alarm/allow"})
+        service = RfidService(config, self.mqtt_service_mock, self.bus)
+        service.connect_sensors()
+        topic, callback = self.mqtt_service_mock.subscribe.call_args.args
+        self.assertEqual(topic, "alarm/allow")
+        callback(b'["01020304"]')
+        self.garage.place(bytes.fromhex("01020304"))
+        service.poll(100.0)
+        self.mqtt_service_mock.publish_access.assert_called_once_with("garage", bytes.fromhex("01020304"), "")
+
+    def test_apply_config_reconnects_the_readers(self):
+        self.rfid_service.connect_sensors()
+        self.rfid_service.start()
+        self.rfid_service.apply_config(RfidConfig(sensors={"garage": "7,24"}))
+        self.assertIsNone(self.rfid_service.thread)
+        self.assertTrue(self.bus.opened)
+        self.assertEqual([reader.name for reader in self.rfid_service.readers], ["garage"])
+        self.rfid_service.start()
+        self.rfid_service.stop()
+
+    @patch("app.services.GPIOD_AVAILABLE", True)
+    @patch("app.services.SPIDEV_AVAILABLE", True)
+    @patch("app.services.SpidevTransport")
+    def test_apply_config_opens_the_bus_with_the_new_settings(self, transport_class):
+        transport_class.side_effect = lambda *settings: self.bus
+        service = RfidService(self.config, self.mqtt_service_mock)
+        service.connect_sensors()
+        service.apply_config(self.config.model_copy(update={"spi_device": 1, "spi_speed": 500000}))
+        self.assertEqual(transport_class.call_count, 2)
+        self.assertEqual(transport_class.call_args.args[1:3], (1, 500000))
+        # an injected transport is kept
+        self.rfid_service.connect_sensors()
+        self.rfid_service.apply_config(self.config.model_copy(update={"spi_speed": 500000}))
+        self.assertIs(self.rfid_service.transport, self.bus)
+
+    def test_without_allow_list_no_decision(self):
+        self.rfid_service.connect_sensors()
+        self.entrance.place(bytes.fromhex("DEADBEEF"))
+        self.rfid_service.poll(100.0)
+        self.mqtt_service_mock.publish_access.assert_not_called()
 
 
 if __name__ == "__main__":
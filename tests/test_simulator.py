@@ -0,0 +1,98 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from app import fake_gpiod
+from app.models import SensorsConfig, SimulatorConfig, SimulatorMode
+from app.services import SensorsService
+from app.simulator import GpioSimulator, load_trace
+
+
+class TestGpioSimulator(TestCase):
+
+    def setUp(self):
+        self.sensors_config = SensorsConfig(sensors={27: "porta", 22: "finestra"}, debounce=0)
+
+    def tearDown(self):
+        fake_gpiod.reset()
+
+    def _simulator(self, **config):
+        return GpioSimulator(self.sensors_config, SimulatorConfig(**config))
+
+    def _run_until(self, simulator, condition, timeout=2.0):
+        simulator.start()
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.001)
+        simulator.stop()
+
+    def test_interval_from_environment(self):
+        os.environ["MOCK_INTERVAL"] = "3"
+        try:
+            self.assertEqual(SimulatorConfig().interval, 3.0)
+        finally:
+            del os.environ["MOCK_INTERVAL"]
+
+    def test_delays_per_mode(self):
+        periodic = self._simulator(interval=2, intervals={22: 5})
+        self.assertEqual(periodic._next_delay(27), 2)
+        self.assertEqual(periodic._next_delay(22), 5)
+        poisson = self._simulator(mode=SimulatorMode.POISSON, interval=2, seed=1)
+        delays = [poisson._next_delay(27) for _ in range(2000)]
+        self.assertAlmostEqual(sum(delays) / len(delays), 2, delta=0.2)
+        uniform = self._simulator(mode=SimulatorMode.RANDOM, interval=2, seed=1)
+        self.assertTrue(all(0 <= uniform._next_delay(27) <= 4 for _ in range(100)))
+
+    def test_change_with_bounces(self):
+        simulator = self._simulator(bounces=2, bounce_time=0.004, interval=10)
+        simulator._change(27, 100.0)
+        self.assertEqual(fake_gpiod.chip("/dev/gpiochip0").values[27], 0)
+        timers = sorted(simulator.timers)
+        self.assertEqual([(at, value) for at, _, _, value in timers[:4]],
+                         [(100.001, 1), (100.002, 0), (100.003, 1), (100.004, 0)])
+        self.assertEqual(timers[-1][0], 110.004)
+        self.assertIsNone(timers[-1][3])
+
+    def test_feeds_sensors_service(self):
+        mqtt_service = MagicMock()
+        sensors_service = SensorsService(self.sensors_config, mqtt_service, gpio_backend=fake_gpiod)
+        sensors_service.connect_sensors()
+        self.assertTrue(sensors_service.edge_mode)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.csv")
+            with open(path, "w") as f:
+                f.write("0.001,27,closed\n0.002,22,closed\n")
+            # a trace changes every pin exactly once, so the values to publish are known
+            simulator = self._simulator(mode=SimulatorMode.TRACE, trace=path)
+            self._run_until(simulator, lambda: simulator.changes >= 2)
+        self.assertEqual(simulator.changes, 2)
+        sensors_service.wait_events(timeout=0)
+        values = {call.args[0]: call.args[2] for call in mqtt_service.publish_state.call_args_list}
+        self.assertEqual(values, {27: 0, 22: 0})
+        sensors_service.close()
+
+    def test_trace_replay(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.csv")
+            with open(path, "w") as f:
+                f.write("# seconds,pin,state\n0.002,22,open\n0.001,27,closed\n\n0.003,27,1\n")
+            self.assertEqual(load_trace(path), [(0.001, 27, 0), (0.002, 22, 1), (0.003, 27, 1)])
+            simulator = self._simulator(mode=SimulatorMode.TRACE, trace=path)
+            self._run_until(simulator, lambda: simulator.changes >= 3)
+        self.assertEqual(simulator.changes, 3)
+        chip = fake_gpiod.chip("/dev/gpiochip0")
+        self.assertEqual(chip.request({27: fake_gpiod.LineSettings(), 22: fake_gpiod.LineSettings()})
+                         .get_values([27, 22]), [1, 1])
+
+    def test_thousands_of_sensors(self):
+        self.sensors_config = SensorsConfig(sensors={pin: f"s{pin}" for pin in range(5000)})
+        simulator = self._simulator(mode=SimulatorMode.POISSON, interval=0.5, seed=3)
+        self._run_until(simulator, lambda: simulator.changes >= 1000)
+        self.assertGreaterEqual(simulator.changes, 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+
+from app.publisher import OutboundMessage
+from app.spool import MessageSpool
+
+
+class TestMessageSpool(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "spool.bin")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _payloads(self, spool):
+        return [(m.topic, m.payload, m.qos) for m in spool.pending()]
+
+    def test_append_and_pending_in_order(self):
+        spool = MessageSpool(self.path)
+        spool.append(OutboundMessage("alarm/a/status", "open", 2))
+        spool.append(OutboundMessage("alarm/b/status", "closed", 1))
+        self.assertEqual(spool.depth, 2)
+        self.assertEqual(
+            self._payloads(spool),
+            [("alarm/a/status", b"open", 2), ("alarm/b/status", b"closed", 1)],
+        )
+        spool.close()
+
+    def test_survives_restart(self):
+        spool = MessageSpool(self.path)
+        spool.append(OutboundMessage("alarm/a/status", "open", 2))
+        spool.close()
+        reopened = MessageSpool(self.path)
+        self.assertEqual(reopened.depth, 1)
+        self.assertEqual(self._payloads(reopened), [("alarm/a/status", b"open", 2)])
+        reopened.close()
+
+    def test_ignores_truncated_record(self):
+        spool = MessageSpool(self.path)
+        spool.append(OutboundMessage("alarm/a/status", "open", 2))
+        spool.close()
+        with open(self.path, "ab") as f:
+            f.write(b"\x05\x00\x10")
+        reopened = MessageSpool(self.path)
+        self.assertEqual(reopened.depth, 1)
+        reopened.close()
+
+    def test_consume(self):
+        spool = MessageSpool(self.path)
+        for topic in ("a", "b", "c"):
+            spool.append(OutboundMessage(topic, "open"))
+        spool.consume(2)
+        self.assertEqual(spool.depth, 1)
+        self.assertEqual([m.topic for m in spool.pending()], ["c"])
+        spool.consume(1)
+        self.assertEqual(spool.depth, 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        spool.close()
+
+    def test_bounded_drops_oldest(self):
+        spool = MessageSpool(self.path, max_messages=2)
+        for topic in ("a", "b", "c"):
+            spool.append(OutboundMessage(topic, "open"))
+        self.assertEqual(spool.depth, 2)
+        self.assertEqual(spool.dropped, 1)
+        self.assertEqual([m.topic for m in spool.pending()], ["b", "c"])
+        spool.close()
+
+    def test_full_spool_is_trimmed_in_bulk(self):
+        spool = MessageSpool(self.path, max_messages=20)
+        for index in range(20):
+            spool.append(OutboundMessage(str(index), "open"))
+        rewrite = spool._rewrite
+        rewrites = []
+        spool._rewrite = lambda records: rewrites.append(len(records)) or rewrite(records)
+        for index in range(20, 22):
+            spool.append(OutboundMessage(str(index), "open"))
+        # the two oldest are dropped together, leaving room for the next append
+        self.assertEqual(rewrites, [18])
+        self.assertEqual((spool.depth, spool.dropped), (20, 2))
+        self.assertEqual([m.topic for m in spool.pending()][:2], ["2", "3"])
+        spool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
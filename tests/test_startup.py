@@ -0,0 +1,110 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import fake_gpiod
+from app.startup import StartupTimer, process_age, read_sensors
+
+CONFIG = """
+[mqtt]
+username = u
+password = p
+[sensors]
+Porta = 27
+finestra = 22
+garage = 5, /dev/gpiochip1
+cantina = 101
+[expanders]
+ext = mcp23017, 1, 0x20, 100
+[rfid]
+"""
+
+# stops the startup at the first read and reports the modules imported so far
+SPY = """
+import runpy, sys
+import app.startup
+
+def spy(path):
+    heavy = ("app.services", "app.container", "injector", "paho", "pydantic")
+    print(",".join(name for name in heavy if name in sys.modules))
+    sys.exit(0)
+
+app.startup.read_sensors = spy
+runpy.run_module("app", run_name="__main__")
+"""
+
+
+class TestStartupTimer(TestCase):
+
+    def test_process_age(self):
+        self.assertGreater(process_age(), 0)
+        with patch("builtins.open", side_effect=OSError):
+            self.assertEqual(process_age(), 0.0)
+
+    def test_interpreter_phase(self):
+        self.assertIn("interpreter", StartupTimer().phases)
+        with patch("app.startup.process_age", return_value=0.0):
+            self.assertNotIn("interpreter", StartupTimer().phases)
+
+    @patch("app.startup.time.monotonic")
+    def test_phases_and_milestones(self, monotonic_mock):
+        monotonic_mock.return_value = 100.0
+        with patch("app.startup.process_age", return_value=0.5):
+            timer = StartupTimer()
+        monotonic_mock.side_effect = [100.0, 100.2, 100.3]
+        with timer.phase("config"):
+            pass
+        self.assertTrue(timer.mark("gpio_state"))
+        self.assertFalse(timer.mark("gpio_state"))
+        self.assertAlmostEqual(timer.phases["config"], 0.2)
+        self.assertAlmostEqual(timer.milestones["gpio_state"], 0.8)
+        self.assertEqual(timer.report(), "interpreter 0.500 s, config 0.200 s; gpio_state at 0.800 s")
+
+
+class TestReadSensors(TestCase):
+
+    def setUp(self):
+        self.home = tempfile.TemporaryDirectory()
+        self.config_path = Path(self.home.name) / ".PiAlarmAdapter" / "config.ini"
+        self.config_path.parent.mkdir()
+        self.config_path.write_text(CONFIG)
+
+    def tearDown(self):
+        fake_gpiod.reset()
+        self.home.cleanup()
+
+    @patch.dict(os.environ, {"GPIO_MOCK": "true"})
+    def test_lines_of_the_board_are_read_and_released(self):
+        fake_gpiod.chip("/dev/gpiochip0").set_value(22, 0)
+        self.assertEqual(read_sensors(self.config_path), {27: 1, 22: 0, 5: 1})
+        self.assertEqual(fake_gpiod.chip("/dev/gpiochip0").requests, [])
+
+    @patch.dict(os.environ, {"GPIO_MOCK": "true"})
+    def test_chip_that_cannot_be_read_is_skipped(self):
+        original = fake_gpiod.request_lines
+
+        def request_lines(path, **kwargs):
+            if path == "/dev/gpiochip1":
+                raise OSError("No such file or directory")
+            return original(path, **kwargs)
+
+        with patch.object(fake_gpiod, "request_lines", request_lines), self.assertLogs("app.startup", "WARNING"):
+            self.assertEqual(read_sensors(self.config_path), {27: 1, 22: 1})
+
+    def test_read_before_the_services_are_imported(self):
+        env = dict(os.environ, HOME=self.home.name, GPIO_MOCK="true", RUNTIME="threads")
+        result = subprocess.run(
+            [sys.executable, "-c", SPY], env=env, capture_output=True, text=True, timeout=30,
+            cwd=Path(__file__).resolve().parent.parent,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from app.faults import BOUNCE
+from app.models import SensorsConfig, SimulatorConfig
+from app.services import MqttService, SensorsService
+from app.supervisor import FAULT, HEARTBEAT, RECORD, SNAPSHOT, STATE, RecordSink, Supervisor
+
+SENSORS = {27: "porta", 22: "finestra", 5: "garage", 6: "cantina"}
+CHIPS = {5: "/dev/gpiochip1", 6: "/dev/gpiochip2"}
+
+
+class FakeProcess:
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.pid = 1000
+        self.exitcode = None
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return self.exitcode is None
+
+    def terminate(self):
+        self.exitcode = -15
+
+    def kill(self):
+        self.exitcode = -9
+
+    def join(self, timeout=None):
+        pass
+
+
+class FakeContext:
+
+    def __init__(self):
+        self.processes = []
+
+    def Pipe(self, duplex=True):
+        return MagicMock(), MagicMock()
+
+    def Process(self, **kwargs):
+        process = FakeProcess(**kwargs)
+        self.processes.append(process)
+        return process
+
+
+class TestRecordSink(TestCase):
+
+    def test_records_are_sent_in_one_write(self):
+        conn = MagicMock()
+        sink = RecordSink(conn)
+        sink.publish_state(27, "porta", 1, 2.5)
+        sink.publish_fault(22, "finestra", BOUNCE, True)
+        sink.heartbeat(3.0)
+        sink.flush()
+        sink.flush()
+        conn.send_bytes.assert_called_once()
+        records = list(RECORD.iter_unpack(conn.send_bytes.call_args.args[0]))
+        self.assertEqual(records[0], (STATE, 1, 27, 2.5))
+        self.assertEqual(records[1][:3], (FAULT, 0x81, 22))
+        self.assertEqual(records[2], (HEARTBEAT, 0, 0, 3.0))
+
+
+class TestSupervisor(TestCase):
+
+    def setUp(self):
+        self.config = SensorsConfig(sensors=SENSORS, chips=CHIPS, zones={"ground": "porta, finestra"})
+        self.mqtt_service_mock = MagicMock(spec=MqttService)
+        self.sensors_service = SensorsService(self.config, self.mqtt_service_mock)
+        self.context = FakeContext()
+        self.supervisor = Supervisor(self.sensors_service, self.mqtt_service_mock, SimulatorConfig(), self.context)
+        self.supervisor.start()
+
+    def test_partition(self):
+        self.assertEqual(
+            Supervisor.partition(self.config),
+            [["/dev/gpiochip0"], ["/dev/gpiochip1"], ["/dev/gpiochip2"]],
+        )
+        self.assertEqual(
+            Supervisor.partition(self.config.model_copy(update={"workers": 2})),
+            [["/dev/gpiochip0", "/dev/gpiochip2"], ["/dev/gpiochip1"]],
+        )
+
+    def test_workers_read_only_their_sensors(self):
+        self.assertFalse(self.sensors_service.local)
+        config = self.context.processes[0].kwargs["args"][2]
+        self.assertEqual(config.sensors, {27: "porta", 22: "finestra"})
+        self.assertEqual(config.zones, {})
+
+    def test_records_are_published(self):
+        worker = self.supervisor.workers[0]
+        self.supervisor._apply(worker, RECORD.pack(SNAPSHOT, 0, 27, 1.0) + RECORD.pack(SNAPSHOT, 0, 22, 1.0))
+        self.assertEqual([msg.pin for msg in self.mqtt_service_mock.publish_snapshot.call_args.args[0]], [27, 22])
+        self.supervisor._apply(worker, RECORD.pack(STATE, 1, 27, 2.0) + RECORD.pack(FAULT, 0x81, 22, 2.0))
+        self.mqtt_service_mock.publish_state.assert_called_once_with(27, "porta", 1, 2.0)
+        self.mqtt_service_mock.publish_fault.assert_called_once_with(22, "finestra", BOUNCE, True)
+        self.assertEqual(self.mqtt_service_mock.publish_zone.call_args.args[0].active, True)
+        self.assertEqual(self.supervisor.records, 4)
+
+    def test_snapshot_after_a_restart_publishes_the_missed_changes(self):
+        worker = self.supervisor.workers[0]
+        self.supervisor._apply(worker, RECORD.pack(SNAPSHOT, 0, 27, 1.0) + RECORD.pack(SNAPSHOT, 0, 22, 1.0))
+        self.supervisor._apply(worker, RECORD.pack(SNAPSHOT, 1, 27, 5.0) + RECORD.pack(SNAPSHOT, 0, 22, 5.0))
+        self.assertEqual(self.mqtt_service_mock.publish_state.call_args.args[:3], (27, "porta", 1))
+        self.assertEqual(self.mqtt_service_mock.publish_state.call_count, 1)
+
+    def test_failed_workers_are_restarted_with_a_delay(self):
+        first, second = self.supervisor.workers[:2]
+        first.process.exitcode = 1
+        with patch("app.supervisor.time.monotonic", return_value=100.0):
+            second.last_seen = 100.0 - self.config.worker_timeout - 1
+            self.supervisor.check(100.0)
+        self.assertEqual((first.process, second.process), (None, None))
+        self.assertEqual(self.supervisor.stats()["workers"], 1)
+        self.supervisor.check(100.5)
+        self.assertIsNone(first.process)
+        self.supervisor.check(first.restart_at)
+        self.assertIsNotNone(first.process)
+        self.assertEqual(first.restarts, 1)
+        self.assertEqual(len(self.context.processes), 5)
+
+    def test_stop(self):
+        processes = list(self.context.processes)
+        self.supervisor.stop()
+        self.assertEqual([process.exitcode for process in processes], [-15] * 3)
+        self.assertEqual(self.supervisor.workers, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import configparser
+import unittest
+from unittest import TestCase
+
+from app.container import _parse_sensors
+from app.models import MqttConfig
+from app.topics import TopicTable
+
+
+class TestTopicTable(TestCase):
+
+    def test_default_layout(self):
+        table = TopicTable()
+        self.assertEqual(table.topics_for(27, "porta"), ("alarm/porta/status",))
+        self.assertEqual(table.event_topic("entrance/tag"), "alarm/entrance/tag")
+
+    def test_device_prefix_and_group_fan_out(self):
+        table = TopicTable(
+            prefix="home/{device}/",
+            device="pi1",
+            templates={"ground": ["{name}/status", "zone/{group}/last"], "garage": ["gpio/{pin}"]},
+            groups={"ground": ["porta", "finestra", "garage"]},
+        )
+        self.assertEqual(table.topics_for(27, "porta"), ("home/pi1/porta/status", "home/pi1/zone/ground/last"))
+        # a template of the sensor wins over those of its groups
+        self.assertEqual(table.topics_for(5, "garage"), ("home/pi1/gpio/5",))
+        self.assertEqual(table.topics_for(9, "cantina"), ("home/pi1/cantina/status",))
+
+    def test_config_lists_and_unknown_fields(self):
+        config = MqttConfig(
+            username="u", password="p", topics={"ground": "{name}/status, zone/{group}"}, groups={"ground": "a, b"}
+        )
+        self.assertEqual(config.topics, {"ground": ["{name}/status", "zone/{group}"]})
+        self.assertEqual(TopicTable.from_config(config).topics_for(1, "b"), ("alarm/b/status", "alarm/zone/ground"))
+        with self.assertRaises(ValueError):
+            MqttConfig(username="u", password="p", topic_template="{room}/status")
+
+    def test_group_members_match_the_lowercased_sensor_names(self):
+        parser = configparser.ConfigParser()
+        parser.read_string("[sensors]\nPorta = 27\n[topics]\nfloor = Zone/{group}\n[groups]\nfloor = Porta\n")
+        sensors, _ = _parse_sensors(parser["sensors"])
+        config = MqttConfig(username="u", password="p", topics=dict(parser["topics"]), groups=dict(parser["groups"]))
+        self.assertEqual(TopicTable.from_config(config).topics_for(27, sensors[27]), ("alarm/Zone/floor",))
+
+
+if __name__ == "__main__":
+    unittest.main()
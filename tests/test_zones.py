@@ -0,0 +1,130 @@
+import configparser
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+import app.container
+from app import fake_gpiod
+from app.models import MqttConfig, PayloadFormat, SensorsConfig, ZoneConfig
+from app.mqtt_client import MqttClient
+from app.publisher import ZONE_PAYLOAD
+from app.services import MqttService, SensorsService
+from app.topics import TopicTable
+from app.zones import ZoneEngine
+
+SENSORS = {27: "porta", 22: "finestra", 17: "garage"}
+
+
+class TestZoneEngine(TestCase):
+
+    def test_rules_and_counters(self):
+        engine = ZoneEngine({
+            "ground": ZoneConfig(members=["porta", "finestra"]),
+            "perimeter": ZoneConfig(members=["porta", "finestra", "garage"], rule="all"),
+            "two": ZoneConfig(members=["porta", "finestra", "garage"], rule="2"),
+        }, SENSORS)
+        engine.reset({27: 0, 22: 0, 17: 1})
+        zones = engine.zones
+        self.assertEqual([zone.open for zone in zones.values()], [0, 1, 1])
+        self.assertEqual([zone.active for zone in zones.values()], [False, False, False])
+
+        self.assertEqual([zone.name for zone in engine.update(27, 0, 1)], ["ground", "two"])
+        self.assertEqual([zone.name for zone in engine.update(22, 0, 1)], ["perimeter"])
+        # the aggregate of ground does not change while a member is still open
+        self.assertEqual([zone.name for zone in engine.update(27, 1, 0)], ["perimeter"])
+        self.assertEqual(zones["ground"].open, 1)
+        self.assertEqual(engine.update(22, 1, 1), [])
+        self.assertEqual(engine.update(99, 0, 1), [])
+
+    def test_unknown_members_are_ignored(self):
+        engine = ZoneEngine({
+            "ground": ZoneConfig(members=["porta", "cantina"], rule="all"),
+            "empty": ZoneConfig(members=["cantina"]),
+        }, SENSORS)
+        self.assertEqual(list(engine.zones), ["ground"])
+        self.assertEqual(engine.zones["ground"].threshold, 1)
+        # a value not read yet counts as closed
+        self.assertEqual([zone.name for zone in engine.update(27, -1, 1)], ["ground"])
+
+    def test_config_parsing(self):
+        config = SensorsConfig(sensors=SENSORS, zones={"ground": "porta, finestra", "all": "ALL: porta, garage"})
+        self.assertEqual(config.zones["ground"], ZoneConfig(members=["porta", "finestra"], rule="any"))
+        self.assertEqual(config.zones["all"].rule, "all")
+        with self.assertRaises(ValueError):
+            SensorsConfig(zones={"ground": "most: porta"})
+
+    def test_config_members_match_the_lowercased_sensor_names(self):
+        parser = configparser.ConfigParser()
+        parser.read_string("[sensors]\nPorta = 27\nFinestra = 22\n[zones]\nground = Porta, FINESTRA\n")
+        config = SensorsConfig(sensors=app.container._parse_sensors(parser["sensors"])[0], zones=dict(parser["zones"]))
+        self.assertEqual(ZoneEngine(config.zones, config.sensors).zones["ground"].pins, (27, 22))
+
+
+class TestZonePublishing(TestCase):
+
+    def setUp(self):
+        self.config = SensorsConfig(sensors=SENSORS, zones={"ground": "all: porta, finestra"})
+        self.mqtt_service_mock = MagicMock(spec=MqttService)
+        self.sensors_service = SensorsService(self.config, self.mqtt_service_mock, gpio_backend=fake_gpiod)
+        self.chip = fake_gpiod.chip("/dev/gpiochip0")
+        self.chip.set_value(27, 0)
+        self.chip.set_value(22, 0)
+        self.sensors_service.connect_sensors()
+
+    def tearDown(self):
+        fake_gpiod.reset()
+
+    def _zones(self):
+        return [(c.args[0].name, c.args[0].active) for c in self.mqtt_service_mock.publish_zone.call_args_list]
+
+    def test_zone_is_published_only_when_its_state_flips(self):
+        self.assertEqual(self._zones(), [("ground", False)])
+        self.mqtt_service_mock.publish_zone.reset_mock()
+        self.chip.set_value(27, 1)
+        self.sensors_service.check_sensors()
+        self.assertEqual(self._zones(), [])
+        self.chip.set_value(22, 1)
+        self.sensors_service.check_sensors()
+        self.assertEqual(self._zones(), [("ground", True)])
+        self.assertEqual(self.mqtt_service_mock.publish_state.call_count, 2)
+
+    def test_reload_publishes_the_zones_that_change(self):
+        self.mqtt_service_mock.publish_zone.reset_mock()
+        self.sensors_service.apply_config(self.config.model_copy(update={
+            "zones": {"ground": ZoneConfig(members=["porta", "finestra"]), "garage": ZoneConfig(members=["garage"])},
+        }))
+        self.assertEqual(self._zones(), [("garage", True)])
+
+    def test_reload_adding_an_open_member_counts_it(self):
+        self.sensors_service.apply_config(self.config.model_copy(update={
+            "sensors": {27: "porta"}, "zones": {"ground": ZoneConfig(members=["porta"])},
+        }))
+        self.chip.set_value(22, 1)
+        self.mqtt_service_mock.publish_zone.reset_mock()
+        self.sensors_service.apply_config(self.config.model_copy(update={
+            "zones": {"ground": ZoneConfig(members=["porta", "finestra"])},
+        }))
+        ground = self.sensors_service.zones.zones["ground"]
+        self.assertEqual((ground.open, ground.active), (1, True))
+        self.assertEqual(self._zones(), [("ground", True)])
+        self.chip.set_value(22, 0)
+        self.sensors_service.check_sensors()
+        self.assertEqual((ground.open, ground.active), (0, False))
+
+    def test_mqtt_service_encodes_the_zone(self):
+        client = MagicMock(spec=MqttClient)
+        service = MqttService(client, payload_format=PayloadFormat.BINARY, topics=TopicTable.from_config(
+            MqttConfig(username="u", password="p", device_id="pi1", topic_prefix="home/{device}/")
+        ))
+        zone = self.sensors_service.zones.zones["ground"]
+        service.publish_zone(zone, 1.0)
+        service.publish_zone(zone, snapshot=True)
+        service.drain(timeout=0)
+        client.publish_message.assert_called_once()
+        topic, payload, qos, _ = client.publish_message.call_args.args[:4]
+        self.assertEqual((topic, qos), ("home/pi1/zone/ground/status", 2))
+        self.assertEqual(ZONE_PAYLOAD.unpack(payload), (0, 0, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()